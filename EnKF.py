@@ -6,30 +6,71 @@ this class is for EnKF operations
 @author: cesny
 """
 import numpy as np
+from randomStreams import NoiseStream
+from observationOperator import ObsOperator
 from utils import setCTMVehicles, forwardCTMPropagation, CTMcreateInitialEnsemble, VmaxCreateInitialEnsemble, VmaxtoCritDen, cellToLength, lengthToCell
 
 
+class AssimilationWindow:
+  '''
+  forecasts and observations collected for one windowed analysis,
+  length is the number of time steps per analysis, kept outside
+  the filter so several rollouts can share one EnKF
+  '''
+  def __init__(self, length):
+    if length < 1:
+      raise Exception('... assimilation window needs at least one time step ...')
+    self.length = length
+    self.clear()
+  
+  def clear(self):
+    self.states = list()  # (cells x members) forecasts with model noise
+    self.predicted = list()  # H A of every step, the observed cells may change between steps
+    self.observations = list()
+    self.obsVariances = list()  # diagonal of R at each step, follows the drone
+    return None
+  
+  def add(self, A, predicted, observations, obsVariances):
+    self.states.append(A)
+    self.predicted.append(predicted)
+    self.observations.append(np.asarray(observations, dtype=float))
+    self.obsVariances.append(obsVariances)
+    return None
+  
+  def isFull(self):
+    return len(self.states) >= self.length
+
+
 class EnKF:
   '''
   this class is used to implement EnKF operations
   for implementation details, this code follows Evensen2003 
+  EnKFtype with an '-ETKF' suffix (e.g., 'CTM-ETKF') selects the
+  deterministic square root filter (Bishop2001, Hunt2007) instead
   '''
-  def __init__(self, obsError, modelError, sampleSize, stateDim, obsDim, m=None, assimilatedDensities=None, H=None, EnKFtype='CTM', nonLinearObs=False, droneLoc = None, trafficNet=None, droneDenObsError=None):
-    self.obsError = obsError  # specifies standard dev. of observ. white noise
+  def __init__(self, obsError, modelError, sampleSize, stateDim, obsDim, m=None, assimilatedDensities=None, H=None, EnKFtype='CTM', nonLinearObs=False, droneLoc = None, trafficNet=None, droneDenObsError=None, rng=None, noiseBlockSize=None):
+    self.obsError = obsError  # specifies standard dev. of observ. white noise, a scalar or one value per observation
     self.modelError = modelError  # specifies standard dev. of model white noise
     self.sampleSize = sampleSize  # number of ensemble members
     self.stateDim = stateDim  # dimension of an ensemble member
     self.obsDim = obsDim  # dimension of observation vector
-    self.EnKFtype = EnKFtype  # could be 'CTM' or 'Vmax'
+    self.EnKFtype = EnKFtype  # could be 'CTM' or 'Vmax', add '-ETKF' for the square root filter
     self.nonLinearObs = nonLinearObs
     self.assimDen = assimilatedDensities  # a list with two elements, assim. den upstream and assim den downstream
     self.m = m  # this is a function that takes as input the state vector as a list [vmax1, vmax2] and returns the model prediction of the parameters [v1, v2]
     self.droneLoc = droneLoc  # stores the drone location (linkID, cell) tuple
-    self.H = H  # create the matrix (vector) H if it is available
+    self.H = H  # the matrix H or an ObsOperator (observed cell indices) if it is available
     self.locToCell = dict()  # maps the tuple (link, cell) to cell between 0 and 40
     self.cellToLoc = dict()
     self.trafficNet = trafficNet
     self.droneDenObsError = droneDenObsError
+    self.noise = NoiseStream(rng, noiseBlockSize)  # draws model and obs. noise, noiseBlockSize pre-generates noise in blocks
+    self.adaptiveSize = None  # settings for run time ensemble resizing, see enableAdaptiveSize
+    self.storeSampleSize = list()
+    self.storeSpread = list()
+    self.storeInnovationRatio = list()
+    self.windowAnalysed = False  # True if the last windowStep ran an analysis
+    self.storeSmoothed = list()  # smoothed means of the steps of every window
     # store data!
     self.storePropEnsembles = list()
     self.storeAhat = list()
@@ -46,21 +87,33 @@ class EnKF:
     creates the mapping between (linkid, cell) to
     global cellindex between (0,40) across all links
     '''
-    cellindex = 0
-    for linkID in self.trafficNet.linkDict:
-      if linkID is not 9:
-        for cellkey, cell in enumerate(self.trafficNet.linkDict[linkID].cells):
-          self.locToCell[(linkID, cellkey)] = cellindex
-          self.cellToLoc[cellindex] = (linkID, cellkey)
-          cellindex += 1
+    geometry = self.trafficNet.getGeometry()
+    self.locToCell = geometry.locToCellMap
+    self.cellToLoc = geometry.cellToLocMap
     return None
   
+  def isSquareRoot(self):
+    '''
+    True if EnKFtype selects the square root filter
+    '''
+    return self.EnKFtype.endswith('ETKF')
+  
+  def getDroneObsRow(self):
+    '''
+    returns the observation row of the drone cell, None
+    if the cell is not observed
+    '''
+    droneCell = self.locToCell[self.droneLoc]
+    if isinstance(self.H, ObsOperator):
+      droneCell = self.H.obsRow(droneCell)
+    return droneCell
+  
   def genModErrorMatrix(self):
     '''
     generates a matrix of perturbations
     that will be used to perturb CTM forecasts
     '''
-    self.modelErrorMatrix = np.random.normal(loc=0.0, scale=self.modelError, size=(self.stateDim, self.sampleSize))  # for general multivariate normal, this could have been generated using  numpy.random.multivariate_normal(mean, cov)
+    self.modelErrorMatrix = self.noise.normal(loc=0.0, scale=self.modelError, size=(self.stateDim, self.sampleSize))  # for general multivariate normal, this could have been generated using  numpy.random.multivariate_normal(mean, cov)
     return None
   
   def genObsErrorMatrix(self):
@@ -72,23 +125,113 @@ class EnKF:
     congestion state
     note for future only considering drone obs in embedded EnKFs
     '''
-    if (self.EnKFtype is 'CTM') and (self.droneLoc is not None):
-      droneCell = self.locToCell[self.droneLoc]
-      self.obsErrorMatrix = np.random.normal(loc=0.0, scale=self.obsError, size=(self.obsDim, self.sampleSize))  # for general multivariate normal, this could have been generated using  numpy.random.multivariate_normal(mean, cov)
-      self.obsErrorMatrix[droneCell] = np.random.normal(loc=0.0, scale=self.droneDenObsError, size=self.sampleSize)  # lower error at location of  drone!
+    if self.EnKFtype.startswith('CTM') and (self.droneLoc is not None):
+      droneCell = self.getDroneObsRow()
+      self.obsErrorMatrix = self.noise.normal(loc=0.0, scale=self.getObsErrorScale(), size=(self.obsDim, self.sampleSize))  # for general multivariate normal, this could have been generated using  numpy.random.multivariate_normal(mean, cov)
+      if droneCell is not None:
+        self.obsErrorMatrix[droneCell] = self.noise.normal(loc=0.0, scale=self.droneDenObsError, size=self.sampleSize)  # lower error at location of  drone!
+    else:
+      self.obsErrorMatrix = self.noise.normal(loc=0.0, scale=self.getObsErrorScale(), size=(self.obsDim, self.sampleSize))
+    return None
+  
+  def getObsErrorScale(self):
+    '''
+    obs. error standard deviation for the noise draws, a column
+    of per observation values if obsError is an array
+    '''
+    if np.ndim(self.obsError) == 0:
+      return self.obsError
+    return np.asarray(self.obsError, dtype=float)[:, np.newaxis]
+
+  def setRandomStream(self, rng):
+    '''
+    replaces the noise stream keeping the block size, used to
+    give deep copies of the filter (e.g., in findPath) their own stream
+    '''
+    self.noise = NoiseStream(rng, self.noise.blockSize)
+    return None
+      
+  def enableAdaptiveSize(self, minSize, maxSize, growFactor=1.5, shrinkFactor=0.5, spreadTolerance=0.05, innovationThreshold=2.0, patience=5):
+    '''
+    lets EnKFStep grow and shrink the ensemble at run time
+    grows by growFactor when the normalized innovations exceed
+    innovationThreshold (spread too small for the observed errors)
+    shrinks by shrinkFactor when the spread changed by less than
+    spreadTolerance (relative) over the last patience steps and
+    the innovations are consistent
+    with the stochastic filter keep minSize above obsDim since R
+    is estimated from sampled noise
+    '''
+    self.adaptiveSize = {'minSize': minSize, 'maxSize': maxSize, 'growFactor': growFactor, 'shrinkFactor': shrinkFactor,
+                         'spreadTolerance': spreadTolerance, 'innovationThreshold': innovationThreshold, 'patience': patience}
+    self._stepsSinceResize = 0
+    return None
+  
+  def getInnovationRatio(self, observations):
+    '''
+    mean normalized innovation squared of the prior, close to 1
+    when the ensemble spread is consistent with the observed errors
+    '''
+    Ahat = self.predictObservations()
+    expectedVar = np.var(Ahat, axis=1, ddof=1) + self.getObsErrorVariances()
+    innovation = np.asarray(observations, dtype=float) - np.mean(Ahat, axis=1)
+    self.innovationRatio = float(np.mean(innovation**2 / expectedVar))
+    self.storeInnovationRatio.append(self.innovationRatio)
+    return self.innovationRatio
+  
+  def adaptEnsembleSize(self):
+    '''
+    decides on a new ensemble size from the spread and
+    innovation statistics and resizes the ensemble
+    '''
+    settings = self.adaptiveSize
+    spread = np.trace(self.getP()) / self.stateDim  # mean variance per state
+    self.storeSpread.append(spread)
+    self.storeSampleSize.append(self.sampleSize)
+    self._stepsSinceResize += 1
+    newSize = self.sampleSize
+    if self.innovationRatio > settings['innovationThreshold']:
+      newSize = min(settings['maxSize'], int(np.ceil(self.sampleSize * settings['growFactor'])))
+    elif self._stepsSinceResize > settings['patience']:
+      pastSpread = self.storeSpread[-settings['patience'] - 1]
+      if abs(spread - pastSpread) <= settings['spreadTolerance'] * pastSpread:
+        newSize = max(settings['minSize'], int(self.sampleSize * settings['shrinkFactor']))
+    if newSize != self.sampleSize:
+      self.resizeEnsemble(newSize)
+      self._stepsSinceResize = 0
+    return None
+  
+  def resizeEnsemble(self, newSize):
+    '''
+    grows the ensemble by resampling new members from the
+    ensemble mean and covariance (random combinations of the
+    anomalies), shrinks it by thinning to a random subset that
+    is recentered and rescaled to keep the mean and spread
+    '''
+    N = self.sampleSize
+    mean = np.mean(self.A, axis=1)
+    Aprime = self.A - mean[:, np.newaxis]
+    if newSize > N:
+      weights = self.noise.normal(loc=0.0, scale=1.0/np.sqrt(N - 1), size=(N, newSize - N))
+      self.A = np.concatenate((self.A, mean[:, np.newaxis] + np.dot(Aprime, weights)), axis=1)
     else:
-      self.obsErrorMatrix = np.random.normal(loc=0.0, scale=self.obsError, size=(self.obsDim, self.sampleSize))
+      keep = np.sort(self.noise.rng.choice(N, size=newSize, replace=False))
+      kept = Aprime[:, keep] - np.mean(Aprime[:, keep], axis=1)[:, np.newaxis]
+      keptSpread = np.sum(kept**2) / (newSize - 1)
+      if keptSpread > 0:
+        kept = kept * np.sqrt((np.sum(Aprime**2) / (N - 1)) / keptSpread)
+      self.A = mean[:, np.newaxis] + kept
+    self.sampleSize = newSize
+    self.getPriorDist()  # mean and P of the resized ensemble
     return None
       
   def getUpdatedEnsembles(self):
     '''
-    get the updated ensembles in list of lists format
-    needed for CTM processing, each sublist is a list
-    of densities
+    get a copy of the updated ensembles as a contiguous
+    (members x cells) array, the layout used for CTM
+    processing, each row is a member's densities
     '''
-    Atranspose = np.transpose(self.A)
-    listofLists = Atranspose.tolist()
-    return listofLists
+    return np.array(np.transpose(self.A), order='C')
   
   def getMean(self):
     '''
@@ -106,17 +249,33 @@ class EnKF:
     P = (1.0/(self.sampleSize-1)) * self.P
     return P
     
+  def applyH(self, X):
+    '''
+    returns H X, gathers rows when H is an ObsOperator
+    '''
+    if isinstance(self.H, ObsOperator):
+      return self.H.apply(X)
+    return np.dot(self.H, X)
+  
+  def applyHtranspose(self, P):
+    '''
+    returns P H^T, gathers columns when H is an ObsOperator
+    '''
+    if isinstance(self.H, ObsOperator):
+      return self.H.applyTranspose(P)
+    return np.dot(P, np.transpose(self.H))
+    
   def getPostDist(self):
     '''
     updates mean and covariance matrix based on
     observations
     '''
     if self.nonLinearObs is False:
-      self.A = self.A + np.dot(self.K, self.D - np.dot(self.H, self.A))
+      self.A = self.A + np.dot(self.K, self.D - self.applyH(self.A))
       scaleMatrix = np.full((self.sampleSize, self.sampleSize), 1.0/self.sampleSize)
       self.Abar = np.dot(self.A, scaleMatrix)
       self.mean = self.Abar[:,0]
-      self.P = self.P - np.dot(self.K, np.dot(self.H, self.P))
+      self.P = self.P - np.dot(self.K, self.applyH(self.P))
       
     elif self.nonLinearObs is True:
       self.A = self.A + np.dot(self.K, self.D - self.Ahat)
@@ -134,16 +293,13 @@ class EnKF:
     computes the Kalman gain
     '''
     if self.nonLinearObs is False:
-      temp1 = np.dot(self.P, np.transpose(self.H))
-      temp2 = np.dot(self.H, self.P)
-      temp2 = np.dot(temp2, np.transpose(self.H))
+      temp1 = self.applyHtranspose(self.P)
+      temp2 = self.applyH(temp1)
       temp2 = temp2 + self.R
       temp2 = np.linalg.inv(temp2)
       self.K = np.dot(temp1, temp2)
     elif self.nonLinearObs is True:
-      Ahat0 = self.m(self.A[0],self.assimDen[0])  # Warning, works specifically with problem at hand
-      Ahat1 = self.m(self.A[1], self.assimDen[1])
-      self.Ahat = np.stack((Ahat0,Ahat1)) # compute Ahat through the m function
+      self.Ahat = self.predictObservations()
       self.storeAhat.append(self.Ahat)
       scaleMatrix = np.full((self.sampleSize, self.sampleSize), 1.0/self.sampleSize)
       self.Ahatbar = np.dot(self.Ahat, scaleMatrix)
@@ -159,6 +315,51 @@ class EnKF:
       self.storeKalman.append(self.K)
     return None
   
+  def predictObservations(self):
+    '''
+    model predicted observations of every ensemble member,
+    through the m function if observations are nonlinear
+    '''
+    if self.nonLinearObs is True:
+      Ahat0 = self.m(self.A[0],self.assimDen[0])  # Warning, works specifically with problem at hand
+      Ahat1 = self.m(self.A[1], self.assimDen[1])
+      return np.stack((Ahat0,Ahat1)) # compute Ahat through the m function
+    return self.applyH(self.A)
+  
+  def getObsErrorVariances(self):
+    '''
+    diagonal of R for the square root filter, taken from
+    the specified obs. errors rather than sampled noise
+    '''
+    variances = np.array(np.broadcast_to(np.asarray(self.obsError, dtype=float)**2, (self.obsDim,)))
+    if self.EnKFtype.startswith('CTM') and (self.droneLoc is not None):
+      droneRow = self.getDroneObsRow()
+      if droneRow is not None:
+        variances[droneRow] = float(self.droneDenObsError)**2  # lower error at location of drone!
+    return variances
+  
+  def getSquareRootPostDist(self, observations):
+    '''
+    ETKF analysis, updates the mean and the anomalies in N x N
+    ensemble space, observations are not perturbed so cost
+    scales with the ensemble size and not with obsDim
+    '''
+    N = self.sampleSize
+    Ahat = self.predictObservations()
+    AhatMean = np.mean(Ahat, axis=1)
+    AhatPrime = Ahat - AhatMean[:, np.newaxis]
+    C = np.transpose(AhatPrime) / self.getObsErrorVariances()  # Y'^T R^-1, R is diagonal
+    eigVal, eigVec = np.linalg.eigh((N - 1) * np.identity(N) + np.dot(C, AhatPrime))
+    Ptilde = np.dot(eigVec / eigVal, np.transpose(eigVec))  # analysis covariance in ensemble space
+    wMean = np.dot(Ptilde, np.dot(C, np.asarray(observations, dtype=float) - AhatMean))
+    W = np.dot(eigVec * np.sqrt((N - 1) / eigVal), np.transpose(eigVec))  # symmetric square root of (N-1) Ptilde
+    self.A = self.mean[:, np.newaxis] + np.dot(self.Aprime, wMean[:, np.newaxis] + W)
+    self.mean = np.mean(self.A, axis=1)
+    self.Abar = np.tile(self.mean[:, np.newaxis], (1, N))
+    self.Aprime = self.A - self.Abar
+    self.P = np.dot(self.Aprime, np.transpose(self.Aprime))
+    return self.mean, self.P
+  
   def getPriorDist(self):
     '''
     generate prior t+1|t
@@ -175,7 +376,7 @@ class EnKF:
   
   def addModelNoise(self, forecasts):
     '''
-    forecasts is a list of lists, where sublists
+    forecasts is a (members x cells) array, where rows
     are model updates for different ensemble
     members
     --------
@@ -185,8 +386,7 @@ class EnKF:
     --------
     returns noisy forecasts
     '''
-    self.A = np.array(forecasts)
-    self.A = np.transpose(self.A)
+    self.A = np.transpose(np.asarray(forecasts, dtype=float))  # (cells x members) view, no copy
     self.genModErrorMatrix()
     self.A = self.A + self.modelErrorMatrix
     self.storePropEnsembles.append(self.A)
@@ -202,11 +402,7 @@ class EnKF:
     adjusts observation noise accordingly
     in genObsErrorMatrix
     '''
-    tempList = list()
-    for sample in range(self.sampleSize):
-      tempList.append(observations)
-    self.D = np.array(tempList)
-    self.D = np.transpose(self.D)
+    self.D = np.repeat(np.asarray(observations, dtype=float)[:, np.newaxis], self.sampleSize, axis=1)
     self.genObsErrorMatrix()
     self.D = self.D + self.obsErrorMatrix
     self.storeD.append(self.D)
@@ -230,11 +426,77 @@ class EnKF:
     '''
     self.createLocToCell()
     self.addModelNoise(forecasts)
-    self.addObsNoise(observations)
-    self.getObsCov()
-    self.getPriorDist()
-    self.getKalmanGain()
-    self.getPostDist()
+    if self.isSquareRoot():
+      self.getPriorDist()
+      if self.adaptiveSize is not None:
+        self.getInnovationRatio(observations)
+      self.getSquareRootPostDist(observations)
+    else:
+      self.addObsNoise(observations)
+      self.getObsCov()
+      self.getPriorDist()
+      if self.adaptiveSize is not None:
+        self.getInnovationRatio(observations)
+      self.getKalmanGain()
+      self.getPostDist()
+    if self.adaptiveSize is not None:
+      self.adaptEnsembleSize()
+    return self.getUpdatedEnsembles()
+  
+  def getWindowPostDist(self, window):
+    '''
+    one analysis over the stacked window (ensemble smoother), the
+    states of all steps are updated jointly with all observations
+    the specified diagonal R is used since a sampled R of the stacked
+    observations would be rank deficient, the gain is computed in
+    N x N ensemble space so cost does not grow with the window
+    '''
+    N = self.sampleSize
+    Z = np.concatenate(window.states, axis=0)
+    Y = np.concatenate(window.predicted, axis=0)
+    observations = np.concatenate(window.observations)
+    variances = np.concatenate(window.obsVariances)
+    Zmean = np.mean(Z, axis=1)
+    Zprime = Z - Zmean[:, np.newaxis]
+    Ymean = np.mean(Y, axis=1)
+    Yprime = Y - Ymean[:, np.newaxis]
+    C = np.transpose(Yprime) / variances  # Y'^T R^-1
+    G = (N - 1) * np.identity(N) + np.dot(C, Yprime)
+    if self.isSquareRoot():
+      eigVal, eigVec = np.linalg.eigh(G)
+      Ptilde = np.dot(eigVec / eigVal, np.transpose(eigVec))
+      wMean = np.dot(Ptilde, np.dot(C, observations - Ymean))
+      W = np.dot(eigVec * np.sqrt((N - 1) / eigVal), np.transpose(eigVec))
+      Z = Zmean[:, np.newaxis] + np.dot(Zprime, wMean[:, np.newaxis] + W)
+    else:
+      D = observations[:, np.newaxis] + self.noise.normal(loc=0.0, scale=np.sqrt(variances)[:, np.newaxis], size=(len(observations), N))
+      innovations = D - Y
+      SinvInnovations = innovations / variances[:, np.newaxis] - np.dot(np.transpose(C), np.linalg.solve(G, np.dot(C, innovations)))  # Woodbury, (Y'Y'^T/(N-1) + R)^-1
+      Z = Z + np.dot(Zprime, np.dot(np.transpose(Yprime), SinvInnovations)) / (N - 1)
+    blocks = np.split(Z, len(window.states), axis=0)
+    self.storeSmoothed.append([np.mean(block, axis=1) for block in blocks])
+    self.A = blocks[-1]
+    return None
+  
+  def windowStep(self, forecasts, observations, window, flush=False):
+    '''
+    windowed version of EnKFStep, the noisy forecasts and the
+    observations of this step are added to window and every
+    window.length steps (or when flush) one analysis is run over
+    the whole window, in between the ensembles are only propagated
+    returns the ensembles of the current step
+    '''
+    if self.nonLinearObs is True:
+      raise Exception('... windowed assimilation needs linear observations ...')
+    self.createLocToCell()
+    self.addModelNoise(forecasts)
+    window.add(self.A, self.applyH(self.A), observations, self.getObsErrorVariances())
+    self.windowAnalysed = False
+    if window.isFull() or flush:
+      self.getWindowPostDist(window)
+      window.clear()
+      self.windowAnalysed = True
+    self.getPriorDist()  # mean and P of the current step
     return self.getUpdatedEnsembles()
 
 
@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+"""
+multi corridor batching, several corridors with the same
+structure (own demand, link parameters, filters and UAV) are
+stacked on a leading batch dimension so propagation, the EnKF
+analysis and path planning each run as one vectorized call across
+corridors
+
+@author: cesny
+"""
+import numpy as np
+from ensembleCTM import EnsembleCTM
+from observationOperator import ObsOperator
+from utils import CTMcreateInitialEnsemble, VmaxCreateInitialEnsemble, VmaxMemberParameters
+
+
+def batchedPosteriorCov(P, cells, obsVariances):
+  '''
+  closed form Kalman update of a stack of covariances P (batch x
+  n x n) for observations of cells with independent errors of
+  variances obsVariances (batch x observations), batched version
+  of findPath.expectedPosteriorCov
+  '''
+  PHt = P[..., :, cells]
+  S = PHt[..., cells, :] + obsVariances[..., :, np.newaxis] * np.identity(len(cells))
+  return P - np.matmul(PHt, np.linalg.solve(S, np.swapaxes(PHt, -1, -2)))
+
+
+class BatchDriver:
+  '''
+  state is an array (corridors x members x cells) of densities,
+  every corridor has its own network (demand and link parameters),
+  CTM EnKF, optional Vmax EnKF and drone, the members of all
+  corridors are propagated by one EnsembleCTM with per row link
+  parameters (the vmax members on the incident links when Vmax
+  filters are given, as perMemberVmax in main.py), the analysis of
+  the stochastic and ETKF filters is batched over corridors with
+  each filter's own noise stream, so it matches the corridor's
+  EnKFStep, filters that cannot be batched (windows, adaptive
+  sizing, nonlinear or matrix H, mixed types) run their own
+  EnKFStep (windowStep with windows) one corridor at a time
+  '''
+  def __init__(self, trafficNets, filters, Vfilters=None, windows=None, excludeLinks=(9,), incidentLinks=(2, 7)):
+    self.trafficNets = list(trafficNets)
+    self.filters = list(filters)
+    self.Vfilters = None if Vfilters is None else list(Vfilters)
+    self.windows = windows  # AssimilationWindow per corridor, None assimilates every step
+    self.numCorridors = len(self.trafficNets)
+    self.incidentLinks = incidentLinks  # links of the vmax states, in the order of Network.updateVmaxCritDen
+    self.geometry = self.trafficNets[0].getGeometry()
+    self.stateDim = self.geometry.numCells
+    self.sampleSize = self.filters[0].sampleSize
+    for EnKFinstance in self.filters + (self.Vfilters or list()):
+      if (EnKFinstance.sampleSize != self.sampleSize) or (EnKFinstance.adaptiveSize is not None):
+        raise Exception('... filters in a batch need the same fixed ensemble size ...')
+    self._checkStructure()
+    for EnKFinstance in self.filters:
+      EnKFinstance.createLocToCell()
+    self.obsCells = self.getObsCells(self.filters[0])
+    for EnKFinstance in self.filters[1:]:
+      if not np.array_equal(self.getObsCells(EnKFinstance), self.obsCells):
+        raise Exception('... filters in a batch must observe the same cells ...')
+    self.obsRow = dict((int(cell), row) for row, cell in enumerate(self.obsCells))  # cell: observation row
+    self.engine = EnsembleCTM(self.trafficNets[0], excludeLinks)
+    self.engine.setRowNetworks(self.trafficNets, self.sampleSize)
+    self.droneCells = np.array([self.geometry.locToCellMap[EnKFinstance.droneLoc] for EnKFinstance in self.filters], dtype=int)
+    self.ensembles = None
+    self.VmaxEnsembles = None  # (corridors x members x incident links) when Vmax filters are given
+
+  def _checkStructure(self):
+    '''
+    the engine keeps one jam density, length and backward wave
+    speed per link and one set of node proportions and priorities,
+    corridors may differ only in demand, free flow speed and capacity
+    '''
+    first = self.trafficNets[0]
+    for trafficNet in self.trafficNets[1:]:
+      geometry = trafficNet.getGeometry()
+      if (geometry.numCells != self.stateDim) or (list(geometry.linkIDs) != list(self.geometry.linkIDs)):
+        raise Exception('... corridors in a batch must have the same structure ...')
+      for linkID in first.linkDict:
+        for key in ('jamDen', 'length', 'bws'):
+          if trafficNet.linkDict[linkID].params[key] != first.linkDict[linkID].params[key]:
+            raise Exception('... corridors in a batch differ in ' + key + ' of link ' + str(linkID) + ' ...')
+      for nodeID in first.nodeDict:
+        node = first.nodeDict[nodeID]
+        if (node.model == 'DivergeNode') and (trafficNet.nodeDict[nodeID].proportions != node.proportions):
+          raise Exception('... corridors in a batch differ in the proportions of node ' + str(nodeID) + ' ...')
+        if (node.model == 'MergeNode') and (trafficNet.nodeDict[nodeID].getPriorities() != node.getPriorities()):
+          raise Exception('... corridors in a batch differ in the priorities of node ' + str(nodeID) + ' ...')
+    return None
+
+  def getObsCells(self, EnKFinstance):
+    '''
+    observed cells of a filter, all cells for a matrix H
+    '''
+    if isinstance(EnKFinstance.H, ObsOperator):
+      return np.asarray(EnKFinstance.H.cells, dtype=int)
+    return np.arange(self.stateDim)
+
+  def setDroneLocations(self, locations):
+    '''
+    locations is a list of (linkID, cell) tuples, one per corridor
+    '''
+    self.droneCells = np.array([self.geometry.locToCellMap[location] for location in locations], dtype=int)
+    for EnKFinstance, location in zip(self.filters + (self.Vfilters or list()), 2 * list(locations)):
+      EnKFinstance.droneLoc = location
+    return None
+
+  def getDroneLocations(self):
+    return [self.geometry.cellToLocMap[int(cell)] for cell in self.droneCells]
+
+  def createInitialEnsembles(self, modSTDV, bestguess=20, rngs=None, VmodSTDV=None):
+    '''
+    initial ensembles around a best guess, as CTMcreateInitialEnsemble,
+    one rng per corridor, VmodSTDV also creates the vmax ensembles
+    '''
+    rngs = [None] * self.numCorridors if rngs is None else rngs
+    self.ensembles = np.stack([CTMcreateInitialEnsemble(self.stateDim, self.sampleSize, modSTDV, bestguess, rng) for rng in rngs])
+    if VmodSTDV is not None:
+      self.VmaxEnsembles = np.stack([VmaxCreateInitialEnsemble(len(self.incidentLinks), self.sampleSize, VmodSTDV, rng=rng) for rng in rngs])
+    return self.ensembles
+
+  def getRowParameters(self):
+    '''
+    dict linkID: (corridors * members x 3) array of ffs, critical
+    density and capacity, the rows of a corridor take the parameters
+    of its own links, or its vmax members on the incident links
+    '''
+    memberParams = dict()
+    for linkID in self.engine.linkSlices:
+      rows = list()
+      for corridor, trafficNet in enumerate(self.trafficNets):
+        params = trafficNet.linkDict[linkID].params
+        rows.append(np.tile([params['ffs'], params['critDen'], params['qcap']], (self.sampleSize, 1)))
+      memberParams[linkID] = np.concatenate(rows)
+    if self.VmaxEnsembles is not None:
+      for corridor in range(self.numCorridors):
+        rows = slice(corridor * self.sampleSize, (corridor + 1) * self.sampleSize)
+        VmaxParams = VmaxMemberParameters(self.VmaxEnsembles[corridor], self.incidentLinks)
+        for linkID in VmaxParams:
+          memberParams[linkID][rows] = VmaxParams[linkID]
+    return memberParams
+
+  def propagate(self, time, ensembles=None):
+    '''
+    one CTM step of every member of every corridor in a single
+    EnsembleCTM call, returns (corridors x members x cells)
+    '''
+    if ensembles is None:
+      ensembles = self.ensembles
+    shape = ensembles.shape
+    self.engine.setMemberParameters(self.getRowParameters())
+    return self.engine.propagate(time, ensembles.reshape(shape[0] * shape[1], shape[2])).reshape(shape)
+
+  def getObsErrorVariances(self):
+    '''
+    (corridors x observations) diagonal of R of every filter, lower
+    error at the drone cell of each corridor
+    '''
+    return np.stack([EnKFinstance.getObsErrorVariances() for EnKFinstance in self.filters])
+
+  def canBatchAnalysis(self):
+    '''
+    True if the analysis of all filters runs as one batched update
+    '''
+    if self.windows is not None:
+      return False
+    squareRoot = self.filters[0].isSquareRoot()
+    for EnKFinstance in self.filters:
+      if (EnKFinstance.adaptiveSize is not None) or (EnKFinstance.nonLinearObs is not False) or (EnKFinstance.sampleSize != self.sampleSize):
+        return False
+      if (not isinstance(EnKFinstance.H, ObsOperator)) or (EnKFinstance.isSquareRoot() != squareRoot):
+        return False
+    return True
+
+  def batchedAnalysis(self, forecasts, observations):
+    '''
+    EnKFStep of every filter as one stack of (corridors x ...)
+    arrays, the noise of each corridor is drawn from its filter in
+    the order of EnKFStep, the filters keep A, mean, P and the other
+    attributes of the step so getMean and getP stay valid
+    '''
+    N = self.sampleSize
+    obsCells = self.obsCells
+    observations = np.asarray(observations, dtype=float)
+    modelNoise = list()
+    obsNoise = list()
+    for EnKFinstance in self.filters:
+      EnKFinstance.createLocToCell()
+      EnKFinstance.genModErrorMatrix()
+      modelNoise.append(EnKFinstance.modelErrorMatrix)
+      if not EnKFinstance.isSquareRoot():
+        EnKFinstance.genObsErrorMatrix()
+        obsNoise.append(EnKFinstance.obsErrorMatrix)
+    A = np.swapaxes(np.asarray(forecasts, dtype=float), 1, 2) + np.stack(modelNoise)  # (corridors x cells x members)
+    mean = np.mean(A, axis=2)
+    Aprime = A - mean[:, :, np.newaxis]
+    if self.filters[0].isSquareRoot():  # ETKF, as getSquareRootPostDist
+      Ahat = A[:, obsCells, :]
+      AhatMean = np.mean(Ahat, axis=2)
+      AhatPrime = Ahat - AhatMean[:, :, np.newaxis]
+      C = np.swapaxes(AhatPrime, 1, 2) / self.getObsErrorVariances()[:, np.newaxis, :]
+      eigVal, eigVec = np.linalg.eigh((N - 1) * np.identity(N) + np.matmul(C, AhatPrime))
+      Ptilde = np.matmul(eigVec / eigVal[:, np.newaxis, :], np.swapaxes(eigVec, 1, 2))
+      wMean = np.matmul(Ptilde, np.matmul(C, (observations - AhatMean)[:, :, np.newaxis]))
+      W = np.matmul(eigVec * np.sqrt((N - 1) / eigVal)[:, np.newaxis, :], np.swapaxes(eigVec, 1, 2))
+      posterior = mean[:, :, np.newaxis] + np.matmul(Aprime, wMean + W)
+      postMean = np.mean(posterior, axis=2)
+      postAprime = posterior - postMean[:, :, np.newaxis]
+      P = np.matmul(postAprime, np.swapaxes(postAprime, 1, 2))
+      for corridor, EnKFinstance in enumerate(self.filters):
+        EnKFinstance.storePropEnsembles.append(A[corridor])
+        EnKFinstance.A = posterior[corridor]
+        EnKFinstance.mean = postMean[corridor]
+        EnKFinstance.Abar = np.tile(postMean[corridor][:, np.newaxis], (1, N))
+        EnKFinstance.Aprime = postAprime[corridor]
+        EnKFinstance.P = P[corridor]
+    else:  # stochastic EnKF, as getKalmanGain and getPostDist
+      E = np.stack(obsNoise)  # (corridors x observations x members)
+      D = observations[:, :, np.newaxis] + E
+      R = np.matmul(E, np.swapaxes(E, 1, 2))
+      P = np.matmul(Aprime, np.swapaxes(Aprime, 1, 2))
+      PHt = P[:, :, obsCells]
+      K = np.swapaxes(np.linalg.solve(PHt[:, obsCells, :] + R, np.swapaxes(PHt, 1, 2)), 1, 2)
+      posterior = A + np.matmul(K, D - A[:, obsCells, :])
+      postMean = np.mean(posterior, axis=2)
+      P = P - np.matmul(K, P[:, obsCells, :])
+      for corridor, EnKFinstance in enumerate(self.filters):
+        EnKFinstance.storePropEnsembles.append(A[corridor])
+        EnKFinstance.storeD.append(D[corridor])
+        EnKFinstance.D = D[corridor]
+        EnKFinstance.R = R[corridor]
+        EnKFinstance.K = K[corridor]
+        EnKFinstance.Aprime = Aprime[corridor]  # prior anomalies, as after getPostDist
+        EnKFinstance.A = posterior[corridor]
+        EnKFinstance.mean = postMean[corridor]
+        EnKFinstance.Abar = np.tile(postMean[corridor][:, np.newaxis], (1, N))
+        EnKFinstance.P = P[corridor]
+    self.ensembles = np.ascontiguousarray(np.swapaxes(posterior, 1, 2))
+    return self.ensembles
+
+  def analysis(self, forecasts, observations, flush=False):
+    '''
+    EnKF analysis of every corridor with its own filter, forecasts
+    is (corridors x members x cells), observations is (corridors x
+    observations), returns the updated ensembles, batched when
+    canBatchAnalysis, otherwise one filter at a time
+    '''
+    if self.canBatchAnalysis():
+      return self.batchedAnalysis(forecasts, observations)
+    updated = list()
+    for corridor, EnKFinstance in enumerate(self.filters):
+      if self.windows is None:
+        updated.append(EnKFinstance.EnKFStep(forecasts[corridor], observations[corridor]))
+      else:
+        updated.append(EnKFinstance.windowStep(forecasts[corridor], observations[corridor], self.windows[corridor], flush))
+    self.ensembles = np.stack(updated)
+    return self.ensembles
+
+  def step(self, time, observations, flush=False):
+    '''
+    propagation and analysis of every corridor
+    '''
+    return self.analysis(self.propagate(time), observations, flush)
+
+  def VmaxStep(self, corridors, observations, obsError, incidentCells=None):
+    '''
+    vmax analysis of the given corridors, as in main.py: with
+    incidentCells the observations are speeds at the incident links
+    (nonlinear, through m with the CTM means at incidentCells),
+    otherwise they are direct vmax observations at the incident link
+    of the corridor's drone, observations is one list per corridor
+    '''
+    for corridor, corridorObs in zip(corridors, observations):
+      EnKFV = self.Vfilters[corridor]
+      EnKFV.obsError = obsError
+      if incidentCells is not None:
+        EnKFV.nonLinearObs = True
+        EnKFV.H = None
+        EnKFV.assimDen = [self.filters[corridor].mean[cell] for cell in incidentCells]
+        EnKFV.obsDim = len(self.incidentLinks)
+      else:
+        EnKFV.nonLinearObs = False
+        EnKFV.H = ObsOperator([self.incidentLinks.index(EnKFV.droneLoc[0])], len(self.incidentLinks))
+        EnKFV.obsDim = 1
+      self.VmaxEnsembles[corridor] = EnKFV.EnKFStep(self.VmaxEnsembles[corridor], corridorObs)
+    return self.VmaxEnsembles
+
+  def getTerminalValues(self, P, obsVariances):
+    '''
+    (corridors x cells) trace reduction from a drone observation
+    at each cell, as findPath.getTerminalValues
+    '''
+    noDrone = np.stack([np.broadcast_to(np.asarray(EnKFinstance.obsError, dtype=float)**2, (len(self.obsCells),)) for EnKFinstance in self.filters])
+    droneVariances = np.array([float(EnKFinstance.droneDenObsError)**2 for EnKFinstance in self.filters])
+    baseTrace = np.trace(batchedPosteriorCov(P, self.obsCells, noDrone), axis1=1, axis2=2)
+    values = np.zeros((self.numCorridors, self.stateDim))
+    for cell in range(self.stateDim):
+      if cell in self.obsRow:
+        variances = noDrone.copy()
+        variances[:, self.obsRow[cell]] = droneVariances
+        values[:, cell] = baseTrace - np.trace(batchedPosteriorCov(P, self.obsCells, variances), axis1=1, axis2=2)
+    return values
+
+  def planExpected(self, time, timeHorizon=None, weight=0.0, VmaxP=None, VmaxObsError=10.0):
+    '''
+    closed form path scoring of findPath (scoring 'expected') for
+    all corridors at once, moves every drone one cell and returns
+    the chosen directions, the vmax term uses the Vmax filters
+    (or VmaxP, corridors x 2 x 2), weight is the vmax weight as in
+    findPath, VmaxObsError is the error of a direct vmax observation
+    '''
+    n = self.stateDim
+    lastStep = len(self.trafficNets[0].totalTimesteps) - 1
+    P0 = np.stack([EnKFinstance.getP() for EnKFinstance in self.filters])
+    Q = np.stack([(EnKFinstance.modelError**2) * np.identity(n) for EnKFinstance in self.filters])
+    noDrone = np.stack([np.broadcast_to(np.asarray(EnKFinstance.obsError, dtype=float)**2, (len(self.obsCells),)) for EnKFinstance in self.filters])
+    droneVariances = np.array([float(EnKFinstance.droneDenObsError)**2 for EnKFinstance in self.filters])
+    steps = {'left': self.droneCells + 1, 'right': n - self.droneCells}  # path length per corridor
+    remaining = dict()
+    for direction in steps:
+      steps[direction] = np.minimum(steps[direction], lastStep - time + 1)
+      full = steps[direction].copy()
+      if timeHorizon is not None:
+        steps[direction] = np.minimum(steps[direction], timeHorizon)
+      remaining[direction] = full - steps[direction]
+    covariances = {'left': P0.copy(), 'right': P0.copy()}
+    terminalCost = {'left': np.zeros(self.numCorridors), 'right': np.zeros(self.numCorridors)}
+    if timeHorizon is not None:
+      values = self.getTerminalValues(P0, self.getObsErrorVariances())
+      cumulative = np.concatenate((np.zeros((self.numCorridors, 1)), np.cumsum(values, axis=1)), axis=1)
+      corridors = np.arange(self.numCorridors)
+      leftEnd = self.droneCells - steps['left'] + 1  # cells below leftEnd are remaining on the left
+      terminalCost['left'] = cumulative[corridors, leftEnd] - cumulative[corridors, leftEnd - remaining['left']]
+      rightStart = self.droneCells + steps['right']
+      terminalCost['right'] = cumulative[corridors, rightStart + remaining['right']] - cumulative[corridors, rightStart]
+    ensembles = self.ensembles
+    for lr in range(int(max(steps['left'].max(), steps['right'].max()))):
+      propagated = self.propagate(time + lr, ensembles)
+      anomalies = ensembles - np.mean(ensembles, axis=1)[:, np.newaxis, :]
+      propagatedAnomalies = propagated - np.mean(propagated, axis=1)[:, np.newaxis, :]
+      L = np.swapaxes(np.matmul(np.linalg.pinv(anomalies), propagatedAnomalies), 1, 2)  # least squares fit per corridor
+      ensembles = propagated
+      for direction, move in (('left', -1), ('right', 1)):
+        active = lr < steps[direction]
+        if not np.any(active):
+          continue
+        P = np.matmul(L[active], np.matmul(covariances[direction][active], np.swapaxes(L[active], 1, 2))) + Q[active]
+        variances = noDrone[active].copy()
+        pathCells = self.droneCells[active] + move * lr
+        for row, (cell, droneVariance) in enumerate(zip(pathCells, droneVariances[active])):
+          if int(cell) in self.obsRow:
+            variances[row, self.obsRow[int(cell)]] = droneVariance
+        covariances[direction][active] = batchedPosteriorCov(P, self.obsCells, variances)
+    if (VmaxP is None) and (self.Vfilters is not None):
+      VmaxP = np.stack([EnKFV.getP() for EnKFV in self.Vfilters])
+    objective = dict()
+    for direction, vmaxCell in (('left', 0), ('right', 1)):
+      objective[direction] = (1 - weight) * (np.trace(covariances[direction], axis1=1, axis2=2) - terminalCost[direction]) / float(n)
+      if VmaxP is not None:
+        VmaxModelError = np.array([EnKFV.modelError for EnKFV in self.Vfilters]) if self.Vfilters is not None else 5.0
+        PV = np.asarray(VmaxP) + (np.asarray(VmaxModelError, dtype=float)**2)[..., np.newaxis, np.newaxis] * np.identity(VmaxP.shape[1])
+        PV = batchedPosteriorCov(PV, np.array([vmaxCell]), np.full((self.numCorridors, 1), VmaxObsError**2))
+        objective[direction] = objective[direction] + weight * np.trace(PV, axis1=1, axis2=2) / float(VmaxP.shape[1])
+    self.objective = objective
+    goLeft = objective['left'] <= objective['right']  # ties go left as min() over the dict in findPath
+    self.droneCells = np.where(goLeft, np.maximum(self.droneCells - 1, 0), np.minimum(self.droneCells + 1, n - 1))
+    self.setDroneLocations(self.getDroneLocations())
+    return np.where(goLeft, 'left', 'right')
+
+
+if __name__ == '__main__':
+  from network import Network
+  from EnKF import EnKF
+  from utils import readData, m
+  from randomStreams import spawnGenerators
+  simTime = 4490
+  simTimeStep = 10
+  linkfile = 'VISSIMnetwork/links.txt'
+  nodefile = 'VISSIMnetwork/nodes.txt'
+  demandfiles = ['VISSIMnetwork/demand6600.txt'] * 4  # one demand file per corridor
+  datafiles = ['data/model_001_Link Segment Results-6600.att'] * 4
+  trueVf = 20.0
+  trafficNets = [Network(simTime, simTimeStep, nodefile, linkfile, demandfile) for demandfile in demandfiles]
+  rngs = spawnGenerators(2018, 3 * len(trafficNets))  # CTM filter, Vmax filter and initial ensembles of every corridor
+  filters = [EnKF(obsError=10, modelError=5, sampleSize=100, stateDim=40, obsDim=40, H=ObsOperator(range(40), 40), EnKFtype='CTM',
+                  droneLoc=(5, 0), trafficNet=trafficNet, droneDenObsError=2, rng=rngs[3 * corridor]) for corridor, trafficNet in enumerate(trafficNets)]
+  Vfilters = [EnKF(obsError=5, modelError=5, sampleSize=100, stateDim=2, obsDim=2, m=m, assimilatedDensities=[0, 0], EnKFtype='Vmax', nonLinearObs=True,
+                   droneLoc=(5, 0), trafficNet=trafficNet, rng=rngs[3 * corridor + 1]) for corridor, trafficNet in enumerate(trafficNets)]
+  batch = BatchDriver(trafficNets, filters, Vfilters)
+  batch.createInitialEnsembles(5, rngs=rngs[2::3], VmodSTDV=5)
+  denData = list()
+  spData = list()
+  for datafile, trafficNet in zip(datafiles, trafficNets):
+    corridorDen, corridorSp = readData(datafile, trafficNet.getGeometry())
+    denData.append(corridorDen)
+    spData.append(corridorSp)
+  for time in trafficNets[0].totalTimesteps:
+    batch.step(time, np.array([data[time] for data in denData]))
+    if time % 30 == 0:  # velocity observations at the incident links
+      batch.VmaxStep(range(batch.numCorridors), [data[time] for data in spData], 5, incidentCells=(6, 32))
+    droneAtIncident = [corridor for corridor, location in enumerate(batch.getDroneLocations()) if location[0] in batch.incidentLinks]
+    batch.VmaxStep(droneAtIncident, [[trueVf]] * len(droneAtIncident), 10)  # the drone observes vmax directly
+    batch.planExpected(time, timeHorizon=10, weight=1.0)
+    print('time: ', time, 'drone cells: ', batch.droneCells)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+corridor geometry index, maps between km from the start of
+the corridor, global cell index and (linkID, cell) locations
+using cumulative offsets and vectorized bisection
+
+@author: cesny
+"""
+import numpy as np
+
+
+class CorridorGeometry:
+  '''
+  built from the link lengths and numCells of the links in
+  linkDict order, links in excludeLinks (ramps) are not part
+  of the corridor, cells of a link are of equal length
+  (link length / numCells)
+  '''
+  def __init__(self, trafficNet, excludeLinks=(9,)):
+    linkIDs = list()
+    linkLengths = list()
+    linkNumCells = list()
+    for linkID in trafficNet.linkDict:
+      if linkID not in excludeLinks:
+        link = trafficNet.linkDict[linkID]
+        linkIDs.append(linkID)
+        linkLengths.append(link.params['length'])
+        linkNumCells.append(link.numCells)
+    self.linkIDs = np.array(linkIDs, dtype=int)
+    self.linkPosition = dict()  # linkID: position in the link arrays
+    for position, linkID in enumerate(linkIDs):
+      self.linkPosition[linkID] = position
+    self.linkLengths = np.array(linkLengths, dtype=float)  # km
+    self.linkNumCells = np.array(linkNumCells, dtype=int)
+    self.linkOffsets = np.concatenate(([0.0], np.cumsum(self.linkLengths)))  # km at the start of every link, plus the corridor end
+    self.linkFirstCell = np.concatenate(([0], np.cumsum(self.linkNumCells)))  # global index of the first cell of every link
+    self.numCells = int(self.linkFirstCell[-1])
+    self.cellLink = np.repeat(self.linkIDs, self.linkNumCells)  # linkID of every global cell
+    self.cellInLink = np.arange(self.numCells) - np.repeat(self.linkFirstCell[:-1], self.linkNumCells)
+    self.cellLength = np.repeat(self.linkLengths / self.linkNumCells, self.linkNumCells)
+    self.cellEdges = np.concatenate(([0.0], np.cumsum(self.cellLength)))  # km at cell boundaries
+    self.locToCellMap = dict()  # (linkID, cell): global cell, for code that works with single locations
+    self.cellToLocMap = dict()
+    for cell in range(self.numCells):
+      location = (int(self.cellLink[cell]), int(self.cellInLink[cell]))
+      self.locToCellMap[location] = cell
+      self.cellToLocMap[cell] = location
+
+  def cellToKm(self, cells):
+    '''
+    km at the center of the given global cells
+    '''
+    cells = np.asarray(cells, dtype=int)
+    return (self.cellEdges[cells] + self.cellEdges[cells + 1]) / 2.0
+
+  def kmToCell(self, km):
+    '''
+    global cell containing each position in km, positions
+    outside the corridor map to the first or last cell
+    '''
+    cells = np.searchsorted(self.cellEdges, np.asarray(km, dtype=float), side='right') - 1
+    return np.clip(cells, 0, self.numCells - 1)
+
+  def locToCell(self, linkIDs, cellsInLink):
+    '''
+    global cells of (linkID, cell) locations given as two sequences
+    '''
+    positions = np.array([self.linkPosition[linkID] for linkID in np.atleast_1d(linkIDs)], dtype=int)
+    return self.linkFirstCell[positions] + np.asarray(cellsInLink, dtype=int)
+
+  def cellToLoc(self, cells):
+    '''
+    (linkIDs, cellsInLink) arrays of the given global cells
+    '''
+    cells = np.asarray(cells, dtype=int)
+    return self.cellLink[cells], self.cellInLink[cells]
+
+  def linkOffsetToCell(self, linkIDs, offsetsKm):
+    '''
+    global cells of positions given as km from the start of
+    their link (e.g., VISSIM segment offsets)
+    '''
+    positions = np.array([self.linkPosition[linkID] for linkID in np.atleast_1d(linkIDs)], dtype=int)
+    cells = self.kmToCell(self.linkOffsets[positions] + np.asarray(offsetsKm, dtype=float))
+    return np.clip(cells, self.linkFirstCell[positions], self.linkFirstCell[positions + 1] - 1)  # keep rounding at link ends inside the link
@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+"""
+batched cell transmission model, propagates every ensemble
+member through the network in one pass of array operations
+allows per member link parameters (e.g., vmax ensembles)
+LTM links are stepped from their reporting cells as in
+LTM.setCellDensities followed by one loadNetworkStep
+
+@author: cesny
+"""
+import math
+import numpy as np
+from nodeKernels import NodeKernels
+
+
+class EnsembleCTM:
+  '''
+  vectorized version of Network.loadNetworkStep for CTM links,
+  the state is an array (members x cells) of vehicles over all
+  cells of all links in linkDict order, the reported cells
+  exclude the links in excludeLinks (ramps) which start each
+  step empty, as in setCTMVehicles, coarse cells (setCoarseCells)
+  are one state cell reported on its span fine cells, an LTM link
+  holds its reporting cells plus an inflow and an outflow column
+  that face the nodes, its counts are rebuilt from the cells every
+  step so it matches the reset path of forwardCTMPropagation,
+  setActiveSet skips the unchanged cell pairs of every member
+  '''
+  def __init__(self, trafficNet, excludeLinks=(9,)):
+    self.trafficNet = trafficNet
+    self.timeStep = trafficNet.timeStep
+    self.excludeLinks = excludeLinks
+    self.linkSlices = dict()  # linkID: slice of the link cells in the state
+    capacity = list()
+    maxVehicles = list()
+    delta = list()
+    length = list()
+    span = list()
+    self.cellPairs = dict()  # span: (upstream cells, downstream cells) of the intra link cell pairs
+    reportCells = list()  # state cell of every reported fine cell
+    self.ltmLinks = dict()  # linkID: (inflow column, outflow column, count maps) of the LTM links
+    index = 0
+    for linkID in trafficNet.linkDict:
+      link = trafficNet.linkDict[linkID]
+      if link.params['linkType'] == 'LTM':
+        self.linkSlices[linkID] = slice(index, index + link.numCells)
+        for c in range(link.numCells):
+          capacity.append(link.params['qcap'] / 3600.0)
+          maxVehicles.append(link.params['jamDen'] * link.cellLength)
+          delta.append(link.params['bws'] / link.params['ffs'])
+          length.append(link.densityLength)
+          span.append(1)
+          if linkID not in excludeLinks:
+            reportCells.append(index + c)
+        index += link.numCells
+        continue
+      if link.params['linkType'] != 'CTM':
+        raise Exception('... EnsembleCTM only supports CTM and LTM links, link ' + str(linkID) + ' is ' + link.params['linkType'] + ' ...')
+      numCells = len(link.cells)
+      self.linkSlices[linkID] = slice(index, index + numCells)
+      for c, cell in enumerate(link.cells):
+        capacity.append(cell.capacity)
+        maxVehicles.append(cell.maxVehicles)
+        delta.append(cell.delta)
+        length.append(cell.length)
+        span.append(link.span)
+        if c < numCells - 1:
+          pairs = self.cellPairs.setdefault(link.span, (list(), list()))
+          pairs[0].append(index + c)
+          pairs[1].append(index + c + 1)
+        if linkID not in excludeLinks:
+          reportCells += [index + c] * link.span
+      index += numCells
+    for linkID in self.linkSlices:  # node facing columns of the LTM links after the cells
+      link = trafficNet.linkDict[linkID]
+      if link.params['linkType'] != 'LTM':
+        continue
+      for column in range(2):
+        capacity.append(link.params['qcap'] / 3600.0)
+        maxVehicles.append(0.0)
+        delta.append(link.params['bws'] / link.params['ffs'])
+        length.append(link.densityLength)
+        span.append(1)
+      self.ltmLinks[linkID] = (index, index + 1, self._ltmMaps(link))
+      index += 2
+    self.numCells = index
+    self.capacity = np.array(capacity)  # veh/sec
+    self.maxVehicles = np.array(maxVehicles)
+    self.delta = np.array(delta)
+    self.length = np.array(length)
+    self.span = np.array(span, dtype=float)
+    for cellSpan in self.cellPairs:
+      upCells, downCells = self.cellPairs[cellSpan]
+      self.cellPairs[cellSpan] = (np.array(upCells, dtype=int), np.array(downCells, dtype=int))
+    self.coarse = bool(np.any(self.span > 1))
+    self.reportCells = np.array(reportCells, dtype=int)
+    self.reportLength = self.length[self.reportCells] / self.span[self.reportCells]  # fine cell length
+    self.memberCapacity = None  # (members x cells) overrides when per member parameters are set
+    self.memberDelta = None
+    self.rowNetworks = None  # networks whose demand is loaded on each block of rows, see setRowNetworks
+    linkEnds = list()  # first and last cells of the CTM links, they take node flows every step
+    for linkID in self.linkSlices:
+      if linkID not in self.ltmLinks:
+        linkEnds += [self.linkSlices[linkID].start, self.linkSlices[linkID].stop - 1]
+    self.linkEnds = np.array(linkEnds, dtype=int)
+    self.activeTolerance = None  # active set update is off unless setActiveSet is called
+    self._setupNodes()
+
+  def firstCell(self, linkID):
+    if linkID in self.ltmLinks:
+      return self.ltmLinks[linkID][0]
+    return self.linkSlices[linkID].start
+
+  def lastCell(self, linkID):
+    if linkID in self.ltmLinks:
+      return self.ltmLinks[linkID][1]
+    return self.linkSlices[linkID].stop - 1
+
+  def _ltmMaps(self, link):
+    '''
+    the LTM counts as linear maps of z = [cell vehicles, inflow,
+    outflow, 1] of a member, the history is rebuilt from the cells
+    as in LTM.setCellDensities and read as in LTM._countAt, returns
+    the sending and receiving rows before the step and the upstream
+    and downstream branches of the cell boundary counts after it
+    '''
+    numCells = link.numCells
+    length = link.params['length']
+    jamDen = link.params['jamDen']
+    forwardStep = link.params['ffs'] * link.params['timeStep'] / 3600.0
+    backwardStep = link.params['bws'] * link.params['timeStep'] / 3600.0
+    freeFlowSteps = length / forwardStep
+    backwardWaveSteps = length / backwardStep
+    lookback = int(math.ceil(max(freeFlowSteps, backwardWaveSteps))) + 1
+    
+    def vehiclesDownstream(x):
+      row = np.zeros(numCells + 3)
+      x = min(max(x, 0.0), length)
+      row[:numCells] = np.clip(np.arange(1, numCells + 1) - x / link.cellLength, 0.0, 1.0)
+      return row
+    
+    upstream = list()  # counts k steps before the step
+    downstream = list()
+    for k in range(lookback + 1):
+      upstream.append(vehiclesDownstream(k * forwardStep))
+      x = max(length - k * backwardStep, 0.0)
+      row = vehiclesDownstream(x)
+      row[-1] -= jamDen * (length - x)
+      downstream.append(row)
+    
+    def countAt(history, flow, stepsBack, oldest):
+      # stepsBack before the step time, -1 is the next step whose count adds flow (column of z)
+      stepsBack = min(max(stepsBack, -1.0), oldest)
+      if stepsBack < 0:
+        after = history[0].copy()
+        after[flow] += 1.0
+        return (1 + stepsBack) * history[0] - stepsBack * after
+      lower = int(math.floor(stepsBack))
+      if lower == stepsBack:
+        return history[lower]
+      fraction = stepsBack - lower
+      return (1 - fraction) * history[lower] + fraction * history[lower + 1]
+    
+    inflow = numCells
+    outflow = numCells + 1
+    sending = countAt(upstream, inflow, max(freeFlowSteps - 1, 0.0), lookback) - countAt(downstream, outflow, 0.0, lookback)
+    receiving = countAt(downstream, outflow, max(backwardWaveSteps - 1, 0.0), lookback) - countAt(upstream, inflow, 0.0, lookback)
+    receiving[-1] += jamDen * length
+    fromUpstream = list()
+    fromDownstream = list()
+    for boundary in range(numCells + 1):  # after the step the oldest count is lookback - 1 steps back
+      x = boundary * link.cellLength
+      fromUpstream.append(countAt(upstream, inflow, x / forwardStep - 1, lookback - 1))
+      row = countAt(downstream, outflow, (length - x) / backwardStep - 1, lookback - 1).copy()
+      row[-1] += jamDen * (length - x)
+      fromDownstream.append(row)
+    return sending, receiving, np.array(fromUpstream).T, np.array(fromDownstream).T
+
+  def _setupNodes(self):
+    '''
+    stores for every node the state indices of the cells
+    it connects, destinations, series, diverge and merge nodes
+    are grouped in NodeKernels
+    '''
+    self.origins = list()  # (origin node, first cell of outgoing link)
+    self.nodeKernels = NodeKernels()
+    for nodeID in self.trafficNet.nodeDict:
+      node = self.trafficNet.nodeDict[nodeID]
+      if node.model == 'Zone':
+        if node.subType == 'Origin':
+          for outLink in node.downstreamLinks:
+            self.origins.append((node, self.firstCell(outLink.ID)))
+        else:
+          for inLink in node.upstreamLinks:
+            self.nodeKernels.addDestination(self.lastCell(inLink.ID))
+      elif node.model == 'SeriesNode':
+        self.nodeKernels.addSeries(self.lastCell(node.rstar[0]), self.firstCell(node.fstar[0]))
+      elif node.model == 'DivergeNode':
+        inLink = node.rstar[0]
+        outCells = [self.firstCell(outLink) for outLink in node.fstar]
+        proportions = [node.proportions[inLink][outLink] for outLink in node.fstar]
+        self.nodeKernels.addDiverge(self.lastCell(inLink), outCells, proportions)
+      elif node.model == 'MergeNode':
+        inCells = [self.lastCell(inLink) for inLink in node.rstar]
+        self.nodeKernels.addMerge(inCells, self.firstCell(node.fstar[0]), node.getPriorities(), node.capacityShares())
+      else:
+        raise Exception('... node model ' + node.model + ' not supported by EnsembleCTM ...')
+    self.nodeKernels.finalize()
+    return None
+
+  def setActiveSet(self, tolerance=1e-6, recheckInterval=10):
+    '''
+    per member version of CTM.setActiveSet: a cell pair of a member
+    is recomputed only when one of its cells changed by more than
+    tolerance (veh) since the previous step given to the engine (so
+    analysis updates count as changes) or its parameters changed,
+    other pairs keep the member's previous transition flow and cells
+    next to them only keep their state, every recheckInterval time
+    steps all pairs are recomputed, tolerance None disables it
+    '''
+    if (tolerance is not None) and self.coarse:
+      raise Exception('... coarse cells and the active set update cannot be combined ...')
+    self.activeTolerance = tolerance
+    self.recheckInterval = recheckInterval
+    self._lastVehicles = None  # (members x cells) state given to the previous step
+    self._transitionFlows = None  # (members x cell pairs) last transition flow of every pair
+    self._changedParameters = None  # (members x cells) cells whose capacity or delta changed since the previous step
+    self._lastRecheck = None  # time step of the last full update, None forces one
+    return None
+
+  def _activeSetTransitions(self, time, vehicles, sending, receiving, change):
+    '''
+    adds the transition flows of the active set to change
+    '''
+    upCells, downCells = self.cellPairs[1]
+    if (self._lastRecheck is None) or (time - self._lastRecheck >= self.recheckInterval) or (time < self._lastRecheck) or (self._lastVehicles is None) or (self._lastVehicles.shape != vehicles.shape):
+      flows = np.minimum(sending[:, upCells], receiving[:, downCells])
+      pairs = None
+      self._lastRecheck = time
+    else:
+      changed = np.abs(vehicles - self._lastVehicles) > self.activeTolerance
+      changed[:, self.linkEnds] = True
+      if self._changedParameters is not None:
+        changed |= self._changedParameters
+      pairs = changed[:, upCells] | changed[:, downCells]
+      rows, columns = np.nonzero(pairs)
+      flows = self._transitionFlows
+      flows[rows, columns] = np.minimum(sending[rows, upCells[columns]], receiving[rows, downCells[columns]])
+    self._transitionFlows = flows
+    self._lastVehicles = vehicles.copy()
+    self._changedParameters = None
+    transitions = np.zeros_like(vehicles)
+    transitions[:, upCells] -= flows
+    transitions[:, downCells] += flows
+    if pairs is not None:  # cells next to recomputed pairs only
+      touched = np.zeros(vehicles.shape, dtype=bool)
+      touched[:, upCells] |= pairs
+      touched[:, downCells] |= pairs
+      transitions[~touched] = 0.0
+    change += transitions
+    return None
+
+  def acceptsMemberParameters(self, memberParams):
+    '''
+    False when memberParams changes the free flow speed of an LTM
+    link, its count maps are built for the link's own speed
+    '''
+    for linkID in memberParams:
+      if linkID in self.ltmLinks:
+        ffs = np.asarray(memberParams[linkID], dtype=float)[:, 0]
+        if np.any(ffs != self.trafficNet.linkDict[linkID].params['ffs']):
+          return False
+    return True
+
+  def setMemberParameters(self, memberParams):
+    '''
+    memberParams is a dict linkID: (members x 3) array of free flow
+    speed (km/hr), critical density (veh/km) and capacity (veh/hr)
+    as in Link.updateVmaxCritDen the backward wave speed is kept
+    so the cells use the capacity and delta = bws/ffs
+    None removes the per member parameters
+    '''
+    previous = (self.memberCapacity, self.memberDelta)
+    if memberParams is None:
+      self.memberCapacity = None
+      self.memberDelta = None
+      self._parametersChanged(previous)
+      return None
+    if not self.acceptsMemberParameters(memberParams):
+      raise Exception('... per member free flow speeds are not supported on LTM links ...')
+    numMembers = None
+    for linkID in memberParams:
+      if numMembers is None:
+        numMembers = len(memberParams[linkID])
+      elif len(memberParams[linkID]) != numMembers:
+        raise Exception('... member parameters have different ensemble sizes ...')
+    self.memberCapacity = np.tile(self.capacity, (numMembers, 1))
+    self.memberDelta = np.tile(self.delta, (numMembers, 1))
+    for linkID in memberParams:
+      params = np.asarray(memberParams[linkID], dtype=float)
+      cells = self.linkSlices[linkID]
+      bws = self.trafficNet.linkDict[linkID].params['bws']
+      if linkID in self.ltmLinks:  # only the capacity varies, on the cells and the node facing columns
+        cells = list(range(cells.start, cells.stop)) + list(self.ltmLinks[linkID][:2])
+      self.memberCapacity[:, cells] = params[:, 2][:, np.newaxis] / 3600.0
+      self.memberDelta[:, cells] = (bws / params[:, 0])[:, np.newaxis]
+    self._parametersChanged(previous)
+    return None
+
+  def _parametersChanged(self, previous):
+    '''
+    marks the cells whose capacity or delta differs from previous
+    (memberCapacity, memberDelta) for the active set update
+    '''
+    if self.activeTolerance is None:
+      return None
+    capacity, delta = previous
+    if capacity is None:
+      capacity, delta = self.capacity, self.delta
+    newCapacity, newDelta = self.capacity, self.delta
+    if self.memberCapacity is not None:
+      newCapacity, newDelta = self.memberCapacity, self.memberDelta
+    try:
+      changed = (capacity != newCapacity) | (delta != newDelta)
+    except ValueError:  # different ensemble sizes, update every cell next step
+      self._lastRecheck = None
+      return None
+    if changed.ndim != 2:  # no per member parameters before or after
+      return None
+    if self._changedParameters is not None and self._changedParameters.shape == changed.shape:
+      changed = changed | self._changedParameters
+    self._changedParameters = changed
+    return None
+
+  def setRowNetworks(self, trafficNets, rowsPerNetwork):
+    '''
+    stacks several networks with the same structure, the rows are
+    blocks of rowsPerNetwork members and block i takes its origin
+    demand from trafficNets[i] (e.g., one block per corridor)
+    None loads the demand of the network the engine was built from
+    '''
+    if trafficNets is None:
+      self.rowNetworks = None
+      return None
+    self.rowNetworks = list(trafficNets)
+    self.rowsPerNetwork = rowsPerNetwork
+    return None
+  
+  def originDemand(self, node, time):
+    '''
+    vehicles entering from the origin node in one time step, an
+    array over rows when row networks are set
+    '''
+    if self.rowNetworks is None:
+      return node.demandRates[time] * (1.0/3600) * self.timeStep
+    rates = np.array([trafficNet.nodeDict[node.ID].demandRates[time] for trafficNet in self.rowNetworks])
+    return np.repeat(rates, self.rowsPerNetwork) * (1.0/3600) * self.timeStep
+  
+  def step(self, time, vehicles):
+    '''
+    moves the vehicles (members x cells) one time step, all flows
+    are computed from the state at time as in loadNetworkStep,
+    vehicles is updated in place
+    '''
+    dt = self.timeStep
+    capacity = self.capacity
+    delta = self.delta
+    if self.memberCapacity is not None:
+      if self.memberCapacity.shape[0] != vehicles.shape[0]:
+        raise Exception('... member parameters do not match the number of ensemble members ...')
+      capacity = self.memberCapacity
+      delta = self.memberDelta
+    maxFlow = capacity * dt
+    space = delta * (self.maxVehicles - vehicles)
+    if self.coarse:  # node flows of coarse cells as CTM with span > 1
+      sending = np.minimum(vehicles / self.span, maxFlow)
+      receiving = np.minimum(space / self.span, maxFlow)
+    else:
+      sending = np.minimum(vehicles, maxFlow)
+      receiving = np.minimum(space, maxFlow)
+    ltmStates = list()
+    for linkID in self.ltmLinks:
+      inColumn, outColumn, maps = self.ltmLinks[linkID]
+      z = np.zeros((vehicles.shape[0], self.linkSlices[linkID].stop - self.linkSlices[linkID].start + 3))
+      z[:, :-3] = vehicles[:, self.linkSlices[linkID]]
+      z[:, -1] = 1.0
+      sending[:, outColumn] = np.clip(np.dot(z, maps[0]), 0.0, maxFlow[..., outColumn])
+      receiving[:, inColumn] = np.clip(np.dot(z, maps[1]), 0.0, maxFlow[..., inColumn])
+      ltmStates.append(z)
+    change = np.zeros_like(vehicles)
+    # intermediate cells, coarse cells move every span steps with a span * dt step
+    for cellSpan in self.cellPairs:
+      if self.activeTolerance is not None:  # fine cells only
+        self._activeSetTransitions(time, vehicles, sending, receiving, change)
+        continue
+      if (time + 1) % cellSpan != 0:
+        continue
+      upCells, downCells = self.cellPairs[cellSpan]
+      if cellSpan == 1:
+        flow = np.minimum(sending[:, upCells], receiving[:, downCells])
+      else:
+        flow = np.minimum(np.minimum(vehicles[:, upCells], maxFlow[..., upCells] * cellSpan),
+                          np.minimum(space[:, downCells], maxFlow[..., downCells] * cellSpan))
+      change[:, upCells] -= flow
+      change[:, downCells] += flow
+    # nodes
+    for node, cell in self.origins:
+      change[:, cell] += self.originDemand(node, time)
+    self.nodeKernels.apply(sending, receiving, change, capacity)
+    # LTM links, cells from Newell's counts after the node flows
+    for linkID, z in zip(self.ltmLinks, ltmStates):
+      inColumn, outColumn, maps = self.ltmLinks[linkID]
+      z[:, -3] = change[:, inColumn]
+      z[:, -2] = -change[:, outColumn]
+      counts = np.minimum(np.dot(z, maps[2]), np.dot(z, maps[3]))  # (members x cell boundaries)
+      cells = self.linkSlices[linkID]
+      change[:, cells] = counts[:, :-1] - counts[:, 1:] - vehicles[:, cells]
+      change[:, [inColumn, outColumn]] = 0.0
+    vehicles += change
+    return vehicles
+
+  def propagate(self, time, densities):
+    '''
+    propagates an ensemble of densities (members x reported cells)
+    one step and returns the new densities with the same shape
+    '''
+    densities = np.asarray(densities, dtype=float)
+    vehicles = np.zeros((densities.shape[0], self.numCells))
+    if self.coarse:  # a coarse cell holds the vehicles of its fine cells
+      np.add.at(vehicles, (slice(None), self.reportCells), densities * self.reportLength)
+    else:
+      vehicles[:, self.reportCells] = densities * self.reportLength
+    self.step(time, vehicles)
+    return vehicles[:, self.reportCells] / self.length[self.reportCells]
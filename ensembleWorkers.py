@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+ensemble workers over TCP, a coordinator sends blocks of ensemble
+members (or planner rollouts) to worker processes on other hosts,
+every worker keeps a Network loaded from the same network files
+messages are pickles prefixed by their length, only use it on a
+trusted cluster network, unpickling runs code from the sender
+
+@author: cesny
+"""
+import socket
+import select
+import struct
+import pickle
+import multiprocessing as mp
+import copy as cp
+import numpy as np
+from time import perf_counter
+from network import Network
+from utils import forwardCTMPropagation
+from findPath import planLocation
+
+_header = struct.Struct('!Q')  # message length in bytes
+
+
+def sendMessage(sock, message):
+  data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+  sock.sendall(_header.pack(len(data)) + data)
+  return None
+
+
+def _recvExactly(sock, size):
+  chunks = list()
+  while size > 0:
+    chunk = sock.recv(min(size, 1 << 20))
+    if not chunk:
+      raise ConnectionError('... connection closed by peer ...')
+    chunks.append(chunk)
+    size -= len(chunk)
+  return b''.join(chunks)
+
+
+def recvMessage(sock):
+  size = _header.unpack(_recvExactly(sock, _header.size))[0]
+  return pickle.loads(_recvExactly(sock, size))
+
+
+def linkParameters(trafficNet):
+  '''
+  free flow speed and critical density of every link, sent with
+  each task so workers follow the vmax updates of the coordinator
+  '''
+  return dict((linkID, (link.params['ffs'], link.params['critDen'])) for linkID, link in trafficNet.linkDict.items())
+
+
+def applyLinkParameters(trafficNet, params):
+  '''
+  updates the links whose parameters changed, the batched engine
+  copies capacities and deltas so it is rebuilt after an update
+  '''
+  for linkID, (ffs, critDen) in params.items():
+    link = trafficNet.linkDict[linkID]
+    if (link.params['ffs'] != ffs) or (link.params['critDen'] != critDen):
+      link.updateVmaxCritDen(ffs, critDen)
+      trafficNet.ensembleEngine = None
+  return None
+
+
+def _runTask(trafficNet, kind, payload):
+  '''
+  'propagate': (time, members, memberParams, linkParams), returns
+  the propagated members
+  'rollout': (linkParams, planLocation keyword arguments without
+  trafficNet), returns the planLocation result
+  '''
+  if kind == 'propagate':
+    time, members, memberParams, params = payload
+    applyLinkParameters(trafficNet, params)
+    return forwardCTMPropagation(time, trafficNet, members, memberParams)
+  if kind == 'rollout':
+    params, plannerArgs = payload
+    applyLinkParameters(trafficNet, params)
+    plannerNet = cp.deepcopy(trafficNet)
+    plannerArgs['EnKFCTM'].trafficNet = plannerNet  # filters are sent without the network
+    plannerArgs['EnKFV'].trafficNet = plannerNet
+    return planLocation(trafficNet=plannerNet, **plannerArgs)
+  raise Exception('... unknown task ' + str(kind) + ' ...')
+
+
+def serveWorker(host='localhost', port=0, portQueue=None):
+  '''
+  worker loop, serves one coordinator connection at a time
+  messages: ('init', networkArgs), ('task', taskID, kind, payload),
+  ('stop',) ends the worker, a closed connection waits for the next
+  coordinator, the network is kept while networkArgs do not change,
+  an unknown message is answered with ('error', None, reason)
+  '''
+  server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  server.bind((host, port))
+  server.listen(1)
+  if portQueue is not None:
+    portQueue.put(server.getsockname()[1])
+  trafficNet = None
+  networkArgs = None
+  running = True
+  while running:
+    conn, address = server.accept()
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+      while True:
+        message = recvMessage(conn)
+        if message[0] == 'init':
+          if message[1] != networkArgs:
+            networkArgs = message[1]
+            trafficNet = Network(*networkArgs)
+          sendMessage(conn, ('ready',))
+        elif message[0] == 'task':
+          taskID, kind, payload = message[1:]
+          try:
+            sendMessage(conn, ('result', taskID, _runTask(trafficNet, kind, payload)))
+          except Exception as err:
+            sendMessage(conn, ('error', taskID, repr(err)))
+        elif message[0] == 'stop':
+          running = False
+          break
+        else:
+          sendMessage(conn, ('error', None, '... unknown worker message ' + str(message[0]) + ' ...'))
+    except (ConnectionError, OSError):
+      pass  # coordinator went away, wait for the next one
+    finally:
+      conn.close()
+  server.close()
+  return None
+
+
+def startLocalWorkers(count, host='localhost'):
+  '''
+  starts count worker processes on this machine (for testing),
+  returns the processes and their (host, port) addresses
+  '''
+  portQueue = mp.Queue()
+  processes = list()
+  for worker in range(count):
+    process = mp.Process(target=serveWorker, args=(host, 0, portQueue))
+    process.daemon = True
+    process.start()
+    processes.append(process)
+  addresses = [(host, portQueue.get(timeout=30)) for worker in range(count)]
+  return processes, addresses
+
+
+class EnsembleCoordinator:
+  '''
+  dispatches tasks to the workers at addresses, one task per worker
+  at a time so faster workers take more, a worker that does not
+  answer within timeout seconds or drops the connection is removed
+  and its task is given to another worker
+  '''
+  def __init__(self, addresses, networkArgs, timeout=60.0, blockSize=None):
+    self.addresses = list(addresses)
+    self.networkArgs = tuple(networkArgs)  # Network arguments, the files must exist on every worker host
+    self.timeout = timeout
+    self.blockSize = blockSize  # members per propagation task, None splits evenly across workers
+    self.workers = dict()  # address: socket
+    self.failures = list()  # (address, reason)
+
+  def connect(self):
+    for address in self.addresses:
+      try:
+        sock = socket.create_connection(address, timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sendMessage(sock, ('init', self.networkArgs))
+        if recvMessage(sock)[0] != 'ready':
+          raise ConnectionError('... worker did not initialize ...')
+        self.workers[address] = sock
+      except (ConnectionError, OSError) as err:
+        self.failures.append((address, repr(err)))
+    if len(self.workers) == 0:
+      raise Exception('... no ensemble workers could be reached ...')
+    return None
+
+  def _dropWorker(self, address, reason):
+    self.failures.append((address, reason))
+    try:
+      self.workers.pop(address).close()
+    except OSError:
+      pass
+    return None
+
+  def runTasks(self, tasks):
+    '''
+    runs a list of (kind, payload) tasks on the workers and
+    returns their results in order
+    '''
+    if len(self.workers) == 0:
+      self.connect()
+    pending = list(range(len(tasks)))
+    pending.reverse()  # pop from the end, first task first
+    results = [None] * len(tasks)
+    done = 0
+    busy = dict()  # address: (taskID, deadline)
+    while done < len(tasks):
+      failed = list()
+      for address in self.workers:
+        if (address not in busy) and (len(pending) > 0):
+          taskID = pending.pop()
+          try:
+            sendMessage(self.workers[address], ('task', taskID) + tuple(tasks[taskID]))
+            busy[address] = (taskID, perf_counter() + self.timeout)
+          except (ConnectionError, OSError) as err:
+            pending.append(taskID)
+            failed.append((address, repr(err)))
+      for address, reason in failed:
+        self._dropWorker(address, reason)
+      if len(busy) == 0:
+        if len(self.workers) == 0:
+          raise Exception('... no ensemble workers left, ' + str(len(tasks) - done) + ' tasks not done ...')
+        continue
+      wait = max(0.0, min(deadline for taskID, deadline in busy.values()) - perf_counter())
+      readable = select.select([self.workers[address] for address in busy], [], [], wait)[0]
+      for address in list(busy):
+        taskID, deadline = busy[address]
+        sock = self.workers[address]
+        if sock in readable:
+          try:
+            reply = recvMessage(sock)
+          except (ConnectionError, OSError, EOFError) as err:
+            busy.pop(address)
+            pending.append(taskID)
+            self._dropWorker(address, repr(err))
+            continue
+          busy.pop(address)
+          if reply[0] == 'error':
+            raise Exception('... task ' + str(reply[1]) + ' failed on worker ' + str(address) + ': ' + reply[2] + ' ...')
+          results[reply[1]] = reply[2]
+          done += 1
+        elif perf_counter() > deadline:
+          busy.pop(address)
+          pending.append(taskID)
+          self._dropWorker(address, 'timeout')
+    return results
+
+  def forwardCTMPropagation(self, time, trafficNet, EnKFensembles, memberParams=None):
+    '''
+    same as utils.forwardCTMPropagation with the members split into
+    blocks propagated by the workers, trafficNet gives the current
+    link parameters
+    '''
+    EnKFensembles = np.asarray(EnKFensembles, dtype=float)
+    if len(self.workers) == 0:
+      self.connect()
+    numMembers = EnKFensembles.shape[0]
+    blockSize = self.blockSize or int(np.ceil(float(numMembers) / len(self.workers)))
+    params = linkParameters(trafficNet)
+    tasks = list()
+    for start in range(0, numMembers, blockSize):
+      rows = slice(start, start + blockSize)
+      blockParams = None
+      if memberParams is not None:
+        blockParams = dict((linkID, np.asarray(memberParams[linkID])[rows]) for linkID in memberParams)
+      tasks.append(('propagate', (time, EnKFensembles[rows], blockParams, params)))
+    return np.concatenate(self.runTasks(tasks), axis=0)
+
+  def planLocations(self, trafficNet, listofPlannerArgs):
+    '''
+    runs findPath.planLocation for every set of keyword arguments
+    (without trafficNet) on the workers, e.g., the planning calls
+    of several replications, the filters are sent without their network
+    '''
+    params = linkParameters(trafficNet)
+    tasks = list()
+    for plannerArgs in listofPlannerArgs:
+      plannerArgs = dict(plannerArgs)
+      for name in ('EnKFCTM', 'EnKFV'):
+        EnKFinstance = cp.copy(plannerArgs[name])
+        EnKFinstance.trafficNet = None
+        plannerArgs[name] = EnKFinstance
+      tasks.append(('rollout', (params, plannerArgs)))
+    return self.runTasks(tasks)
+
+  def close(self, stopWorkers=False):
+    '''
+    closes the connections, stopWorkers also ends the worker processes
+    '''
+    for address in list(self.workers):
+      if stopWorkers:
+        try:
+          sendMessage(self.workers[address], ('stop',))
+        except (ConnectionError, OSError):
+          pass
+      self.workers.pop(address).close()
+    return None
+
+
+if __name__ == '__main__':
+  workerPort = None  # e.g. 5000, runs this process as a worker on a compute node instead of the localhost test
+  if workerPort is not None:
+    serveWorker('0.0.0.0', workerPort)
+  else:
+    from utils import CTMcreateInitialEnsemble
+    networkArgs = (4490, 10, 'VISSIMnetwork/nodes.txt', 'VISSIMnetwork/links.txt', 'VISSIMnetwork/demand6600.txt')
+    processes, addresses = startLocalWorkers(3)
+    coordinator = EnsembleCoordinator(addresses, networkArgs, timeout=30.0)
+    trafficNet = Network(*networkArgs)
+    ensembles = CTMcreateInitialEnsemble(40, 100, 5, rng=np.random.default_rng(2018))
+    distributed = coordinator.forwardCTMPropagation(0, trafficNet, ensembles)
+    local = forwardCTMPropagation(0, trafficNet, ensembles)
+    print('max difference with local propagation: ', np.max(np.abs(distributed - local)))
+    processes[0].terminate()  # a worker dies, its tasks go to the others
+    distributed = coordinator.forwardCTMPropagation(1, trafficNet, distributed)
+    print('workers left: ', len(coordinator.workers), 'failures: ', coordinator.failures)
+    coordinator.close(stopWorkers=True)
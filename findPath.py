@@ -9,39 +9,78 @@ control algorithm
 @author: cesny
 """
 import numpy as np
+from time import perf_counter
+from observationOperator import ObsOperator
+from EnKF import AssimilationWindow
 from utils import setCTMVehicles, forwardCTMPropagation, CTMcreateInitialEnsemble, VmaxCreateInitialEnsemble, m, VmaxtoCritDen, cellToLength, lengthToCell
 
 
 
+def expectedPosteriorCov(P, H, obsVariances):
+  '''
+  closed form Kalman update of the covariance P for observations
+  through H (ObsOperator or matrix) with independent errors of
+  variance obsVariances, no observation is sampled
+  '''
+  if isinstance(H, ObsOperator):
+    PHt = H.applyTranspose(P)
+    HPHt = H.apply(PHt)
+  else:
+    PHt = np.dot(P, np.transpose(H))
+    HPHt = np.dot(H, PHt)
+  S = HPHt + np.diag(obsVariances)
+  return P - np.dot(PHt, np.linalg.solve(S, np.transpose(PHt)))
+
+
+def planLocation(**kwargs):
+  '''
+  runs findPath(**kwargs).updateLocation, module level so that it
+  can be sent to a worker process for pipelined planning
+  returns the new location and whether planning completed
+  '''
+  explorePath = findPath(**kwargs)
+  newLocation = explorePath.updateLocation()
+  return newLocation, explorePath.completed, getattr(explorePath, 'rolloutSteps', None)
+
 
 class findPath:
   '''
   this class is for determining next drone 
   location based on A-optimal control
   '''
-  def __init__(self, location, time, trafficNet, EnKFCTM, EnKFV, timeHorizon=None, weight=0.5):
+  def __init__(self, location, time, trafficNet, EnKFCTM, EnKFV, timeHorizon=None, weight=0.5, rng=None, deadline=None, memberParams=None, scoring='ensemble', terminalValues=None, assimilationWindow=None, cache=None):
     self.location = location  # current drone location, defined as a tuple (linkID, cell), cell count from zero
     self.time = time  # current time
-    self.timeHorizon = timeHorizon  # time horizon to do MPC (number of timeSteps), set dynamically till drone visits all cells in each path, can assign otherwise
+    self.timeHorizon = timeHorizon  # time horizon to do MPC (number of timeSteps), None runs till drone visits all cells in each path
+    self.terminalValues = terminalValues  # per cell value of a drone observation, terminal estimate for cells beyond timeHorizon, computed from EnKFCTM if None
     self.trafficNet = trafficNet  # the traffic network class
     self.EnKFCTM = EnKFCTM  # the ensemble kalman filtering class for densities
     self.EnKFV = EnKFV  # the ensemble kalman filtering class, use to predict covariance matrix
+    self.EnKFCTM.adaptiveSize = None  # keep ensemble sizes fixed within rollouts so both paths are scored alike
+    self.EnKFV.adaptiveSize = None
     self.cellToLoc = dict()
     self.locToCell = dict()  # maps the tuple (link, cell) to cell between 0 and 40
     self.weight = weight  # this is the weight of vmax vs densities trace, weight corresponds to vmax, (1-w) corresponds to weight of densities trace
+    self.memberParams = memberParams  # per member link parameters for forwardCTMPropagation, None uses the network parameters
+    self.scoring = scoring  # 'ensemble' runs EnKF rollouts, 'expected' uses the closed form covariance update (deterministic)
+    self.assimilationWindow = assimilationWindow  # time steps per CTM analysis in the rollouts, None assimilates every step
+    self.cache = cache  # plannerCache.DecisionCache shared across calls and runs, None always plans
+    self.cacheHit = False
+    self.deadline = deadline  # wall clock budget in seconds for anytime planning, None runs the full rollouts
+    self.completed = True  # set to False when anytime planning is cut off by the deadline
+    if rng is not None:  # give the rollout filters their own streams so they do not replay the noise of the filters they were copied from
+      CTMrng, Vrng = rng.spawn(2)
+      self.EnKFCTM.setRandomStream(CTMrng)
+      self.EnKFV.setRandomStream(Vrng)
   
   def createLocToCell(self):
     '''
     creates the mapping between (linkid, cell) to
     global cellindex between (0,40) across all links
     '''
-    cellindex = 0
-    for linkID in self.trafficNet.linkDict:
-      if linkID is not 9:
-        for cellkey, cell in enumerate(self.trafficNet.linkDict[linkID].cells):
-          self.locToCell[(linkID, cellkey)] = cellindex
-          self.cellToLoc[cellindex] = (linkID, cellkey)
-          cellindex += 1
+    geometry = self.trafficNet.getGeometry()
+    self.locToCell = geometry.locToCellMap
+    self.cellToLoc = geometry.cellToLocMap
     return None
   
   def generateDronePaths(self):
@@ -54,19 +93,57 @@ class findPath:
     self.dronePaths = dict()
     self.dronePaths['left'] = dict()
     self.dronePaths['right'] = dict()
+    self.remainingCells = dict()  # cells of each path beyond timeHorizon, valued by the terminal estimate
     droneCell = self.locToCell[self.location]
     leftPath = list(range(0,droneCell+1))
     leftPath.reverse()
-    rightPath = list(range(droneCell, 40))
+    rightPath = list(range(droneCell, self.trafficNet.getGeometry().numCells))
+    lastStep = len(self.trafficNet.totalTimesteps) - 1  # end of the simulation
     # assuming at every time step the drone can move one cell, determine its path across time
-    for key, lcell in enumerate(leftPath):
-      if self.time+key <= 449:  # limited by time horizon
-        self.dronePaths['left'][self.time+key] = lcell
-    for key, rcell in enumerate(rightPath):
-      if self.time+key <= 449:
-        self.dronePaths['right'][self.time+key] = rcell
+    for direction, path in (('left', leftPath), ('right', rightPath)):
+      self.remainingCells[direction] = list()
+      for key, cell in enumerate(path):
+        if self.time+key > lastStep:  # limited by simulation horizon
+          break
+        if (self.timeHorizon is not None) and (key >= self.timeHorizon):  # limited by planning horizon
+          self.remainingCells[direction] = path[key:lastStep - self.time + 1]
+          break
+        self.dronePaths[direction][self.time+key] = cell
     return None
   
+  def getTerminalValues(self):
+    '''
+    per cell value table, reduction in the trace of the current
+    CTM covariance when the drone observes the cell (closed form
+    update, lower obs. error at the drone cell), cells that are
+    not observed have no value
+    '''
+    self.EnKFCTM.createLocToCell()
+    droneLoc = self.EnKFCTM.droneLoc
+    P = self.EnKFCTM.getP()
+    self.EnKFCTM.droneLoc = None
+    baseTrace = np.trace(expectedPosteriorCov(P, self.EnKFCTM.H, self.EnKFCTM.getObsErrorVariances()))
+    self.terminalValues = np.zeros(self.EnKFCTM.stateDim)
+    for cell in range(self.EnKFCTM.stateDim):
+      self.EnKFCTM.droneLoc = self.cellToLoc[cell]
+      self.terminalValues[cell] = baseTrace - np.trace(expectedPosteriorCov(P, self.EnKFCTM.H, self.EnKFCTM.getObsErrorVariances()))
+    self.EnKFCTM.droneLoc = droneLoc
+    return self.terminalValues
+  
+  def getTerminalCost(self):
+    '''
+    estimate of the further trace reduction of each path from
+    the cells it would visit after the planning horizon
+    '''
+    self.terminalCost = {'left': 0.0, 'right': 0.0}
+    if len(self.remainingCells['left']) + len(self.remainingCells['right']) == 0:
+      return self.terminalCost
+    if self.terminalValues is None:
+      self.getTerminalValues()
+    for direction in self.terminalCost:
+      self.terminalCost[direction] = float(np.sum(self.terminalValues[self.remainingCells[direction]]))
+    return self.terminalCost
+  
   def getObservations(self):
     '''
     use traffic network to simulate paths based on current
@@ -81,8 +158,8 @@ class findPath:
     storeResults = dict()
     CTMensembles = self.EnKFCTM.getUpdatedEnsembles()  # current ensembles
     for lr in range(loadRange):
-      CTMensembles = forwardCTMPropagation(self.time + lr, self.trafficNet, CTMensembles)
-      storeResults[self.time + lr] =  [float(sum(col))/len(col) for col in zip(*CTMensembles)]  # store average of propagated ensembles as expected observed true state
+      CTMensembles = forwardCTMPropagation(self.time + lr, self.trafficNet, CTMensembles, self.memberParams)
+      storeResults[self.time + lr] = np.mean(CTMensembles, axis=0)  # store average of propagated ensembles as expected observed true state
     
     for time in self.dronePaths['left']:
       self.pathObservations['left'][time] = storeResults[time]
@@ -90,6 +167,24 @@ class findPath:
       self.pathObservations['right'][time] = storeResults[time]
     return None
   
+  def newWindow(self):
+    '''
+    an empty assimilation window for a rollout, None if the
+    rollouts assimilate every step
+    '''
+    if self.assimilationWindow is None:
+      return None
+    return AssimilationWindow(self.assimilationWindow)
+  
+  def assimilate(self, CTMensembles, observations, window, flush):
+    '''
+    one rollout assimilation step, windowed if window is not None,
+    flush runs the analysis of a partial window at the end of a path
+    '''
+    if window is None:
+      return self.EnKFCTM.EnKFStep(CTMensembles, observations)
+    return self.EnKFCTM.windowStep(CTMensembles, observations, window, flush)
+  
   def getCovarianceMatrices(self):
     '''
     use the "observations" (from propagated ensembles) to determine
@@ -100,24 +195,33 @@ class findPath:
     error
     '''
     self.finalCovariancesCTM = dict()
-    self.finalCovariancesVmax = dict()
     # densities covariance matrix
     CTMensemblesLeft = self.EnKFCTM.getUpdatedEnsembles()
     CTMensemblesRight = self.EnKFCTM.getUpdatedEnsembles()
-    VmaxEnsemblesLeft = self.EnKFV.getUpdatedEnsembles()
-    VmaxEnsemblesRight = self.EnKFV.getUpdatedEnsembles()
-    for time in self.dronePaths['left']:
-      CTMensemblesLeft = forwardCTMPropagation(time, self.trafficNet, CTMensemblesLeft)
+    window = self.newWindow()
+    for key, time in enumerate(self.dronePaths['left']):
+      CTMensemblesLeft = forwardCTMPropagation(time, self.trafficNet, CTMensemblesLeft, self.memberParams)
       self.EnKFCTM.droneLoc = self.cellToLoc[self.dronePaths['left'][time]]  # update drone location according to base policy, used for precise observations
-      CTMensemblesLeft = self.EnKFCTM.EnKFStep(CTMensemblesLeft, self.pathObservations['left'][time])  # update the ensembles
+      CTMensemblesLeft = self.assimilate(CTMensemblesLeft, self.pathObservations['left'][time], window, key == len(self.dronePaths['left']) - 1)  # update the ensembles
     self.finalCovariancesCTM['left'] = self.EnKFCTM.getP()  
     
-    for time in self.dronePaths['right']:
-      CTMensemblesRight = forwardCTMPropagation(time, self.trafficNet, CTMensemblesRight)
+    window = self.newWindow()
+    for key, time in enumerate(self.dronePaths['right']):
+      CTMensemblesRight = forwardCTMPropagation(time, self.trafficNet, CTMensemblesRight, self.memberParams)
       self.EnKFCTM.droneLoc = self.cellToLoc[self.dronePaths['right'][time]]  # update drone location according to base policy, used for precise observations
-      CTMensemblesRight = self.EnKFCTM.EnKFStep(CTMensemblesRight, self.pathObservations['right'][time])
+      CTMensemblesRight = self.assimilate(CTMensemblesRight, self.pathObservations['right'][time], window, key == len(self.dronePaths['right']) - 1)
     self.finalCovariancesCTM['right'] = self.EnKFCTM.getP()
-    
+    self.getVmaxCovariances()
+    return None
+  
+  def getVmaxCovariances(self):
+    '''
+    covariance on vmax after the drone observes uf at the
+    incident location of the left path and of the right path
+    '''
+    self.finalCovariancesVmax = dict()
+    VmaxEnsemblesLeft = self.EnKFV.getUpdatedEnsembles()
+    VmaxEnsemblesRight = self.EnKFV.getUpdatedEnsembles()
     # update the uf estimates
     self.EnKFV.obsError = 10   
     self.EnKFV.obsDim = 1
@@ -125,21 +229,82 @@ class findPath:
     # VfObserved = [20.0]
     self.EnKFV.nonLinearObs = False
     # do left
-    self.EnKFV.H = np.array([[1.0, 0.0]])
+    self.EnKFV.H = ObsOperator([0], self.EnKFV.stateDim)
     print(' ')
-    print('pre-update left: ', np.transpose(np.array(VmaxEnsemblesLeft))[:,0:3])
+    print('pre-update left: ', np.transpose(VmaxEnsemblesLeft)[:,0:3])
     VmaxEnsemblesLeft = self.EnKFV.EnKFStep(VmaxEnsemblesLeft, [EnKFVmean[0]])
     self.finalCovariancesVmax['left'] = self.EnKFV.getP()
-    print('left path: ', self.finalCovariancesVmax['left'], np.transpose(np.array(VmaxEnsemblesLeft))[:,0:3])
+    print('left path: ', self.finalCovariancesVmax['left'], np.transpose(VmaxEnsemblesLeft)[:,0:3])
     print(' ')
     # do right
-    self.EnKFV.H = np.array([[0.0, 1.0]])
-    print('pre-update right: ', np.transpose(np.array(VmaxEnsemblesRight))[:,0:3])
+    self.EnKFV.H = ObsOperator([1], self.EnKFV.stateDim)
+    print('pre-update right: ', np.transpose(VmaxEnsemblesRight)[:,0:3])
     VmaxEnsemblesRight = self.EnKFV.EnKFStep(VmaxEnsemblesRight, [EnKFVmean[1]])
     self.finalCovariancesVmax['right'] = self.EnKFV.getP()
-    print('right path: ', self.finalCovariancesVmax['right'], np.transpose(np.array(VmaxEnsemblesRight))[:,0:3])
+    print('right path: ', self.finalCovariancesVmax['right'], np.transpose(VmaxEnsemblesRight)[:,0:3])
     print(' ')
     return None
+  
+  def getTangentModel(self, perturbation=1e-3):
+    '''
+    linearization L of one CTM step at the current mean by finite
+    differences, the mean and its stateDim perturbed copies are
+    propagated in one call, with per member parameters the members
+    take the mean parameters
+    '''
+    mean = np.asarray(self.EnKFCTM.getMean(), dtype=float)
+    stateDim = len(mean)
+    states = mean + np.concatenate((np.zeros((1, stateDim)), perturbation * np.identity(stateDim)))
+    memberParams = None
+    if self.memberParams is not None:
+      memberParams = dict((linkID, np.tile(np.mean(params, axis=0), (stateDim + 1, 1))) for linkID, params in self.memberParams.items())
+    propagated = forwardCTMPropagation(self.time, self.trafficNet, states, memberParams)
+    return np.transpose(propagated[1:] - propagated[0]) / perturbation  # L[i, j] = d density i / d density j
+  
+  def getExpectedCovariances(self, startTime=None):
+    '''
+    deterministic replacement of getObservations and getCovarianceMatrices
+    the tangent model L is built once at the current mean, along each
+    path the covariance is forecast as L P L^T + Q and updated in closed
+    form with the path's observation schedule (observed cells, lower
+    error at the drone cell), with a deadline both paths stop at the
+    same step and self.completed is False
+    '''
+    self.finalCovariancesCTM = dict()
+    self.EnKFCTM.createLocToCell()
+    stateDim = self.EnKFCTM.stateDim
+    Q = (self.EnKFCTM.modelError**2) * np.identity(stateDim)
+    covariances = {'left': self.EnKFCTM.getP(), 'right': self.EnKFCTM.getP()}
+    L = self.getTangentModel()
+    loadRange = max(len(self.dronePaths['left']), len(self.dronePaths['right']))
+    for lr in range(loadRange):
+      if (self.deadline is not None) and (perf_counter() - startTime > self.deadline):
+        self.completed = False
+        break
+      time = self.time + lr
+      for direction in ('left', 'right'):
+        if time not in self.dronePaths[direction]:
+          continue
+        P = np.dot(L, np.dot(covariances[direction], np.transpose(L))) + Q
+        self.EnKFCTM.droneLoc = self.cellToLoc[self.dronePaths[direction][time]]  # observation schedule of the path at this step
+        covariances[direction] = expectedPosteriorCov(P, self.EnKFCTM.H, self.EnKFCTM.getObsErrorVariances())
+    self.finalCovariancesCTM['left'] = covariances['left']
+    self.finalCovariancesCTM['right'] = covariances['right']
+    return None
+  
+  def getExpectedVmaxCovariances(self):
+    '''
+    closed form version of getVmaxCovariances, random walk
+    forecast of the vmax covariance followed by a direct uf
+    observation at the incident location of each path
+    '''
+    self.finalCovariancesVmax = dict()
+    stateDim = self.EnKFV.stateDim
+    P = self.EnKFV.getP() + (self.EnKFV.modelError**2) * np.identity(stateDim)
+    obsVariance = float(self.EnKFV.obsError)**2
+    self.finalCovariancesVmax['left'] = expectedPosteriorCov(P, ObsOperator([0], stateDim), [obsVariance])
+    self.finalCovariancesVmax['right'] = expectedPosteriorCov(P, ObsOperator([1], stateDim), [obsVariance])
+    return None
     
   def getObjective(self):
     '''
@@ -149,8 +314,8 @@ class findPath:
     returns objective of left path and objective of right path in a dict
     '''
     self.ObjectiveVal = dict()
-    self.ObjectiveVal['left'] = (self.weight * np.trace(self.finalCovariancesVmax['left']) / 2.0) + ((1-self.weight) * np.trace(self.finalCovariancesCTM['left']) / 40.0)
-    self.ObjectiveVal['right'] = (self.weight * np.trace(self.finalCovariancesVmax['right']) / 2.0) + ((1-self.weight) * np.trace(self.finalCovariancesCTM['right']) / 40.0)
+    self.ObjectiveVal['left'] = (self.weight * np.trace(self.finalCovariancesVmax['left']) / 2.0) + ((1-self.weight) * (np.trace(self.finalCovariancesCTM['left']) - self.terminalCost['left']) / 40.0)
+    self.ObjectiveVal['right'] = (self.weight * np.trace(self.finalCovariancesVmax['right']) / 2.0) + ((1-self.weight) * (np.trace(self.finalCovariancesCTM['right']) - self.terminalCost['right']) / 40.0)
     print(' ')
     print('objective left: ', np.trace(self.finalCovariancesVmax['left']) / 2.0, np.trace(self.finalCovariancesCTM['left']) / 40.0)
     print('objective right: ', np.trace(self.finalCovariancesVmax['right']) / 2.0, np.trace(self.finalCovariancesCTM['right']) / 40.0)
@@ -168,18 +333,105 @@ class findPath:
         
     elif direction == 'right':
       currentCell = self.locToCell[self.location]
-      if currentCell != 39:
+      if currentCell != self.trafficNet.getGeometry().numCells - 1:
         newLoc = currentCell + 1
         self.location =  self.cellToLoc[newLoc]
     return self.location
   
+  def updateLocationAnytime(self):
+    '''
+    anytime version of updateLocation, the left and right rollouts
+    are advanced one step at a time in turn and the objective of
+    each path is kept up to date, when the deadline is reached the
+    best decision so far is returned and self.completed is False,
+    the deadline is checked before each depth so both paths are
+    always compared after the same number of rollout steps
+    '''
+    startTime = perf_counter()
+    self.createLocToCell()
+    self.generateDronePaths()
+    self.getTerminalCost()  # before the rollouts change the filter, zero unless the paths are truncated by timeHorizon
+    self.getVmaxCovariances()  # a single cheap update per path
+    self.finalCovariancesCTM = dict()
+    self.rolloutSteps = dict()  # number of rollout steps evaluated per path
+    paths = dict()
+    CTMensembles = dict()
+    windows = dict()
+    for direction in ('left', 'right'):
+      paths[direction] = sorted(self.dronePaths[direction])
+      CTMensembles[direction] = self.EnKFCTM.getUpdatedEnsembles()
+      windows[direction] = self.newWindow()
+      self.finalCovariancesCTM[direction] = self.EnKFCTM.getP()  # running estimate before any rollout step
+      self.rolloutSteps[direction] = 0
+    meanEnsembles = self.EnKFCTM.getUpdatedEnsembles()  # propagated without assimilation to get expected observations
+    loadRange = max(len(paths['left']), len(paths['right']))
+    self.completed = False
+    for lr in range(loadRange):
+      if perf_counter() - startTime > self.deadline:
+        break
+      meanEnsembles = forwardCTMPropagation(self.time + lr, self.trafficNet, meanEnsembles, self.memberParams)
+      expectedObs = np.mean(meanEnsembles, axis=0)
+      for direction in ('left', 'right'):
+        if lr >= len(paths[direction]):
+          continue
+        time = paths[direction][lr]
+        CTMensembles[direction] = forwardCTMPropagation(time, self.trafficNet, CTMensembles[direction], self.memberParams)
+        self.EnKFCTM.droneLoc = self.cellToLoc[self.dronePaths[direction][time]]
+        CTMensembles[direction] = self.assimilate(CTMensembles[direction], expectedObs, windows[direction], lr == len(paths[direction]) - 1)
+        if (windows[direction] is None) or self.EnKFCTM.windowAnalysed:  # forecasts between windowed analyses are not estimates of the path
+          self.finalCovariancesCTM[direction] = self.EnKFCTM.getP()
+        self.rolloutSteps[direction] += 1
+    else:
+      self.completed = (self.rolloutSteps['left'] == len(paths['left'])) and (self.rolloutSteps['right'] == len(paths['right']))
+    self.getObjective()
+    minKey = min(self.ObjectiveVal, key=self.ObjectiveVal.get)
+    return self.moveDrone(minKey)
+  
+  def getSettings(self):
+    '''
+    planner options that change the decision, part of the cache key
+    '''
+    return (self.weight, self.timeHorizon, self.scoring, self.assimilationWindow, self.memberParams is not None)
+  
   def updateLocation(self):
     '''
-    determines the next step for the drone
+    determines the next step for the drone, with a cache a
+    decision made for the same location, time and quantized filter
+    statistics is reused and the rollouts are skipped
+    '''
+    if self.cache is None:
+      return self.chooseLocation()
+    cacheKey = self.cache.makeKey(self.location, self.time, self.EnKFCTM, self.EnKFV, self.getSettings())
+    cached = self.cache.get(cacheKey)
+    if cached is not None:
+      direction, self.ObjectiveVal = cached
+      self.cacheHit = True
+      self.createLocToCell()
+      return self.moveDrone(direction)
+    newLocation = self.chooseLocation()
+    if self.completed:  # decisions cut off by a deadline are not reused
+      self.cache.put(cacheKey, min(self.ObjectiveVal, key=self.ObjectiveVal.get), self.ObjectiveVal)
+    return newLocation
+  
+  def chooseLocation(self):
+    '''
     go left or go right, updates self.location
     '''
+    if self.scoring == 'expected':
+      startTime = perf_counter()
+      self.createLocToCell()
+      self.generateDronePaths()
+      self.getTerminalCost()
+      self.getExpectedCovariances(startTime)
+      self.getExpectedVmaxCovariances()
+      self.getObjective()
+      minKey = min(self.ObjectiveVal, key=self.ObjectiveVal.get)
+      return self.moveDrone(minKey)
+    if self.deadline is not None:
+      return self.updateLocationAnytime()
     self.createLocToCell()
     self.generateDronePaths()
+    self.getTerminalCost()
     self.getObservations()
     self.getCovarianceMatrices()
     self.getObjective()
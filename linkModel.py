@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """
-cell transmission model
+cell transmission model and link transmission model
 
 @author: cesny
 """
@@ -47,19 +47,110 @@ class CTM(Link):
       newCell = Cell(self.params['qcap'], self.params['jamDen'] * self.params['length'] / self.numCells,
                      self.params['bws'] / self.params['ffs'], self.params['timeStep'], self.params['ffs'])
       self.cells.append(newCell)
+    self.activeTolerance = None  # active set update is off unless setActiveSet is called
+    self.span = 1  # fine cells per cell, see setCoarseCells
     
   def calculateSendingFlow(self, time, timeStep):
     """
     overwrites Link method
     """
+    if self.span > 1:
+      lastCell = self.cells[-1]  # vehicles of the last fine cell, spread evenly
+      return min(lastCell.vehicles / self.span, lastCell.capacity * self.params['timeStep'])
     return self.cells[-1].calculateSendingFlow()
   
   def calculateReceivingFlow(self, time, timeStep):
     """
     overwrites Link method
     """
+    if self.span > 1:
+      firstCell = self.cells[0]
+      return min(firstCell.delta * (firstCell.maxVehicles - firstCell.vehicles) / self.span, firstCell.capacity * self.params['timeStep'])
     return self.cells[0].calculateReceivingFlow()
   
+  def setCoarseCells(self, span):
+    """
+    merges every span fine cells into one coarse cell, coarse cells
+    exchange vehicles every span time steps with a span*timeStep
+    step (the CFL condition still holds), at the steps where time
+    is a multiple of span, node flows still move every time step,
+    densities are reported on the fine cells
+    span must divide numCells, span 1 restores the fine cells
+    """
+    if self.numCells % span != 0:
+      raise Exception('... span ' + str(span) + ' does not divide the ' + str(self.numCells) + ' cells of link ' + str(self.ID) + ' ...')
+    if self.activeTolerance is not None:
+      raise Exception('... coarse cells and the active set update cannot be combined ...')
+    fineDensities = self.linkDensity()
+    self.span = span
+    self.cells = list()
+    for c in range(self.numCells // span):
+      newCell = Cell(self.params['qcap'], self.params['jamDen'] * self.params['length'] * span / self.numCells,
+                     self.params['bws'] / self.params['ffs'], self.params['timeStep'] * span, self.params['ffs'])
+      self.cells.append(newCell)
+    self.setCellDensities(fineDensities)
+    return None
+  
+  def setActiveSet(self, tolerance=1e-6, recheckInterval=10):
+    """
+    enables the active set update: only cell pairs next to a cell
+    whose vehicles changed by more than tolerance (veh) are recomputed,
+    other pairs keep their previous transition flow and cells next to
+    them only keep their previous state, every recheckInterval time
+    steps all cells are updated, tolerance None disables it
+    the per member resets of the serial forwardCTMPropagation path
+    mark nearly every cell as changed, ensembles get the active set
+    from EnsembleCTM.setActiveSet (Network.enableActiveSet)
+    """
+    if self.span > 1:
+      raise Exception('... coarse cells and the active set update cannot be combined ...')
+    self.activeTolerance = tolerance
+    self.recheckInterval = recheckInterval
+    self._transitionFlows = [0.0] * (self.numCells - 1)  # last transition flow of every cell pair
+    self._changedCells = set(range(self.numCells))
+    self._lastRecheck = None  # time step of the last full update, None forces one
+    return None
+  
+  def _activeSetUpdate(self, time):
+    """
+    moves vehicles between the cells of the active set
+    """
+    lastCell = self.numCells - 1
+    if (self._lastRecheck is None) or (time - self._lastRecheck >= self.recheckInterval) or (time < self._lastRecheck):
+      pairs = range(lastCell)
+      touchedCells = range(self.numCells)
+      self._lastRecheck = time
+    else:
+      self._changedCells.update((0, lastCell))  # boundary cells take node flows every step
+      pairs = set()
+      for c in self._changedCells:
+        if c > 0:
+          pairs.add(c - 1)
+        if c < lastCell:
+          pairs.add(c)
+      touchedCells = set()
+      for c in pairs:
+        touchedCells.add(c)
+        touchedCells.add(c + 1)
+    for c in pairs:
+      cellSendingFlow = self.cells[c].calculateSendingFlow()
+      cellReceivingFlow = self.cells[c+1].calculateReceivingFlow()
+      self._transitionFlows[c] = min(cellSendingFlow, cellReceivingFlow)
+    changes = dict()
+    for c in touchedCells:
+      change = 0.0
+      if c > 0:
+        change += self._transitionFlows[c-1]
+      if c < lastCell:
+        change -= self._transitionFlows[c]
+      changes[c] = change
+    self._changedCells = set()
+    for c in changes:
+      self.cells[c].addVehicles(changes[c])
+      if abs(changes[c]) > self.activeTolerance:
+        self._changedCells.add(c)
+    return None
+  
   def linkUpdate(self, time):
     """
     performs any internal calculations, puts flows on links, and 
@@ -67,17 +158,34 @@ class CTM(Link):
     inFlow and outFlow were calculated based on the t-1
     sending and receiving flows
     """    
+    if self.activeTolerance is not None:
+      self._activeSetUpdate(time)
+      self.flowIn(time)
+      self.flowOut(time)
+      return None
+    if self.span > 1:
+      if time % self.span == 0:  # coarse cells move once every span steps, on the clock so every ensemble member moves alike
+        self._cellTransitions()
+    else:
+      self._cellTransitions()
+    self.flowIn(time)
+    self.flowOut(time)
+    return None
+  
+  def _cellTransitions(self):
+    """
+    moves vehicles between the cells of the link
+    """
+    numCells = len(self.cells)
     cellTransitionFlow = list()
     # deal with intermediate cells
-    for c in range(0, self.numCells-1):
+    for c in range(0, numCells-1):
       cellSendingFlow = self.cells[c].calculateSendingFlow()
       cellReceivingFlow = self.cells[c+1].calculateReceivingFlow()
       cellTransitionFlow.append(min(cellSendingFlow, cellReceivingFlow))
-    for c in range(0, self.numCells-1):
+    for c in range(0, numCells-1):
       self.cells[c].removeVehicles(cellTransitionFlow[c])
       self.cells[c+1].addVehicles(cellTransitionFlow[c])
-    self.flowIn(time)
-    self.flowOut(time)
     return None
       
   def flowIn(self, time):
@@ -96,9 +204,25 @@ class CTM(Link):
     """
     listofDensities = list()
     for cell in self.cells:
-      listofDensities.append(cell.cellDensity())
+      listofDensities += [cell.cellDensity()] * self.span  # coarse cells are spread over their fine cells
     return listofDensities
   
+  def setCellDensities(self, densities):
+    """
+    sets the vehicles in every cell from a list of densities,
+    coarse cells take the mean of the fine cell densities they cover
+    """
+    if self.span > 1:
+      for c, cell in enumerate(self.cells):
+        cell.vehicles = sum(densities[c * self.span:(c + 1) * self.span]) * cell.length / self.span
+      return None
+    for c, (cell, density) in enumerate(zip(self.cells, densities)):
+      vehicles = density * cell.length  # convert density to vehicles
+      if (self.activeTolerance is not None) and (abs(vehicles - cell.vehicles) > self.activeTolerance):
+        self._changedCells.add(c)
+      cell.vehicles = vehicles
+    return None
+  
   def updateVmaxCritDen(self, newVmax, newCritDen):
     """
     overwrites link method to update cells
@@ -108,6 +232,170 @@ class CTM(Link):
     for cell in self.cells:
       cell.capacity = self.params['qcap'] / 3600.0 # already updated for link
       cell.delta = self.params['bws'] / self.params['ffs']  # already upated in link 
+    if self.activeTolerance is not None:
+      self._lastRecheck = None  # new parameters, update every cell next step
     return None
 
-      
\ No newline at end of file
+
+class LTM(Link):
+  """
+  link transmission model (Yperman2007), sending and receiving flows
+  come from the cumulative counts at the link ends so the cost per
+  step does not depend on the number of cells, cell densities are
+  reconstructed from the counts (Newell) only when linkDensity is
+  called, numCells cells of equal length are used for reporting
+  densities are vehicles per CTM cell length (Cell.length = ffs*dt)
+  so both link types report and take the same densities
+  """
+  def __init__(self, linkID, unode, dnode, params):
+    Link.__init__(self, linkID, unode, dnode, params)
+    self.numCells = math.ceil(self.params['length']/(self.params['ffs']*(1.0/3600)*self.params['timeStep']))  # same cells as CTM
+    self.cellLength = self.params['length'] / self.numCells  # the cells split the link evenly, as the CTM maxVehicles
+    self.densityLength = self.params['ffs'] * self.params['timeStep'] / 3600.0  # Cell.length, vehicles per cell / densityLength gives the density
+    self.currentTime = 0  # last time step with recorded counts
+    self._historyStart = 0  # earliest time step kept in the counts
+    self._setDensities = None  # (time, densities) of the last setCellDensities, reported as is until the next step
+    self._upstreamCounts[0] = 0.0
+    self._downstreamCounts[0] = 0.0
+  
+  def _freeFlowSteps(self):
+    return self.params['length'] / (self.params['ffs'] * self.params['timeStep'] / 3600.0)
+  
+  def _backwardWaveSteps(self):
+    return self.params['length'] / (self.params['bws'] * self.params['timeStep'] / 3600.0)
+  
+  def _countAt(self, counts, time):
+    """
+    cumulative count at a (fractional) time step, linear between
+    steps, clamped to the kept history
+    """
+    time = min(max(time, self._historyStart), self.currentTime)
+    lower = int(math.floor(time))
+    if lower == time:
+      return counts[lower]
+    fraction = time - lower
+    return (1 - fraction) * counts[lower] + fraction * counts[lower + 1]
+  
+  def upstreamCount(self, time):
+    """
+    overwrites link method, counts are cumulative here
+    """
+    return self._countAt(self._upstreamCounts, time)
+  
+  def downstreamCount(self, time):
+    """
+    overwrites link method, counts are cumulative here
+    """
+    return self._countAt(self._downstreamCounts, time)
+  
+  def calculateSendingFlow(self, time, timeStep):
+    """
+    vehicles that entered one free flow travel time ago and
+    have not left yet, limited by capacity
+    """
+    now = self.currentTime
+    sending = self.upstreamCount(now + 1 - self._freeFlowSteps()) - self.downstreamCount(now)
+    return max(0.0, min(sending, self.params['qcap'] * timeStep / 3600.0))
+  
+  def calculateReceivingFlow(self, time, timeStep):
+    """
+    space freed by vehicles that left one backward wave travel
+    time ago, limited by capacity
+    """
+    now = self.currentTime
+    receiving = self.downstreamCount(now + 1 - self._backwardWaveSteps()) + self.params['jamDen'] * self.params['length'] - self.upstreamCount(now)
+    return max(0.0, min(receiving, self.params['qcap'] * timeStep / 3600.0))
+  
+  def flowIn(self, time):
+    """
+    overwrites link method to keep cumulative counts
+    """
+    self._upstreamCounts[time] = self._upstreamCounts[self.currentTime] + self.inFlow
+    return None
+  
+  def flowOut(self, time):
+    """
+    overwrites link method to keep cumulative counts
+    """
+    self._downstreamCounts[time] = self._downstreamCounts[self.currentTime] + self.outFlow
+    return None
+  
+  def linkUpdate(self, time):
+    """
+    records the counts of the next step and drops counts older
+    than the longest lookback, counts follow the link's own clock
+    (currentTime) so that ensemble resets do not depend on time
+    """
+    time = self.currentTime + 1
+    self.flowIn(time)
+    self.flowOut(time)
+    self.currentTime = time
+    oldest = time - int(math.ceil(max(self._freeFlowSteps(), self._backwardWaveSteps()))) - 1
+    while self._historyStart < oldest:
+      self._upstreamCounts.pop(self._historyStart, None)
+      self._downstreamCounts.pop(self._historyStart, None)
+      self._historyStart += 1
+    return None
+  
+  def _cumulativeAt(self, x):
+    """
+    Newell's cumulative count at position x (km) and currentTime
+    """
+    now = self.currentTime
+    length = self.params['length']
+    fromUpstream = self.upstreamCount(now - x / (self.params['ffs'] * self.params['timeStep'] / 3600.0))
+    fromDownstream = self.downstreamCount(now - (length - x) / (self.params['bws'] * self.params['timeStep'] / 3600.0)) + self.params['jamDen'] * (length - x)
+    return min(fromUpstream, fromDownstream)
+  
+  def linkDensity(self, time=None, cells=None):
+    """
+    overwrites link method, reconstructs the density of every
+    reporting cell from the cumulative counts, with cells (indices
+    on the link) only those are reconstructed and the others are nan
+    """
+    if cells is None:
+      cells = range(self.numCells)
+    if (self._setDensities is not None) and (self._setDensities[0] == self.currentTime):
+      return [self._setDensities[1][c] if c in cells else float('nan') for c in range(self.numCells)]  # the rebuilt counts are linear between steps
+    counts = dict()
+    listofDensities = [float('nan')] * self.numCells
+    for c in cells:
+      for boundary in (c, c + 1):
+        if boundary not in counts:
+          counts[boundary] = self._cumulativeAt(boundary * self.cellLength)
+      listofDensities[c] = (counts[c] - counts[c + 1]) / self.densityLength
+    return listofDensities
+  
+  def setCellDensities(self, densities):
+    """
+    rebuilds the count history so that the reconstructed densities
+    match densities at currentTime: with V(x) the vehicles downstream
+    of x, the upstream count x/ffs ago is V(x) and the downstream
+    count (L-x)/bws ago is V(x) - jamDen*(L-x), so both of Newell's
+    branches give V(x) now and the congested cells (density above
+    critical) keep their queue, which spills back at bws as in CTM
+    """
+    now = self.currentTime
+    length = self.params['length']
+    vehicles = [density * self.densityLength for density in densities]
+    downstreamOf = [0.0] * (self.numCells + 1)  # vehicles downstream of the start of each cell
+    for c in range(self.numCells - 1, -1, -1):
+      downstreamOf[c] = downstreamOf[c + 1] + vehicles[c]
+    
+    def vehiclesDownstream(x):
+      x = min(max(x, 0.0), length)
+      cell = min(int(math.floor(x / self.cellLength)), self.numCells - 1)
+      return downstreamOf[cell + 1] + (cell + 1 - x / self.cellLength) * vehicles[cell]  # uniform density within a cell
+    
+    lookback = int(math.ceil(max(self._freeFlowSteps(), self._backwardWaveSteps()))) + 1
+    self._upstreamCounts = dict()
+    self._downstreamCounts = dict()
+    forwardStep = self.params['ffs'] * self.params['timeStep'] / 3600.0  # km travelled in free flow per step
+    backwardStep = self.params['bws'] * self.params['timeStep'] / 3600.0  # km travelled by the backward wave per step
+    for k in range(lookback + 1):
+      self._upstreamCounts[now - k] = vehiclesDownstream(k * forwardStep)
+      x = max(length - k * backwardStep, 0.0)
+      self._downstreamCounts[now - k] = vehiclesDownstream(x) - self.params['jamDen'] * (length - x)
+    self._historyStart = now - lookback
+    self._setDensities = (now, [float(density) for density in densities])
+    return None
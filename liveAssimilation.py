@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio ingestion of live (or replayed) observation feeds,
+records are bucketed into simulation steps and each completed
+step drives CTM propagation and EnKF assimilation
+
+a record is one line: timestamp;kind;cell;value
+timestamp in seconds, kind is 'density' (veh/km), cell is the
+global cell index between 0 and 40
+
+@author: cesny
+"""
+import asyncio
+import sys
+import time as clock
+import numpy as np
+from observationOperator import ObsOperator
+from utils import forwardCTMPropagation
+
+
+def parseRecord(line):
+  '''
+  returns (timestamp, kind, cell, value), None for
+  malformed lines
+  '''
+  data = line.strip().split(';')
+  if len(data) != 4:
+    return None
+  try:
+    return float(data[0]), data[1], int(data[2]), float(data[3])
+  except ValueError:
+    return None
+
+
+def formatRecord(timestamp, kind, cell, value):
+  '''
+  inverse of parseRecord
+  '''
+  return '%.3f;%s;%d;%.6f\n' % (timestamp, kind, cell, value)
+
+
+def recordsFromData(denData, timeStep=10):
+  '''
+  converts readData density output (dict of step: list over
+  cells) to a time ordered list of record lines, used to
+  build replay feeds from VISSIM files
+  '''
+  records = list()
+  for step in sorted(denData):
+    for cell, density in enumerate(denData[step]):
+      records.append(formatRecord(step * timeStep, 'density', cell, density))
+  return records
+
+
+async def readSocketFeed(host, port, queue):
+  '''
+  reads records from a TCP feed into queue, queue.put blocks
+  when the queue is full so a slow estimator stops reading and
+  TCP flow control pushes back on the feed
+  puts None when the feed closes
+  '''
+  reader, writer = await asyncio.open_connection(host, port)
+  try:
+    while True:
+      line = await reader.readline()
+      if not line:
+        break
+      record = parseRecord(line.decode())
+      if record is not None:
+        await queue.put(record)
+  finally:
+    writer.close()
+    await queue.put(None)
+  return None
+
+
+async def tailFileFeed(path, queue, pollInterval=0.5, stopAtEOF=False):
+  '''
+  follows a file that is being appended to (like tail -f) and
+  puts its records into queue, stops at EOF only if stopAtEOF
+  '''
+  with open(path) as feed:
+    buffered = ''
+    while True:
+      line = feed.readline()
+      if not line:
+        if stopAtEOF:
+          break
+        await asyncio.sleep(pollInterval)
+        continue
+      buffered += line
+      if not buffered.endswith('\n'):  # partial line, wait for the writer to finish it
+        continue
+      record = parseRecord(buffered)
+      buffered = ''
+      if record is not None:
+        await queue.put(record)
+  await queue.put(None)
+  return None
+
+
+class LiveAssimilation:
+  '''
+  consumes records from a queue, buckets them into simulation
+  steps and runs forwardCTMPropagation and EnKFStep once a step
+  is complete (i.e., a record of a later step arrives)
+  realTimeFactor is simulated seconds per wall clock second of
+  the feed, used to report lag behind real time
+  '''
+  def __init__(self, trafficNet, EnKFCTM, CTMensembles, timeStep=10, startTime=0.0, realTimeFactor=1.0, maxQueue=1000, onStep=None):
+    self.trafficNet = trafficNet
+    self.EnKFCTM = EnKFCTM
+    self.CTMensembles = CTMensembles
+    self.timeStep = timeStep
+    self.startTime = startTime  # feed timestamp of simulation step zero
+    self.realTimeFactor = realTimeFactor
+    self.queue = asyncio.Queue(maxsize=maxQueue)  # bounded, provides back-pressure
+    self.onStep = onStep  # optional callback(step, EnKFCTM) called after every step
+    self.step = 0  # next step to be processed
+    self.bucket = list()
+    self.lateRecords = 0  # records that arrived after their step was processed
+    self.lags = dict()  # step: seconds behind real time
+    self._wallStart = None
+
+  def processStep(self, step, records):
+    '''
+    propagates the ensembles over one step and assimilates the
+    step's density records, averaging repeated cells, steps with
+    no records are forecast only
+    '''
+    self.CTMensembles = forwardCTMPropagation(step, self.trafficNet, self.CTMensembles)
+    observed = dict()
+    for timestamp, kind, cell, value in records:
+      if kind == 'density':
+        observed.setdefault(cell, list()).append(value)
+    if len(observed) == 0:
+      self.EnKFCTM.createLocToCell()
+      self.EnKFCTM.addModelNoise(self.CTMensembles)
+      self.EnKFCTM.getPriorDist()
+      self.CTMensembles = self.EnKFCTM.getUpdatedEnsembles()
+      return None
+    cells = sorted(observed)
+    self.EnKFCTM.H = ObsOperator(cells, self.EnKFCTM.stateDim)
+    self.EnKFCTM.obsDim = len(cells)
+    observations = [float(np.mean(observed[cell])) for cell in cells]
+    self.CTMensembles = self.EnKFCTM.EnKFStep(self.CTMensembles, observations)
+    return None
+
+  def reportLag(self, step):
+    '''
+    step data is complete at (step+1)*timeStep feed seconds,
+    lag is how long after that (in wall clock) processing ended
+    '''
+    due = self._wallStart + (step + 1) * self.timeStep / self.realTimeFactor
+    lag = clock.monotonic() - due
+    self.lags[step] = lag
+    if lag > self.timeStep / self.realTimeFactor:
+      print('... step %d processed %.2f s behind real time, queue size %d ...' % (step, lag, self.queue.qsize()))
+    return lag
+
+  async def _flush(self, untilStep):
+    '''
+    processes all steps before untilStep, the heavy work runs
+    in an executor so the feed keeps being read meanwhile
+    '''
+    loop = asyncio.get_running_loop()
+    while self.step < untilStep:
+      records, self.bucket = self.bucket, list()
+      await loop.run_in_executor(None, self.processStep, self.step, records)
+      self.reportLag(self.step)
+      if self.onStep is not None:
+        self.onStep(self.step, self.EnKFCTM)
+      self.step += 1
+    return None
+
+  async def consume(self):
+    '''
+    consumes the queue until a None record is received
+    '''
+    self._wallStart = clock.monotonic()
+    while True:
+      record = await self.queue.get()
+      if record is None:
+        if len(self.bucket) > 0:
+          await self._flush(self.step + 1)
+        break
+      recordStep = int((record[0] - self.startTime) // self.timeStep)
+      if recordStep < self.step:
+        self.lateRecords += 1
+        continue
+      await self._flush(recordStep)
+      self.bucket.append(record)
+    return self.CTMensembles
+
+  async def runSocket(self, host, port):
+    '''
+    runs the estimator against a TCP feed
+    '''
+    producer = asyncio.ensure_future(readSocketFeed(host, port, self.queue))
+    ensembles = await self.consume()
+    await producer
+    return ensembles
+
+  async def runFile(self, path, pollInterval=0.5, stopAtEOF=False):
+    '''
+    runs the estimator against a tailed file
+    '''
+    producer = asyncio.ensure_future(tailFileFeed(path, self.queue, pollInterval, stopAtEOF))
+    ensembles = await self.consume()
+    await producer
+    return ensembles
+
+
+async def serveReplay(records, host, port, timeStep=10, realTimeFactor=1.0):
+  '''
+  serves record lines to the first client that connects,
+  records are paced by their timestamps, closes after the
+  last record
+  '''
+  done = asyncio.Event()
+
+  async def handle(reader, writer):
+    wallStart = clock.monotonic()
+    firstTimestamp = None
+    for line in records:
+      record = parseRecord(line)
+      if record is None:
+        continue
+      if firstTimestamp is None:
+        firstTimestamp = record[0]
+      due = wallStart + (record[0] - firstTimestamp) / realTimeFactor
+      delay = due - clock.monotonic()
+      if delay > 0:
+        await asyncio.sleep(delay)
+      writer.write(line.encode())
+      await writer.drain()  # waits when the consumer is not reading, i.e., back-pressure
+    writer.close()
+    done.set()
+
+  server = await asyncio.start_server(handle, host, port)
+  async with server:
+    await done.wait()
+  return None
+
+
+def runReplayProcess(recordfile, host, port, timeStep=10, realTimeFactor=1.0):
+  '''
+  entry point for a local replay process
+  '''
+  with open(recordfile) as rf:
+    records = rf.readlines()
+  asyncio.run(serveReplay(records, host, port, timeStep, realTimeFactor))
+  return None
+
+
+if __name__ == '__main__':
+  from network import Network
+  from EnKF import EnKF
+  from utils import CTMcreateInitialEnsemble
+  host = '127.0.0.1'
+  port = 9050
+  simTime = 4490
+  simTimeStep = 10
+  realTimeFactor = 10.0  # replay ten times faster than real time
+  recordfile = 'data/liveRecords.txt'
+  if len(sys.argv) > 1 and sys.argv[1] == 'replay':
+    runReplayProcess(recordfile, host, port, simTimeStep, realTimeFactor)
+  else:
+    linkfile = 'VISSIMnetwork/links.txt'
+    nodefile = 'VISSIMnetwork/nodes.txt'
+    demandfile = 'VISSIMnetwork/demand6600.txt'
+    trafficNet = Network(simTime, simTimeStep, nodefile, linkfile, demandfile)
+    CTMstateDim = 40
+    CTMensembles = 100
+    EnKFCTM = EnKF(obsError=10, modelError=5, sampleSize=CTMensembles, stateDim=CTMstateDim, obsDim=CTMstateDim, droneLoc=(5,0), trafficNet=trafficNet, droneDenObsError=2)
+    ensembles = CTMcreateInitialEnsemble(CTMstateDim, CTMensembles, 5)
+    estimator = LiveAssimilation(trafficNet, EnKFCTM, ensembles, timeStep=simTimeStep, realTimeFactor=realTimeFactor,
+                                 onStep=lambda step, enkf: print('step: ', step, 'mean density: ', np.mean(enkf.mean)))
+    asyncio.run(estimator.runSocket(host, port))
+    print('late records: ', estimator.lateRecords, 'max lag: ', max(estimator.lags.values()))
@@ -7,13 +7,36 @@ primary UAV navigation and estimation framework
 
 from network import Network
 import numpy as np
-from EnKF import EnKF
+from EnKF import EnKF, AssimilationWindow
 import copy as cp
 import matplotlib.pyplot as plt
-from findPath import findPath
-from utils import readData, setCTMVehicles, forwardCTMPropagation, CTMcreateInitialEnsemble, VmaxCreateInitialEnsemble, m, VmaxtoCritDen, createLocToCell, cellToLength, lengthToCell
+from concurrent.futures import ProcessPoolExecutor
+from findPath import findPath, planLocation
+from utils import readData, setCTMVehicles, forwardCTMPropagation, CTMcreateInitialEnsemble, VmaxCreateInitialEnsemble, m, VmaxtoCritDen, VmaxMemberParameters, createLocToCell, cellToLength, lengthToCell
+from randomStreams import spawnGenerators
+from observationOperator import ObsOperator
+from memoryReport import MemoryReport
+from plannerReplay import saveSnapshot
+from plannerCache import DecisionCache
+from superObs import SuperObservations
+from ensembleWorkers import EnsembleCoordinator
 
  
+def moveUAV(plan, EnKFCTM, EnKFV):
+  '''
+  applies a planLocation result, updates the UAV
+  location in both filters and returns it
+  '''
+  droneLocation, completed, rolloutSteps = plan
+  if not completed:
+    print('planning cut off by deadline after rollout steps: ', rolloutSteps)
+  EnKFCTM.droneLoc = droneLocation  # update UAV loc. in CTM EnKF
+  EnKFV.droneLoc = droneLocation  # update UAV loc. in uf EnKF
+  print(' ')
+  print(' ... ')
+  print('drone currently at: ', droneLocation)
+  return droneLocation
+
 
 if __name__ == '__main__':
   # create traffic network
@@ -24,32 +47,58 @@ if __name__ == '__main__':
   nodefile = 'VISSIMnetwork/nodes.txt'
   demandfile = 'VISSIMnetwork/demand6600.txt'
   trafficNet = Network(simTime, simTimeStep, nodefile, linkfile, demandfile)
+  activeSetTolerance = None  # e.g. 1e-6 veh, every member skips the cell pairs whose cells did not change (EnsembleCTM.setActiveSet)
+  if activeSetTolerance is not None:
+    trafficNet.enableActiveSet(activeSetTolerance)
+  propagate = forwardCTMPropagation  # local propagation, replaced by the coordinator when ensembleWorkers are given below
   LocToCell = createLocToCell(trafficNet)
   # laod data observations from VISSIM
-  denData, spData = readData('data/model_001_Link Segment Results-6600.att')
+  denData, spData = readData('data/model_001_Link Segment Results-6600.att', trafficNet.getGeometry())  # VISSIM segments mapped to cells by the corridor geometry
   
   # true incident Vf
   trueVf=20.0
   
   # UAV path planning weight lambda
   pathWeight=1.0
+  planningScoring = 'ensemble'  # 'expected' scores paths with the closed form covariance update instead of EnKF rollouts
+  pipelinePlanning = False  # plan in a background process while the next step is propagated
+  planningHorizon = None  # e.g. 10, rollout steps per path, cells beyond it are valued by a terminal estimate, None runs to the corridor edge
+  planningDeadline = None  # wall clock budget for planning in seconds (e.g., 10.0 for the UAV control period), None runs full rollouts
+  memoryInterval = None  # e.g. 30, samples memory of the filters, network and planner every that many steps
+  memoryFile = 'memoryReport.txt'  # tab delimited time series of the memory samples
+  recordSnapshots = None  # e.g. 'snapshots', directory for per step planner inputs replayed by plannerReplay.py
+  ensembleWorkers = None  # e.g. [('node01', 5000), ('node02', 5000)], hosts running ensembleWorkers.py that propagate the CTM members
+  decisionCacheFile = None  # e.g. 'decisionCache.pkl', planner decisions reused across runs of the same scenario (not with pipelinePlanning)
   
   # set initial UAV location, link 5 cell 0
   droneLocation = (5,0)
   
+  # random streams, one per filter, one for the initial ensembles and one for planner rollouts
+  seed = 2018
+  noiseBlockSize = 100000  # noise is pre-generated in blocks of this many values, None draws every step
+  CTMrng, Vrng, initRng, plannerRng = spawnGenerators(seed, 4)
+  
   # specify parameters for CTM-EnKF
   totalcells = 0
   for linkID in trafficNet.linkDict:
     if linkID is not 9:
       totalcells += trafficNet.linkDict[linkID].numCells
-  HCTM = np.array(np.identity(totalcells).tolist())
+  HCTM = ObsOperator(range(totalcells), totalcells)  # every cell is observed, loop detectors would list only their cells
   CTMobsSTDV = 10  # standard deviation veh/km
   CTMdrObsSTDV = 2 # standard deviaiton veh/km of drone observations
   CTMmodSTDV = 5  # standard deviation veh/km
   CTMstateDim = 40  # 40 cells with monitored densities
   CTMobsDim = 40  # 40 cells with monitored densities
   CTMensembles = 100  # number of ensembles in EnKF
-  EnKFCTM = EnKF(obsError=CTMobsSTDV, modelError=CTMmodSTDV, sampleSize=CTMensembles, stateDim=CTMstateDim, obsDim=CTMobsDim, H=HCTM, droneLoc=droneLocation, trafficNet=trafficNet, droneDenObsError=CTMdrObsSTDV)
+  CTMEnKFtype = 'CTM'  # 'CTM-ETKF' for the deterministic square root filter, allows smaller ensembles
+  maxObservations = None  # e.g. 20, readings are combined per cell into super-observations and thinned to this many per step (dense feeds)
+  assimilationWindow = None  # e.g. 6, time steps (60 s) of observations stacked into one CTM analysis, None assimilates every step
+  adaptiveEnsembles = False  # grow/shrink the CTM ensemble at run time based on spread and innovations
+  EnKFCTM = EnKF(obsError=CTMobsSTDV, modelError=CTMmodSTDV, sampleSize=CTMensembles, stateDim=CTMstateDim, obsDim=CTMobsDim, H=HCTM, EnKFtype=CTMEnKFtype, droneLoc=droneLocation, trafficNet=trafficNet, droneDenObsError=CTMdrObsSTDV, rng=CTMrng, noiseBlockSize=noiseBlockSize)
+  CTMwindow = AssimilationWindow(assimilationWindow) if assimilationWindow is not None else None
+  superObs = SuperObservations(CTMstateDim, maxObs=maxObservations) if maxObservations is not None else None
+  if adaptiveEnsembles:
+    EnKFCTM.enableAdaptiveSize(minSize=20 if EnKFCTM.isSquareRoot() else CTMobsDim + 1, maxSize=CTMensembles)  # the stochastic filter samples R, keep it full rank
   
   # specify parameters for velocity EnKF when velocities are observed
   VobsSTDV = 5 # obs standard deviation!
@@ -57,15 +106,18 @@ if __name__ == '__main__':
   VstateDim = 2  # two incident prone regions
   VobsDimV = 2  # observing velocities on those two regions
   Vensembles = 100  # number of ensembles in EnKF
-  EnKFV = EnKF(obsError=VobsSTDV, modelError=VmodSTDV, sampleSize=Vensembles, stateDim=VstateDim, obsDim=VobsDimV, m=m, assimilatedDensities=[0,0], EnKFtype='Vmax', nonLinearObs=True, droneLoc=droneLocation, trafficNet=trafficNet)
+  perMemberVmax = True  # propagate CTM member i with vmax member i instead of writing the vmax mean into the links, False for the split CTM/Vmax workflow
+  if perMemberVmax and (adaptiveEnsembles or (Vensembles != CTMensembles)):
+    raise Exception('... perMemberVmax needs Vensembles == CTMensembles and a fixed ensemble size (adaptiveEnsembles False) ...')
+  EnKFV = EnKF(obsError=VobsSTDV, modelError=VmodSTDV, sampleSize=Vensembles, stateDim=VstateDim, obsDim=VobsDimV, m=m, assimilatedDensities=[0,0], EnKFtype='Vmax', nonLinearObs=True, droneLoc=droneLocation, trafficNet=trafficNet, rng=Vrng, noiseBlockSize=noiseBlockSize)
   
   # specify parameters for velocity EnKF when we obtain direct uf observations
   VdrObsSTDV = 10  # error of observing the true uf value
   VobsDimVf = 1  # when the drone observes it only does so at one location
   
   # creates initial ensembles
-  CTMensembles = CTMcreateInitialEnsemble(CTMstateDim, CTMensembles, CTMmodSTDV)
-  VmaxEnsembles = VmaxCreateInitialEnsemble(VstateDim,Vensembles,VmodSTDV)
+  CTMensembles = CTMcreateInitialEnsemble(CTMstateDim, CTMensembles, CTMmodSTDV, rng=initRng)
+  VmaxEnsembles = VmaxCreateInitialEnsemble(VstateDim,Vensembles,VmodSTDV, rng=initRng)
   
   # store data
   firstIncidentDen = list()
@@ -84,9 +136,30 @@ if __name__ == '__main__':
   droneLocKm=list()
   
   # simulate
+  memory = MemoryReport(memoryInterval) if memoryInterval is not None else None
+  planner = ProcessPoolExecutor(max_workers=1) if pipelinePlanning else None
+  decisionCache = DecisionCache(path=decisionCacheFile) if (decisionCacheFile is not None) and not pipelinePlanning else None  # the planner process would fill its own copy
+  coordinator = None
+  if ensembleWorkers is not None:
+    coordinator = EnsembleCoordinator(ensembleWorkers, (simTime, simTimeStep, nodefile, linkfile, demandfile))
+    propagate = coordinator.forwardCTMPropagation
+  pendingPlan = None  # planner running in the background, joined before the assimilation that needs the UAV location
   for time in totalTimeSteps:  # cell indices 6 and 32 for inc1 and inc2, respectively (i.e., those are the incident prone locations)
-    CTMensembles = forwardCTMPropagation(time, trafficNet, CTMensembles)  # propagate ensembles using CTM
-    CTMensembles = EnKFCTM.EnKFStep(CTMensembles, denData[time])  # data assimilation, get updated density ensembles from EnKF
+    memberParams = VmaxMemberParameters(VmaxEnsembles) if perMemberVmax else None
+    CTMensembles = propagate(time, trafficNet, CTMensembles, memberParams)  # propagate ensembles using CTM
+    if pendingPlan is not None:
+      droneLocation = moveUAV(pendingPlan.result(), EnKFCTM, EnKFV)
+      storeDroneLocation.append(droneLocation)
+      droneLocCell.append(LocToCell[droneLocation])
+      pendingPlan = None
+    if superObs is not None:  # the readings of the step, one per observed cell here, plus the drone reading of its cell
+      droneCell = LocToCell[droneLocation]
+      CTMensembles = superObs.assimilate(EnKFCTM, CTMensembles, HCTM.cells, denData[time], CTMobsSTDV**2, window=CTMwindow, flush=(time == totalTimeSteps[-1]),
+                                         droneReading=(droneCell, denData[time][droneCell], CTMdrObsSTDV**2))
+    elif CTMwindow is not None:  # propagate only, one analysis every assimilationWindow steps
+      CTMensembles = EnKFCTM.windowStep(CTMensembles, denData[time], CTMwindow, flush=(time == totalTimeSteps[-1]))
+    else:
+      CTMensembles = EnKFCTM.EnKFStep(CTMensembles, denData[time])  # data assimilation, get updated density ensembles from EnKF
     firstIncidentDen.append(EnKFCTM.mean[6])  # add best estimate of den in incident location to list
     secIncidentDen.append(EnKFCTM.mean[32])
     storeDenTotal.append(EnKFCTM.mean)
@@ -109,7 +182,8 @@ if __name__ == '__main__':
       Vmax2Estimated.append(EnKFV.mean[1])
       critDenEstimated.append(VmaxtoCritDen(EnKFV.mean))
       # update traffic parameters
-      trafficNet.updateVmaxCritDen(EnKFV.mean, VmaxtoCritDen(EnKFV.mean))  # Now the parameters are updates for the links of interest at the locations of interest
+      if not perMemberVmax:
+        trafficNet.updateVmaxCritDen(EnKFV.mean, VmaxtoCritDen(EnKFV.mean))  # Now the parameters are updates for the links of interest at the locations of interest
       # store objective
       Vobj = np.trace(EnKFV.getP())
       print('post velocity trace: ', EnKFV.getP())
@@ -121,9 +195,9 @@ if __name__ == '__main__':
       VmaxlistofTime.append(time)
       EnKFV.nonLinearObs = False  # linear relationship when drone at incident location (direct uf observation)
       if droneLocation[0] == 2:
-        EnKFV.H = np.array([[1.0, 0.0]])
+        EnKFV.H = ObsOperator([0], VstateDim)
       if droneLocation[0] == 7:
-        EnKFV.H = np.array([[0.0, 1.0]])
+        EnKFV.H = ObsOperator([1], VstateDim)
       # adjust observations
       EnKFV.obsError = VdrObsSTDV
       EnKFV.obsDim = VobsDimVf
@@ -134,11 +208,12 @@ if __name__ == '__main__':
       Vmax2Estimated.append(EnKFV.mean[1])
       critDenEstimated.append(VmaxtoCritDen(EnKFV.mean))
       # update traffic parameters
-      trafficNet.updateVmaxCritDen(EnKFV.mean, VmaxtoCritDen(EnKFV.mean))  # Now the parameters are updates for the links of interest at the locations of interest
+      if not perMemberVmax:
+        trafficNet.updateVmaxCritDen(EnKFV.mean, VmaxtoCritDen(EnKFV.mean))  # Now the parameters are updates for the links of interest at the locations of interest
       # store objective
       Vobj = np.trace(EnKFV.getP())
       print('drone uf obs. at: ', droneLocation, EnKFV.getP())
-      print('updated ensembles: ', droneLocation, np.transpose(np.array(VmaxEnsembles))[:,0:3])
+      print('updated ensembles: ', droneLocation, np.transpose(VmaxEnsembles)[:,0:3])
       print(' ')
       velObj.append(Vobj)  # store the variation in the trace of the EnKF-V (uf)
     
@@ -146,18 +221,43 @@ if __name__ == '__main__':
     obj= (pathWeight * np.trace(EnKFV.getP()) / 2.0) + ((1-pathWeight) * np.trace(EnKFCTM.getP()) / 40.0)  # path planning objective
     objective.append(obj)
     # update the UAV location and update filters
-    print('pre-find path ensembles: ', np.transpose(np.array(VmaxEnsembles))[:,0:3])  # sanity check
-    explorePath = findPath(location=droneLocation, time=time, trafficNet=cp.deepcopy(trafficNet), EnKFCTM=cp.deepcopy(EnKFCTM), EnKFV=cp.deepcopy(EnKFV), weight=pathWeight)
-    droneLocation = explorePath.updateLocation()
-    print('post-find path ensembles: ', np.transpose(np.array(VmaxEnsembles))[:,0:3])  # sanity check
-    print('post-find path ensembles from EnKF: ', np.transpose(np.array(EnKFV.getUpdatedEnsembles()))[:,0:3])  # sanity check
-    EnKFCTM.droneLoc = droneLocation  # update UAV loc. in CTM EnKF
-    EnKFV.droneLoc = droneLocation  # update UAV loc. in uf EnKF
-    print(' ')
-    print(' ... ')
-    print('drone currently at: ', droneLocation)
+    print('pre-find path ensembles: ', np.transpose(VmaxEnsembles)[:,0:3])  # sanity check
+    stepRng = plannerRng.spawn(1)[0]
+    if recordSnapshots is not None:
+      saveSnapshot(recordSnapshots, time, EnKFCTM, EnKFV, trafficNet, droneLocation, stepRng)
+    plannerArgs = dict(location=droneLocation, time=time, trafficNet=cp.deepcopy(trafficNet), EnKFCTM=cp.deepcopy(EnKFCTM), EnKFV=cp.deepcopy(EnKFV), weight=pathWeight, timeHorizon=planningHorizon, rng=stepRng, deadline=planningDeadline, scoring=planningScoring, memberParams=VmaxMemberParameters(VmaxEnsembles) if perMemberVmax else None, assimilationWindow=assimilationWindow, cache=decisionCache)
+    if memory is not None:
+      memory.sample(time, EnKFCTM=EnKFCTM, EnKFV=EnKFV, trafficNet=trafficNet, CTMensembles=CTMensembles,
+                    results=[firstIncidentDen, secIncidentDen, storeDenTotal, objective, velObj, storeDenInc])
+    if pipelinePlanning:
+      if memory is not None:
+        memory.sample(time, plannerArgs=plannerArgs)  # copies sent to the planner process, its own peak is not traced here
+      pendingPlan = planner.submit(planLocation, **plannerArgs)  # works on copies, overlaps with the next propagation
+      continue
+    if memory is not None:
+      droneLocation = moveUAV(memory.measureCall(time, 'findPath', planLocation, kwargs=plannerArgs), EnKFCTM, EnKFV)
+    else:
+      droneLocation = moveUAV(planLocation(**plannerArgs), EnKFCTM, EnKFV)
+    print('post-find path ensembles: ', np.transpose(VmaxEnsembles)[:,0:3])  # sanity check
+    print('post-find path ensembles from EnKF: ', np.transpose(EnKFV.getUpdatedEnsembles())[:,0:3])  # sanity check
+    storeDroneLocation.append(droneLocation)
+    droneLocCell.append(LocToCell[droneLocation])
+  
+  if pendingPlan is not None:  # plan made after the last step
+    droneLocation = moveUAV(pendingPlan.result(), EnKFCTM, EnKFV)
     storeDroneLocation.append(droneLocation)
     droneLocCell.append(LocToCell[droneLocation])
+  if planner is not None:
+    planner.shutdown()
+  if coordinator is not None:
+    coordinator.close()
+  if decisionCache is not None:
+    decisionCache.save()
+    print('planner cache hit rate: ', decisionCache.hitRate())
+  if memory is not None:
+    memory.write(memoryFile)
+    print('largest allocations: ', memory.topAllocations(5))
+    memory.stop()
 
   # determine position of UAV in km from start of road
   droneLocKm.append(cellToLength(storeDroneLocation, trafficNet))
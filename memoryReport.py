@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+opt-in memory accounting, explicit deep sizes of the EnKF
+instances, the network and the planner inputs plus tracemalloc
+totals, sampled every few steps and written as a time series
+
+@author: cesny
+"""
+import sys
+import tracemalloc
+import numpy as np
+
+
+def sizeOf(obj, exclude=(), seen=None):
+  '''
+  deep size in bytes of obj, follows containers and object
+  attributes, ndarrays count their data buffer once, objects
+  in exclude (and what only they reference) are not counted
+  '''
+  if seen is None:
+    seen = set(id(item) for item in exclude)
+  if id(obj) in seen:
+    return 0
+  seen.add(id(obj))
+  if isinstance(obj, np.ndarray):
+    size = sys.getsizeof(obj)
+    if obj.base is not None:  # a view, count the buffer of its base instead
+      size += sizeOf(obj.base, exclude, seen)
+    return size
+  size = sys.getsizeof(obj)
+  if isinstance(obj, (str, bytes, int, float, complex, bool)) or obj is None:
+    return size
+  if isinstance(obj, dict):
+    for key, value in obj.items():
+      size += sizeOf(key, exclude, seen) + sizeOf(value, exclude, seen)
+  elif isinstance(obj, (list, tuple, set, frozenset)):
+    for item in obj:
+      size += sizeOf(item, exclude, seen)
+  if hasattr(obj, '__dict__') and not isinstance(obj, type):
+    size += sizeOf(vars(obj), exclude, seen)
+  return size
+
+
+def enkfMemory(EnKFinstance):
+  '''
+  bytes held by an EnKF per attribute (e.g., the store lists),
+  the shared network is not counted and arrays referenced by
+  several attributes are counted once, in the first one
+  '''
+  accounts = dict()
+  seen = set([id(EnKFinstance.trafficNet)])
+  for name, value in vars(EnKFinstance).items():
+    if name != 'trafficNet':
+      accounts[name] = sizeOf(value, seen=seen)
+  return accounts
+
+
+def networkMemory(trafficNet):
+  '''
+  bytes held by the network split into cells (CTM cells, LTM
+  counts), link counts, demand and the rest (engine, geometry)
+  '''
+  accounts = {'cells': 0, 'counts': 0, 'demand': 0, 'other': 0}
+  seen = set()
+  for linkID in trafficNet.linkDict:
+    link = trafficNet.linkDict[linkID]
+    accounts['counts'] += sizeOf(link._upstreamCounts, seen=seen) + sizeOf(link._downstreamCounts, seen=seen)
+    if hasattr(link, 'cells'):
+      accounts['cells'] += sizeOf(link.cells, seen=seen)
+  for nodeID in trafficNet.nodeDict:
+    node = trafficNet.nodeDict[nodeID]
+    if hasattr(node, 'demandRates'):
+      accounts['demand'] += sizeOf(node.demandRates, seen=seen)
+  accounts['other'] = sizeOf(trafficNet, seen=seen)  # links, nodes and attributes not counted above
+  return accounts
+
+
+class MemoryReport:
+  '''
+  samples memory every interval time steps, objects are given
+  by name to sample (e.g., EnKFCTM=EnKFCTM, trafficNet=trafficNet)
+  and accounted according to their type, planning calls are
+  measured with measureCall
+  '''
+  def __init__(self, interval=10, trace=True):
+    self.interval = interval
+    self.trace = trace  # tracemalloc slows down the run, explicit accounting still works without it
+    self.samples = list()  # (time, name, bytes)
+    if self.trace and not tracemalloc.is_tracing():
+      tracemalloc.start()
+
+  def isSampled(self, time):
+    return time % self.interval == 0
+
+  def _record(self, time, name, accounts):
+    for account in sorted(accounts):
+      self.samples.append((time, name + '.' + account, accounts[account]))
+    self.samples.append((time, name, sum(accounts.values())))
+    return None
+
+  def sample(self, time, **objects):
+    '''
+    records the accounts of the given objects and the traced
+    totals if time is a sampling step
+    '''
+    if not self.isSampled(time):
+      return None
+    for name in objects:
+      obj = objects[name]
+      if hasattr(obj, 'EnKFtype'):
+        self._record(time, name, enkfMemory(obj))
+      elif hasattr(obj, 'linkDict'):
+        self._record(time, name, networkMemory(obj))
+      else:
+        self.samples.append((time, name, sizeOf(obj)))
+    if self.trace:
+      current, peak = tracemalloc.get_traced_memory()
+      self.samples.append((time, 'traced.current', current))
+      self.samples.append((time, 'traced.peak', peak))
+    return None
+
+  def measureCall(self, time, name, func, args=(), kwargs=None):
+    '''
+    calls func(*args, **kwargs), on sampling steps records the deep size of its
+    arguments (e.g., the planner deepcopies) and the traced peak
+    during the call above the memory in use before it
+    '''
+    if kwargs is None:
+      kwargs = dict()
+    if not self.isSampled(time):
+      return func(*args, **kwargs)
+    self.samples.append((time, name + '.arguments', sizeOf((args, kwargs))))
+    if not self.trace:
+      return func(*args, **kwargs)
+    before = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    result = func(*args, **kwargs)
+    self.samples.append((time, name + '.peak', tracemalloc.get_traced_memory()[1] - before))
+    return result
+
+  def topAllocations(self, limit=10):
+    '''
+    source lines holding the most traced memory
+    '''
+    if not self.trace:
+      return list()
+    snapshot = tracemalloc.take_snapshot()
+    return [str(stat) for stat in snapshot.statistics('lineno')[:limit]]
+
+  def write(self, path):
+    '''
+    writes the samples as a tab delimited time series
+    '''
+    with open(path, 'w') as rf:
+      rf.write('time\taccount\tbytes\n')
+      for time, name, size in self.samples:
+        rf.write('%d\t%s\t%d\n' % (time, name, size))
+    return None
+
+  def stop(self):
+    if self.trace and tracemalloc.is_tracing():
+      tracemalloc.stop()
+    return None
@@ -9,6 +9,8 @@ including network loading
 import nodeModel
 import linkModel
 import numpy as np
+from ensembleCTM import EnsembleCTM
+from corridorGeometry import CorridorGeometry
 
 '''
 simulation parameters used in VISSIM model
@@ -52,6 +54,10 @@ class Network:
     self.ODs = dict()  # create an OD dictionary, each OD is a class that stores demand
     self.nodeDict = dict()  # dictionary of nodes
     self.linkDict = dict()  # dictionary of links
+    self.ensembleEngine = None  # batched ensemble propagation, created on first use
+    self.geometry = None  # corridor geometry index, created on first use
+    self.reportedCells = None  # cells whose densities loadNetworkStep reconstructs on LTM links, None for all
+    self.activeSet = None  # (tolerance, recheckInterval) of enableActiveSet, also given to the ensemble engine
     self._setupNetwork(nodefile, linkfile, demandfile)
   
   def _setupNetwork(self, nodefile, linkfile, demandfile):
@@ -70,9 +76,71 @@ class Network:
     """
     self.linkDict[2].updateVmaxCritDen(newVmaxlist[0], newCritDenlist[0])
     self.linkDict[7].updateVmaxCritDen(newVmaxlist[1], newCritDenlist[1])
+    self.ensembleEngine = None  # the engine copies capacities and deltas, rebuild it with the new ones
     return None
   
   
+  def getEnsembleEngine(self):
+    """
+    returns the batched CTM engine used to propagate all ensemble
+    members at once (e.g., with per member parameters)
+    """
+    if self.ensembleEngine is None:
+      self.ensembleEngine = EnsembleCTM(self)
+      if self.activeSet is not None:
+        self.ensembleEngine.setActiveSet(*self.activeSet)
+    return self.ensembleEngine
+  
+  def getGeometry(self):
+    """
+    returns the corridor geometry index (km, cell and (link, cell)
+    lookups), link lengths and numCells do not change during a run
+    """
+    if self.geometry is None:
+      self.geometry = CorridorGeometry(self)
+    return self.geometry
+  
+  def enableActiveSet(self, tolerance=1e-6, recheckInterval=10):
+    """
+    switches all CTM links to the active set update, only cells
+    that changed (and their neighbours) are recomputed each step,
+    see CTM.setActiveSet, the ensemble engine does the same for
+    every member (EnsembleCTM.setActiveSet)
+    """
+    for linkID in self.linkDict:
+      link = self.linkDict[linkID]
+      if link.params['linkType'] == 'CTM':
+        link.setActiveSet(tolerance, recheckInterval)
+    self.activeSet = (tolerance, recheckInterval) if tolerance is not None else None
+    if self.ensembleEngine is not None:
+      self.ensembleEngine.setActiveSet(tolerance, recheckInterval)
+    return None
+  
+  def setCoarseCells(self, linkSpans):
+    """
+    linkSpans is a dict linkID: span, merges every span cells of
+    the link into one coarse cell (e.g., links far from the UAV
+    and detectors), densities are still reported on the fine cells
+    """
+    for linkID in linkSpans:
+      link = self.linkDict[linkID]
+      if link.params['linkType'] != 'CTM':
+        raise Exception('... coarse cells are only available for CTM links, link ' + str(linkID) + ' ...')
+      link.setCoarseCells(linkSpans[linkID])
+    self.ensembleEngine = None
+    return None
+  
+  def setReportedCells(self, cells=None):
+    """
+    cells are indices into the densities array of loadNetworkStep
+    (e.g., the detector and drone cells of a loading run), LTM links
+    only reconstruct these and report nan in the others, CTM links
+    report every cell, None reports all cells (needed by the EnKF
+    propagation, which resets every cell of a member)
+    """
+    self.reportedCells = None if cells is None else set(int(cell) for cell in cells)
+    return None
+  
   def readNodes(self, nfile):
     """
     reads node file, returns None
@@ -190,35 +258,76 @@ class Network:
   def loadNetworkStep(self, time):
     """
     implements the network loading algorithm for one time step
-    and returns the densities on the cells
+    and returns the densities on the cells as an array, and a
+    list of per link views into that array
     """
     for nodeID in self.nodeDict:
       self.nodeDict[nodeID].nodeUpdate(time, self.timeStep)
     for linkID in self.linkDict:
       self.linkDict[linkID].linkUpdate(time + 1)
     
-    linkDensities = list()
+    reportedLinks = [self.linkDict[linkID] for linkID in self.linkDict if linkID != 9]
+    linkDensities = np.empty(sum(link.numCells for link in reportedLinks))
     listofLinkDensities = list()
-    for linkID in self.linkDict:
-      if linkID is not 9:
-        listofDensitiesPerLink = self.linkDict[linkID].linkDensity()
-        listofLinkDensities.append(listofDensitiesPerLink)
-        for linkdenval in listofDensitiesPerLink:
-          linkDensities.append(linkdenval)
+    index = 0
+    for link in reportedLinks:
+      if (self.reportedCells is not None) and (link.params['linkType'] == 'LTM'):
+        cells = [c for c in range(link.numCells) if index + c in self.reportedCells]
+        linkDensities[index:index + link.numCells] = link.linkDensity(cells=cells)
+      else:
+        linkDensities[index:index + link.numCells] = link.linkDensity()
+      listofLinkDensities.append(linkDensities[index:index + link.numCells])
+      index += link.numCells
     return linkDensities, listofLinkDensities
   
-  def networkLoading(self):
+  def networkLoading(self, mode='dict', outFile=None):
     """
     the full network loading algorithm, returns dictionary of
     dictionaries where outer keys are time, inner key is link, and value
     is the densities on the cells
+    mode 'generator' yields (time, densities) one step at a time,
+    mode 'array' fills a preallocated (time x cells) array, memory
+    mapped to the .npy file outFile if given, nothing is kept in
+    netLoadingResults in these modes
     """
+    if mode == 'generator':
+      return self.iterNetworkLoading()
+    if mode == 'array':
+      return self.arrayNetworkLoading(outFile)
+    if mode != 'dict':
+      raise Exception('... unknown network loading mode ' + str(mode) + ' ...')
     self.netLoadingResults = dict()
     for time in self.totalTimesteps:
       self.netLoadingResults[time] = self.loadNetworkStep(time)
       
     return self.netLoadingResults
   
+  def iterNetworkLoading(self):
+    """
+    generator over the network loading, yields the time and
+    the densities array of every step
+    """
+    for time in self.totalTimesteps:
+      yield time, self.loadNetworkStep(time)[0]
+  
+  def arrayNetworkLoading(self, outFile=None):
+    """
+    network loading into a (time x cells) array, row t holds the
+    densities after loading step t, with outFile the array is a
+    memory map of a .npy file flushed at the end
+    """
+    numCells = sum(self.linkDict[linkID].numCells for linkID in self.linkDict if linkID != 9)
+    shape = (len(self.totalTimesteps), numCells)
+    if outFile is not None:
+      results = np.lib.format.open_memmap(outFile, mode='w+', dtype=float, shape=shape)
+    else:
+      results = np.empty(shape)
+    for row, (time, densities) in enumerate(self.iterNetworkLoading()):
+      results[row] = densities
+    if outFile is not None:
+      results.flush()
+    return results
+  
   def resetCounts(self):
     for linkID in self.linkDict:
       link = self.linkDict[linkID]
@@ -236,5 +345,28 @@ if __name__ == '__main__':
     nodefile = 'VISSIMnetwork/nodes.txt'
     demandfile = 'VISSIMnetwork/demand6600.txt'
     trafficNet = Network(simTime, simTimeStep, nodefile, linkfile, demandfile)
-    results=trafficNet.networkLoading()
-    print(results)
\ No newline at end of file
+    activeSetTolerance = None  # e.g. 1e-6 veh, skips cells in steady state
+    coarseLinks = dict()  # linkID: span, e.g. {1: 5, 8: 5} for the corridor ends, span has to divide numCells
+    trafficNet.setCoarseCells(coarseLinks)
+    if len(coarseLinks) > 0:  # identical ensemble members have to stay identical with coarse cells
+      from utils import forwardCTMPropagation
+      checkNet = Network(simTime, simTimeStep, nodefile, linkfile, demandfile)
+      checkNet.setCoarseCells(coarseLinks)
+      members = np.tile(np.linspace(10.0, 150.0, len(checkNet.getEnsembleEngine().reportCells)), (3, 1))
+      for time in range(2 * max(coarseLinks.values())):
+        members = forwardCTMPropagation(time, checkNet, members)
+      if np.any(members != members[0]):
+        raise Exception('... identical members diverged with coarse cells ...')
+    trafficNet.setReportedCells(None)  # e.g. the detector cells, LTM links then reconstruct only those
+    if activeSetTolerance is not None:
+      trafficNet.enableActiveSet(activeSetTolerance)
+    loadingMode = 'generator'  # 'dict' keeps every step in netLoadingResults, 'array' fills a (time x cells) array
+    if loadingMode == 'generator':
+      for time, densities in trafficNet.networkLoading(mode='generator'):
+        print(time, densities)
+    elif loadingMode == 'array':
+      results = trafficNet.networkLoading(mode='array', outFile='networkLoading.npy')  # memory mapped, outFile=None keeps it in RAM
+      print(results.shape)
+    else:
+      results=trafficNet.networkLoading()
+      print(results)
\ No newline at end of file
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+vectorized node models, all series, diverge and merge nodes of a
+network are processed as groups of array operations over the
+whole ensemble (members x cells), same flows as nodeModel
+
+@author: cesny
+"""
+import numpy as np
+
+
+def seriesFlows(sending, receiving):
+  '''
+  sending and receiving are (members x nodes)
+  '''
+  return np.minimum(sending, receiving)
+
+
+def divergeFlows(sending, receiving, proportions):
+  '''
+  sending is (members x nodes), receiving is (members x nodes x
+  outlinks), proportions is (nodes x outlinks), returns the flows
+  (members x nodes x outlinks) of DivergeNode
+  '''
+  demand = sending[:, :, np.newaxis] * proportions
+  with np.errstate(divide='ignore', invalid='ignore'):
+    thetas = np.where(demand != 0, receiving / demand, np.inf)  # as DivergeNode, also for negative sending flows
+  theta = np.minimum(1.0, np.min(thetas, axis=2))
+  return theta[:, :, np.newaxis] * demand
+
+
+def mergeFlows(sending, receiving, priorities):
+  '''
+  sending is (members x nodes x inlinks), receiving is (members x
+  nodes), priorities is (nodes x inlinks), returns the flows
+  (members x nodes x inlinks) of MergeNode: if the supply is short
+  it is shared in proportion to the priorities, approaches sending
+  less than their share keep their sending flow and the rest of
+  the supply is shared again among the others
+  '''
+  flows = np.array(sending, dtype=float)
+  congested = np.sum(sending, axis=2) > receiving
+  active = np.repeat(congested[:, :, np.newaxis], sending.shape[2], axis=2)
+  remaining = np.array(receiving, dtype=float)
+  for iteration in range(sending.shape[2] + 1):  # every pass caps at least one approach (possibly several) or stops
+    activePriority = np.sum(np.where(active, priorities, 0.0), axis=2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      share = remaining[:, :, np.newaxis] * priorities / activePriority[:, :, np.newaxis]
+    capped = active & (sending <= share)
+    if not np.any(capped):
+      break
+    remaining = remaining - np.sum(np.where(capped, sending, 0.0), axis=2)
+    active = active & ~capped
+  return np.where(active, share, flows)
+
+
+class NodeKernels:
+  '''
+  groups the nodes of a network by model and degree, cells are
+  indices into the state of an EnsembleCTM, apply adds the node
+  flows of one step to the change of every cell, merges whose
+  priorities are capacity shares take them from the cell capacities
+  of each step (per member capacities included)
+  '''
+  def __init__(self):
+    self.destinations = list()
+    self.seriesUp = list()
+    self.seriesDown = list()
+    self.diverges = dict()  # outlinks: (upCells, downCells, proportions)
+    self.merges = dict()  # inlinks: (upCells, downCells, priorities, capacityShares)
+
+  def addDestination(self, cell):
+    self.destinations.append(cell)
+    return None
+
+  def addSeries(self, upCell, downCell):
+    self.seriesUp.append(upCell)
+    self.seriesDown.append(downCell)
+    return None
+
+  def addDiverge(self, upCell, downCells, proportions):
+    group = self.diverges.setdefault(len(downCells), (list(), list(), list()))
+    group[0].append(upCell)
+    group[1].append(list(downCells))
+    group[2].append(list(proportions))
+    return None
+
+  def addMerge(self, upCells, downCell, priorities, capacityShares=False):
+    group = self.merges.setdefault(len(upCells), (list(), list(), list(), list()))
+    group[0].append(list(upCells))
+    group[1].append(downCell)
+    group[2].append(list(priorities))
+    group[3].append(capacityShares)
+    return None
+
+  def finalize(self):
+    '''
+    converts the groups to arrays, call after adding the nodes
+    '''
+    self.destinations = np.array(self.destinations, dtype=int)
+    self.seriesUp = np.array(self.seriesUp, dtype=int)
+    self.seriesDown = np.array(self.seriesDown, dtype=int)
+    for degree in self.diverges:
+      upCells, downCells, proportions = self.diverges[degree]
+      self.diverges[degree] = (np.array(upCells, dtype=int), np.array(downCells, dtype=int), np.array(proportions, dtype=float))
+    for degree in self.merges:
+      upCells, downCells, priorities, capacityShares = self.merges[degree]
+      self.merges[degree] = (np.array(upCells, dtype=int), np.array(downCells, dtype=int), np.array(priorities, dtype=float), np.array(capacityShares, dtype=bool))
+    return None
+
+  def apply(self, sending, receiving, change, capacity=None):
+    '''
+    sending, receiving and change are (members x cells), change
+    is updated in place, capacity (cells or members x cells) gives
+    the priorities of the merges that use capacity shares
+    '''
+    change[:, self.destinations] -= sending[:, self.destinations]
+    if len(self.seriesUp) > 0:
+      flow = seriesFlows(sending[:, self.seriesUp], receiving[:, self.seriesDown])
+      change[:, self.seriesUp] -= flow
+      change[:, self.seriesDown] += flow
+    for degree in self.diverges:
+      upCells, downCells, proportions = self.diverges[degree]
+      flow = divergeFlows(sending[:, upCells], receiving[:, downCells], proportions)
+      change[:, upCells] -= np.sum(flow, axis=2)
+      np.add.at(change, (slice(None), downCells), flow)
+    for degree in self.merges:
+      upCells, downCells, priorities, capacityShares = self.merges[degree]
+      if (capacity is not None) and np.any(capacityShares):
+        priorities = np.where(capacityShares[:, np.newaxis], capacity[..., upCells], priorities)
+      flow = mergeFlows(sending[:, upCells], receiving[:, downCells], priorities)
+      np.add.at(change, (slice(None), upCells), -flow)
+      change[:, downCells] += np.sum(flow, axis=2)
+    return change
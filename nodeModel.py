@@ -111,3 +111,75 @@ class DivergeNode(Node):
       transitionFlows[inLink][outLink] = theta * self.proportions[inLink][outLink] * sendingFlow[inLink]
     return transitionFlows
 
+class MergeNode(Node):
+  def __init__(self, nodeID, nodeModel, fstar, rstar):
+    self.priorities = dict()  # a dictionary with priorities of upstream links, empty for capacity shares
+    Node.__init__(self, nodeID, nodeModel, fstar, rstar)
+  
+  def _processStars(self, fstar, rstar):
+    """
+    overrides node processStars to read priorities if they are
+    given as link:priority in rstar
+    """
+    for star in fstar:
+      intStar = int(star)
+      self.fstar.append(intStar)
+    for star in rstar:
+      if ':' in star:
+        link, priority = star.split(':')
+        self.rstar.append(int(link))
+        self.priorities[int(link)] = float(priority)
+      else:
+        self.rstar.append(int(star))
+    return None
+  
+  def getPriorities(self):
+    """
+    priorities of the upstream links in rstar order, proportional to
+    the current link capacities (they follow updateVmaxCritDen) if
+    not given in the node file
+    """
+    if self.capacityShares():
+      capacities = dict((inLink.ID, inLink.params['qcap']) for inLink in self.upstreamLinks)
+      return [capacities[inLink] for inLink in self.rstar]
+    if len(self.priorities) != len(self.rstar):
+      raise Exception('... priorities missing for some upstream links of merge node ' + str(self.ID) + ' ...')
+    return [self.priorities[inLink] for inLink in self.rstar]
+  
+  def capacityShares(self):
+    """
+    True if the priorities are the capacity shares of the upstream links
+    """
+    return len(self.priorities) == 0
+  
+  def calculateTransitionFlows(self, sendingFlow, receivingFlow, proportions=None):
+    """
+    sendingFlow and receivingFlow are dictionaries
+    sendingFlow = {uplink1: val, uplink2: val..}
+    if the receiving flow is short it is shared by priority, links
+    sending less than their share keep their sending flow and the
+    rest is shared again among the others
+    """
+    transitionFlows = dict()
+    for inLinkID in self.rstar:
+      transitionFlows[inLinkID] = dict()
+    outLink = self.fstar[0]
+    priorities = dict(zip(self.rstar, self.getPriorities()))
+    if sum(sendingFlow[inLink] for inLink in self.rstar) <= receivingFlow[outLink]:
+      for inLink in self.rstar:
+        transitionFlows[inLink][outLink] = sendingFlow[inLink]
+      return transitionFlows
+    active = list(self.rstar)
+    remaining = receivingFlow[outLink]
+    while len(active) > 0:
+      activePriority = sum(priorities[inLink] for inLink in active)
+      capped = [inLink for inLink in active if sendingFlow[inLink] <= remaining * priorities[inLink] / activePriority]
+      if len(capped) == 0:
+        break
+      for inLink in capped:
+        transitionFlows[inLink][outLink] = sendingFlow[inLink]
+        remaining -= sendingFlow[inLink]
+        active.remove(inLink)
+    for inLink in active:
+      transitionFlows[inLink][outLink] = remaining * priorities[inLink] / activePriority
+    return transitionFlows
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+index based (sparse) observation operator for the EnKF
+
+@author: cesny
+"""
+import numpy as np
+
+
+class ObsOperator:
+  '''
+  observation operator defined by the list of observed cells
+  and optional weights, equivalent to a H matrix with row k
+  equal to weights[k] at column cells[k] and zero elsewhere
+  H products are computed by gathering rows/columns so no
+  dense obsDim x stateDim matrix is ever formed
+  '''
+  def __init__(self, cells, stateDim, weights=None):
+    self.cells = np.asarray(cells, dtype=int)  # observed state indices, one per observation
+    self.stateDim = stateDim
+    self.obsDim = len(self.cells)
+    self.weights = None
+    if weights is not None:
+      self.weights = np.asarray(weights, dtype=float)
+    self._rowOfCell = dict()  # maps a state index to its observation row
+    for row, cell in enumerate(self.cells):
+      self._rowOfCell.setdefault(int(cell), row)
+
+  def apply(self, X):
+    '''
+    returns H X for a state vector or a matrix with
+    stateDim rows (e.g., ensembles A or P H^T)
+    '''
+    HX = X[self.cells]
+    if self.weights is not None:
+      if HX.ndim == 1:
+        HX = HX * self.weights
+      else:
+        HX = HX * self.weights[:, np.newaxis]
+    return HX
+
+  def applyTranspose(self, P):
+    '''
+    returns P H^T for a matrix P with stateDim columns
+    '''
+    PHt = P[:, self.cells]
+    if self.weights is not None:
+      PHt = PHt * self.weights
+    return PHt
+
+  def obsRow(self, cell):
+    '''
+    returns the observation row of a state index, None
+    if the cell is not observed
+    '''
+    return self._rowOfCell.get(cell)
+
+  def toDense(self):
+    '''
+    returns the equivalent dense H, for debugging only
+    '''
+    H = np.zeros((self.obsDim, self.stateDim))
+    if self.weights is None:
+      H[np.arange(self.obsDim), self.cells] = 1.0
+    else:
+      H[np.arange(self.obsDim), self.cells] = self.weights
+    return H
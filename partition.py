@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+domain decomposed network loading, the network is split into
+partitions at boundary nodes and every partition is loaded in
+its own worker process, only the sending and receiving flows of
+the links at boundary nodes are exchanged every time step
+
+@author: cesny
+"""
+import multiprocessing as mp
+import numpy as np
+from network import Network
+
+
+def findPartitions(trafficNet, boundaryNodes):
+  '''
+  splits the links into partitions, two links are in the same
+  partition if they share a node that is not a boundary node,
+  returns a list of (linkIDs, nodeIDs) with links in linkDict
+  order, nodeIDs are the non boundary nodes of the partition
+  '''
+  for nodeID in boundaryNodes:
+    if trafficNet.nodeDict[nodeID].model == 'Zone':
+      raise Exception('... zones cannot be boundary nodes, node ' + str(nodeID) + ' ...')
+  parent = dict()
+  for linkID in trafficNet.linkDict:
+    parent[linkID] = linkID
+
+  def root(linkID):
+    while parent[linkID] != linkID:
+      parent[linkID] = parent[parent[linkID]]
+      linkID = parent[linkID]
+    return linkID
+
+  for nodeID in trafficNet.nodeDict:
+    if nodeID in boundaryNodes:
+      continue
+    node = trafficNet.nodeDict[nodeID]
+    links = [link.ID for link in node.upstreamLinks + node.downstreamLinks]
+    for linkID in links[1:]:
+      parent[root(linkID)] = root(links[0])
+  partitions = dict()  # root link: (linkIDs, nodeIDs)
+  for linkID in trafficNet.linkDict:
+    partitions.setdefault(root(linkID), (list(), list()))[0].append(linkID)
+  for nodeID in trafficNet.nodeDict:
+    if nodeID in boundaryNodes:
+      continue
+    node = trafficNet.nodeDict[nodeID]
+    linkID = (node.upstreamLinks + node.downstreamLinks)[0].ID
+    partitions[root(linkID)][1].append(nodeID)
+  return list(partitions.values())
+
+
+def _boundaryFlows(trafficNet, time, nodeIDs, boundaryInLinks, boundaryOutLinks):
+  '''
+  runs the node updates of the partition for time and returns the
+  sending flows of links entering boundary nodes and the receiving
+  flows of links leaving them
+  '''
+  for nodeID in nodeIDs:
+    trafficNet.nodeDict[nodeID].nodeUpdate(time, trafficNet.timeStep)
+  sending = dict()
+  for linkID in boundaryInLinks:
+    sending[linkID] = trafficNet.linkDict[linkID].calculateSendingFlow(time, trafficNet.timeStep)
+  receiving = dict()
+  for linkID in boundaryOutLinks:
+    receiving[linkID] = trafficNet.linkDict[linkID].calculateReceivingFlow(time, trafficNet.timeStep)
+  return sending, receiving
+
+
+def _partitionWorker(conn, networkArgs, linkIDs, nodeIDs, boundaryInLinks, boundaryOutLinks, activeSet):
+  '''
+  worker process, holds the network but only updates the links
+  and nodes of its partition
+  messages: ('prepare', time), ('advance', time, outFlows, inFlows),
+  ('set', time, linkDensities), ('stop',)
+  '''
+  trafficNet = Network(*networkArgs)
+  if activeSet is not None:
+    trafficNet.enableActiveSet(*activeSet)
+  while True:
+    message = conn.recv()
+    if message[0] == 'prepare':
+      conn.send(_boundaryFlows(trafficNet, message[1], nodeIDs, boundaryInLinks, boundaryOutLinks))
+    elif message[0] == 'advance':
+      time, outFlows, inFlows = message[1:]
+      for linkID in outFlows:
+        trafficNet.linkDict[linkID].outFlow = outFlows[linkID]
+      for linkID in inFlows:
+        trafficNet.linkDict[linkID].inFlow = inFlows[linkID]
+      linkDensities = dict()
+      for linkID in linkIDs:
+        link = trafficNet.linkDict[linkID]
+        link.linkUpdate(time + 1)
+        linkDensities[linkID] = link.linkDensity()
+      if time + 1 in trafficNet.totalTimesteps:  # prepare the next step in the same message
+        conn.send((linkDensities,) + _boundaryFlows(trafficNet, time + 1, nodeIDs, boundaryInLinks, boundaryOutLinks))
+      else:
+        conn.send((linkDensities, None, None))
+    elif message[0] == 'set':
+      time, linkDensities = message[1:]
+      for linkID in linkDensities:
+        trafficNet.linkDict[linkID].setCellDensities(linkDensities[linkID])
+      conn.send(_boundaryFlows(trafficNet, time, nodeIDs, boundaryInLinks, boundaryOutLinks))
+    elif message[0] == 'stop':
+      break
+    else:
+      raise Exception('... unknown partition message ' + str(message[0]) + ' ...')
+  conn.close()
+  return None
+
+
+class PartitionedNetwork:
+  '''
+  same interface as Network.loadNetworkStep and networkLoading,
+  the boundary nodes are computed here from the flows reported by
+  the workers, every worker reads the network files itself, the
+  links in excludeLinks (ramps) are not reported, as in EnsembleCTM
+  '''
+  def __init__(self, simTime, simStep, nodefile, linkfile, demandfile, boundaryNodes, activeSet=None, excludeLinks=(9,)):
+    self.networkArgs = (simTime, simStep, nodefile, linkfile, demandfile)
+    self.trafficNet = Network(*self.networkArgs)  # topology and boundary node models
+    self.totalTimesteps = self.trafficNet.totalTimesteps
+    self.boundaryNodes = list(boundaryNodes)
+    self.partitions = findPartitions(self.trafficNet, self.boundaryNodes)
+    self.activeSet = activeSet  # (tolerance, recheckInterval) for the CTM links, None for the full update
+    self.excludeLinks = excludeLinks
+    self.workers = list()  # (process, connection, linkIDs)
+    self._preparedTime = None  # time the workers have computed boundary flows for
+    self._sending = dict()
+    self._receiving = dict()
+
+  def start(self):
+    '''
+    starts one worker process per partition
+    '''
+    for linkIDs, nodeIDs in self.partitions:
+      boundaryInLinks = list()
+      boundaryOutLinks = list()
+      for nodeID in self.boundaryNodes:
+        node = self.trafficNet.nodeDict[nodeID]
+        boundaryInLinks += [link.ID for link in node.upstreamLinks if link.ID in linkIDs]
+        boundaryOutLinks += [link.ID for link in node.downstreamLinks if link.ID in linkIDs]
+      parentConn, childConn = mp.Pipe()
+      process = mp.Process(target=_partitionWorker, args=(childConn, self.networkArgs, linkIDs, nodeIDs,
+                                                          boundaryInLinks, boundaryOutLinks, self.activeSet))
+      process.daemon = True
+      process.start()
+      self.workers.append((process, parentConn, linkIDs))
+    return None
+
+  def close(self):
+    for process, conn, linkIDs in self.workers:
+      conn.send(('stop',))
+      process.join()
+    self.workers = list()
+    return None
+
+  def _collectFlows(self, replies):
+    self._sending = dict()
+    self._receiving = dict()
+    for sending, receiving in replies:
+      self._sending.update(sending)
+      self._receiving.update(receiving)
+    return None
+
+  def _prepare(self, time):
+    for process, conn, linkIDs in self.workers:
+      conn.send(('prepare', time))
+    self._collectFlows([conn.recv() for process, conn, linkIDs in self.workers])
+    self._preparedTime = time
+    return None
+
+  def setLinkDensities(self, time, linkDensities):
+    '''
+    overwrites cell densities, linkDensities is a dict linkID:
+    list of densities, as in Link.setCellDensities
+    '''
+    for process, conn, linkIDs in self.workers:
+      conn.send(('set', time, dict((linkID, linkDensities[linkID]) for linkID in linkIDs if linkID in linkDensities)))
+    self._collectFlows([conn.recv() for process, conn, linkIDs in self.workers])
+    self._preparedTime = time
+    return None
+
+  def loadNetworkStep(self, time):
+    '''
+    one step of network loading, same output as
+    Network.loadNetworkStep
+    '''
+    if len(self.workers) == 0:
+      self.start()
+    if self._preparedTime != time:
+      self._prepare(time)
+    outFlows = dict()
+    inFlows = dict()
+    for nodeID in self.boundaryNodes:
+      node = self.trafficNet.nodeDict[nodeID]
+      transitionFlows = node.calculateTransitionFlows(self._sending, self._receiving)
+      for inLink in transitionFlows:
+        outFlows[inLink] = sum(transitionFlows[inLink].values())
+        for outLink in transitionFlows[inLink]:
+          inFlows[outLink] = inFlows.get(outLink, 0.0) + transitionFlows[inLink][outLink]
+    for process, conn, linkIDs in self.workers:
+      conn.send(('advance', time, dict((linkID, outFlows[linkID]) for linkID in outFlows if linkID in linkIDs),
+                 dict((linkID, inFlows[linkID]) for linkID in inFlows if linkID in linkIDs)))
+    densities = dict()
+    replies = list()
+    for process, conn, linkIDs in self.workers:
+      linkDensities, sending, receiving = conn.recv()
+      densities.update(linkDensities)
+      replies.append((sending or dict(), receiving or dict()))
+    self._collectFlows(replies)
+    self._preparedTime = time + 1
+    reportedLinks = [linkID for linkID in self.trafficNet.linkDict if linkID not in self.excludeLinks]
+    linkDensities = np.concatenate([densities[linkID] for linkID in reportedLinks])
+    listofLinkDensities = list()
+    index = 0
+    for linkID in reportedLinks:
+      numCells = len(densities[linkID])
+      listofLinkDensities.append(linkDensities[index:index + numCells])
+      index += numCells
+    return linkDensities, listofLinkDensities
+
+  def networkLoading(self):
+    '''
+    full network loading, same output as Network.networkLoading
+    '''
+    self.netLoadingResults = dict()
+    for time in self.totalTimesteps:
+      self.netLoadingResults[time] = self.loadNetworkStep(time)
+    return self.netLoadingResults
+
+
+if __name__ == '__main__':
+  simTime = 4490
+  simTimeStep = 10
+  linkfile = 'VISSIMnetwork/links.txt'
+  nodefile = 'VISSIMnetwork/nodes.txt'
+  demandfile = 'VISSIMnetwork/demand6600.txt'
+  boundaryNodes = [4]  # series node in the middle of the corridor
+  partitioned = PartitionedNetwork(simTime, simTimeStep, nodefile, linkfile, demandfile, boundaryNodes)
+  print('partitions: ', [linkIDs for linkIDs, nodeIDs in partitioned.partitions])
+  results = partitioned.networkLoading()
+  partitioned.close()
+  monolithic = Network(simTime, simTimeStep, nodefile, linkfile, demandfile).networkLoading()
+  maxError = max(np.max(np.abs(np.array(results[time][0]) - np.array(monolithic[time][0]))) for time in results)
+  print('max difference with monolithic loading: ', maxError)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+decision cache for findPath, planner decisions are keyed by the
+drone location, time and quantized means and spreads of the CTM
+and vmax filters, so Monte Carlo replications of a scenario can
+reuse decisions instead of rerunning the rollouts
+
+@author: cesny
+"""
+import os
+import pickle
+from collections import OrderedDict
+import numpy as np
+
+
+def quantize(values, step):
+  '''
+  integer bins of width step, a tuple so it can be part of a key
+  '''
+  return tuple(int(value) for value in np.round(np.asarray(values, dtype=float) / step))
+
+
+class DecisionCache:
+  '''
+  LRU cache of planner decisions (direction, objective values),
+  densityStep and vmaxStep are the bin widths of the CTM and vmax
+  statistics (veh/km, km/hr), path is a pickle file shared across
+  runs, loaded on creation and merged on save
+  '''
+  def __init__(self, capacity=10000, densityStep=2.0, vmaxStep=1.0, path=None):
+    self.capacity = capacity
+    self.densityStep = densityStep
+    self.vmaxStep = vmaxStep
+    self.path = path
+    self.entries = OrderedDict()  # key: (direction, objective values), most recently used last
+    self.hits = 0
+    self.misses = 0
+    if (self.path is not None) and os.path.isfile(self.path):
+      self.load()
+
+  def makeKey(self, location, time, EnKFCTM, EnKFV, settings=()):
+    '''
+    key of a planning call, settings are the planner options that
+    change the decision (weight, horizon, scoring, ...)
+    '''
+    CTMspread = np.sqrt(np.maximum(np.diag(EnKFCTM.getP()), 0.0))
+    Vspread = np.sqrt(np.maximum(np.diag(EnKFV.getP()), 0.0))
+    return (tuple(location), time, tuple(settings),
+            quantize(EnKFCTM.getMean(), self.densityStep), quantize(CTMspread, self.densityStep),
+            quantize(EnKFV.getMean(), self.vmaxStep), quantize(Vspread, self.vmaxStep))
+
+  def get(self, key):
+    '''
+    cached (direction, objective values) or None
+    '''
+    if key not in self.entries:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self.entries.move_to_end(key)
+    return self.entries[key]
+
+  def put(self, key, direction, objectiveValues):
+    self.entries[key] = (direction, dict((path, float(value)) for path, value in objectiveValues.items()))
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.capacity:
+      self.entries.popitem(last=False)  # least recently used
+    return None
+
+  def hitRate(self):
+    lookups = self.hits + self.misses
+    if lookups == 0:
+      return 0.0
+    return float(self.hits) / lookups
+
+  def load(self, path=None):
+    '''
+    adds the entries of a saved cache, entries already held are
+    kept and count as more recently used
+    '''
+    path = self.path if path is None else path
+    with open(path, 'rb') as cf:
+      saved = pickle.load(cf)
+    if (saved['densityStep'] != self.densityStep) or (saved['vmaxStep'] != self.vmaxStep):
+      raise Exception('... cache file ' + path + ' was saved with different quantization steps ...')
+    entries = OrderedDict(saved['entries'])
+    entries.update(self.entries)
+    self.entries = entries
+    while len(self.entries) > self.capacity:
+      self.entries.popitem(last=False)
+    return None
+
+  def save(self, path=None):
+    '''
+    merges with the file (other runs may have saved to it) and
+    writes through a temporary file so readers never see a partial cache
+    '''
+    path = self.path if path is None else path
+    if os.path.isfile(path):
+      self.load(path)
+    tempPath = path + '.tmp' + str(os.getpid())
+    with open(tempPath, 'wb') as cf:
+      pickle.dump({'densityStep': self.densityStep, 'vmaxStep': self.vmaxStep, 'entries': list(self.entries.items())}, cf)
+    os.replace(tempPath, path)
+    return None
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+planner snapshots and replay, main.py can record the inputs of
+every planning call (ensembles, means, covariances, UAV location,
+link parameters) and this module reruns only the planner on them,
+in parallel across steps, to tune findPath without rerunning the
+propagation and assimilation
+
+@author: cesny
+"""
+import os
+import glob
+import json
+import copy as cp
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from network import Network
+from EnKF import EnKF
+from findPath import findPath
+from utils import VmaxMemberParameters
+
+
+def snapshotPath(directory, time):
+  return os.path.join(directory, 'step_%04d.npz' % time)
+
+
+def saveSnapshot(directory, time, EnKFCTM, EnKFV, trafficNet, droneLocation, rng=None):
+  '''
+  writes the planner inputs of one step to directory/step_tttt.npz,
+  rng is the planner's generator, its seed sequence is stored so
+  the replay spawns the same rollout streams
+  '''
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  linkIDs = sorted(trafficNet.linkDict)
+  linkParams = np.array([[trafficNet.linkDict[linkID].params['ffs'], trafficNet.linkDict[linkID].params['critDen']] for linkID in linkIDs])
+  rngState = ''
+  if rng is not None:
+    seedSequence = rng.bit_generator.seed_seq
+    rngState = json.dumps({'entropy': seedSequence.entropy, 'spawn_key': list(seedSequence.spawn_key),
+                           'pool_size': seedSequence.pool_size, 'n_children_spawned': seedSequence.n_children_spawned})
+  np.savez_compressed(snapshotPath(directory, time), time=time, droneLocation=np.array(droneLocation),
+                      CTMA=EnKFCTM.A, CTMP=EnKFCTM.P, CTMmean=EnKFCTM.mean,
+                      VA=EnKFV.A, VP=EnKFV.P, Vmean=EnKFV.mean,
+                      linkIDs=np.array(linkIDs), linkParams=linkParams, rngState=np.array(rngState))
+  return None
+
+
+def loadSnapshot(path):
+  '''
+  returns the snapshot as a dict
+  '''
+  with np.load(path) as data:
+    snapshot = dict((key, data[key]) for key in data.files)
+  snapshot['time'] = int(snapshot['time'])
+  snapshot['droneLocation'] = tuple(int(value) for value in snapshot['droneLocation'])
+  snapshot['rngState'] = str(snapshot['rngState'])
+  return snapshot
+
+
+def restoreFilter(EnKFinstance, A, P, mean):
+  '''
+  sets the filter state the planner reads (getUpdatedEnsembles,
+  getP, getMean)
+  '''
+  EnKFinstance.A = np.array(A)
+  EnKFinstance.P = np.array(P)
+  EnKFinstance.mean = np.array(mean)
+  EnKFinstance.sampleSize = EnKFinstance.A.shape[1]
+  EnKFinstance.Abar = np.repeat(EnKFinstance.mean[:, np.newaxis], EnKFinstance.sampleSize, axis=1)
+  EnKFinstance.Aprime = EnKFinstance.A - EnKFinstance.Abar
+  return None
+
+
+def restoreSnapshot(snapshot, trafficNet, EnKFCTM, EnKFV):
+  '''
+  applies a snapshot to a network and filters built with the
+  configuration of the recorded run
+  '''
+  for linkID, (ffs, critDen) in zip(snapshot['linkIDs'], snapshot['linkParams']):
+    link = trafficNet.linkDict[int(linkID)]
+    if (link.params['ffs'] != ffs) or (link.params['critDen'] != critDen):
+      link.updateVmaxCritDen(float(ffs), float(critDen))
+      trafficNet.ensembleEngine = None  # rebuilt with the restored parameters
+  restoreFilter(EnKFCTM, snapshot['CTMA'], snapshot['CTMP'], snapshot['CTMmean'])
+  restoreFilter(EnKFV, snapshot['VA'], snapshot['VP'], snapshot['Vmean'])
+  EnKFCTM.droneLoc = snapshot['droneLocation']
+  EnKFV.droneLoc = snapshot['droneLocation']
+  return None
+
+
+_replayTemplates = None  # (trafficNet, EnKFCTM, EnKFV) built once per worker process
+
+
+def _initReplayWorker(config):
+  '''
+  config holds the Network arguments ('network') and the EnKF
+  keyword arguments of the CTM and vmax filters ('EnKFCTM', 'EnKFV')
+  '''
+  global _replayTemplates
+  trafficNet = Network(*config['network'])
+  EnKFCTM = EnKF(trafficNet=trafficNet, **config['EnKFCTM'])
+  EnKFV = EnKF(trafficNet=trafficNet, **config['EnKFV'])
+  _replayTemplates = (trafficNet, EnKFCTM, EnKFV)
+  return None
+
+
+def replayStep(path, plannerOptions):
+  '''
+  reruns findPath.updateLocation on one snapshot, plannerOptions
+  are findPath keyword arguments (weight, timeHorizon, scoring, ...)
+  and perMemberVmax, returns (time, recorded location, new location,
+  objective values)
+  '''
+  snapshot = loadSnapshot(path)
+  trafficNet, EnKFCTM, EnKFV = cp.deepcopy(_replayTemplates)
+  restoreSnapshot(snapshot, trafficNet, EnKFCTM, EnKFV)
+  plannerOptions = dict(plannerOptions)
+  memberParams = VmaxMemberParameters(EnKFV.getUpdatedEnsembles()) if plannerOptions.pop('perMemberVmax', False) else None
+  rng = None
+  if snapshot['rngState'] != '':
+    seedSequence = json.loads(snapshot['rngState'])
+    rng = np.random.default_rng(np.random.SeedSequence(seedSequence['entropy'], spawn_key=tuple(seedSequence['spawn_key']),
+                                                       pool_size=seedSequence['pool_size'], n_children_spawned=seedSequence['n_children_spawned']))
+  explorePath = findPath(snapshot['droneLocation'], snapshot['time'], trafficNet, EnKFCTM, EnKFV, rng=rng, memberParams=memberParams, **plannerOptions)
+  newLocation = explorePath.updateLocation()
+  return snapshot['time'], snapshot['droneLocation'], newLocation, explorePath.ObjectiveVal
+
+
+def replay(directory, config, plannerOptions, workers=4):
+  '''
+  replays every snapshot in directory in parallel, returns the
+  results of replayStep sorted by time
+  '''
+  paths = sorted(glob.glob(os.path.join(directory, 'step_*.npz')))
+  if workers == 1:
+    _initReplayWorker(config)
+    return [replayStep(path, plannerOptions) for path in paths]
+  with ProcessPoolExecutor(max_workers=workers, initializer=_initReplayWorker, initargs=(config,)) as executor:
+    results = list(executor.map(replayStep, paths, [plannerOptions] * len(paths)))
+  return results
+
+
+def recordedDecisions(results):
+  '''
+  the location the recorded run moved to at each step is the
+  drone location of the next snapshot
+  '''
+  decisions = dict()
+  for (time, location, newLocation, objective), following in zip(results[:-1], results[1:]):
+    decisions[time] = following[1]
+  return decisions
+
+
+if __name__ == '__main__':
+  from observationOperator import ObsOperator
+  from utils import m
+  snapshotDir = 'snapshots'  # recordSnapshots directory of main.py
+  config = {'network': (4490, 10, 'VISSIMnetwork/nodes.txt', 'VISSIMnetwork/links.txt', 'VISSIMnetwork/demand6600.txt'),
+            'EnKFCTM': dict(obsError=10, modelError=5, sampleSize=100, stateDim=40, obsDim=40, H=ObsOperator(range(40), 40), EnKFtype='CTM', droneDenObsError=2, noiseBlockSize=100000),
+            'EnKFV': dict(obsError=5, modelError=5, sampleSize=100, stateDim=2, obsDim=2, m=m, assimilatedDensities=[0,0], EnKFtype='Vmax', nonLinearObs=True, noiseBlockSize=100000)}
+  plannerOptions = dict(weight=1.0, timeHorizon=None, scoring='ensemble')  # the settings under test
+  results = replay(snapshotDir, config, plannerOptions)
+  decisions = recordedDecisions(results)
+  agree = sum(1 for time, location, newLocation, objective in results if decisions.get(time) == newLocation)
+  print('decisions matching the recorded run: ', agree, 'of', len(decisions))
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+random number streams used by the EnKFs, the ensemble
+builders and the planner rollouts
+
+@author: cesny
+"""
+import numpy as np
+
+
+def spawnGenerators(seed, numStreams):
+  '''
+  spawns numStreams independent but reproducible generators
+  from one seed (an int or a SeedSequence), use one stream
+  per filter, worker or planner rollout
+  '''
+  if isinstance(seed, np.random.SeedSequence):
+    seedSequence = seed
+  else:
+    seedSequence = np.random.SeedSequence(seed)
+  return [np.random.default_rng(child) for child in seedSequence.spawn(numStreams)]
+
+
+class NoiseStream:
+  '''
+  draws gaussian noise from a numpy Generator, if blockSize
+  is given standard normals are pre-generated in blocks of
+  blockSize values and consumed by slicing
+  '''
+  def __init__(self, rng=None, blockSize=None):
+    if rng is None:
+      rng = np.random.default_rng()
+    self.rng = rng
+    self.blockSize = blockSize
+    self._block = np.empty(0)
+    self._position = 0
+
+  def _refill(self, count):
+    '''
+    generates a new block, large enough to hold at least count
+    values, leftovers of the previous block are dropped
+    '''
+    self._block = self.rng.standard_normal(max(self.blockSize, count))
+    self._position = 0
+    return None
+
+  def standardNormal(self, size):
+    '''
+    returns standard normal samples with shape size
+    '''
+    if self.blockSize is None:
+      return self.rng.standard_normal(size)
+    count = int(np.prod(size))
+    if self._position + count > self._block.size:
+      self._refill(count)
+    samples = self._block[self._position:self._position + count]
+    self._position += count
+    return samples.reshape(size)
+
+  def normal(self, loc=0.0, scale=1.0, size=None):
+    '''
+    same call signature as np.random.normal
+    '''
+    return loc + scale * self.standardNormal(size)
+
+  def spawn(self, numStreams):
+    '''
+    returns numStreams independent child streams with the
+    same block size, used to seed planner rollouts
+    '''
+    return [NoiseStream(child, self.blockSize) for child in self.rng.spawn(numStreams)]
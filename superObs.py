@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+super-observations for dense sensor feeds, readings of a time step
+are combined per cell into one observation with a reduced error
+variance and optionally thinned, so the EnKF assimilates a small
+observation vector however many readings come in
+
+@author: cesny
+"""
+import numpy as np
+from observationOperator import ObsOperator
+
+
+def combineReadings(cells, values, variances, correlation=0.0):
+  '''
+  one super-observation per cell, the inverse variance weighted
+  mean of its readings, with error variance w^T S w where S is the
+  error covariance of the readings: independent readings give
+  1/sum(1/var), correlation > 0 (readings of a cell sharing an error,
+  e.g., the same probe) reduces the variance less
+  returns cells (sorted), values and variances as arrays
+  '''
+  cells = np.asarray(cells, dtype=int)
+  values = np.asarray(values, dtype=float)
+  variances = np.broadcast_to(np.asarray(variances, dtype=float), values.shape)
+  uniqueCells, inverse = np.unique(cells, return_inverse=True)
+  precision = 1.0 / variances
+  weights = precision / np.bincount(inverse, weights=precision)[inverse]
+  superValues = np.bincount(inverse, weights=weights * values)
+  sigma = np.sqrt(variances)
+  independent = np.bincount(inverse, weights=(weights * sigma)**2)
+  shared = np.bincount(inverse, weights=weights * sigma)**2
+  superVariances = (1.0 - correlation) * independent + correlation * shared
+  return uniqueCells, superValues, superVariances
+
+
+def thinObservations(cells, values, variances, stateDim, maxObs, keepCells=()):
+  '''
+  keeps at most maxObs observations, cells in keepCells (e.g., the
+  drone cell) are always kept, the state is split into equal blocks
+  for the others and every block keeps its most precise observation
+  '''
+  if len(cells) <= maxObs:
+    return cells, values, variances
+  kept = [row for row, cell in enumerate(cells) if cell in keepCells]
+  numBlocks = maxObs - len(kept)
+  if numBlocks < 0:
+    raise Exception('... more cells to keep than maxObs ...')
+  blocks = (np.asarray(cells) * numBlocks) // stateDim
+  selected = list(kept)
+  for block in range(numBlocks):
+    candidates = [row for row in np.flatnonzero(blocks == block) if row not in kept]
+    if len(candidates) > 0:
+      selected.append(min(candidates, key=lambda row: variances[row]))
+  selected = np.sort(selected)
+  return cells[selected], values[selected], variances[selected]
+
+
+class SuperObservations:
+  '''
+  pre-assimilation stage, the readings of a time step (cells,
+  values, error variances) are combined per cell, thinned to at
+  most maxObs and assimilated with an ObsOperator and per observation
+  errors set only for that step, the drone reading is one more
+  reading of its cell (the filter's lower drone error is not applied
+  on top of the combined variance)
+  '''
+  def __init__(self, stateDim, maxObs=None, correlation=0.0):
+    self.stateDim = stateDim
+    self.maxObs = maxObs  # None keeps every observed cell
+    self.correlation = correlation  # error correlation of readings of the same cell
+    self.storeObsDim = list()
+    self.storeReadings = list()
+
+  def build(self, cells, values, variances, keepCells=()):
+    '''
+    returns the ObsOperator, observations and error variances
+    '''
+    cells, values, variances = combineReadings(cells, values, variances, self.correlation)
+    if self.maxObs is not None:
+      cells, values, variances = thinObservations(cells, values, variances, self.stateDim, self.maxObs, keepCells)
+    return ObsOperator(cells, self.stateDim), values, variances
+
+  def assimilate(self, EnKFinstance, forecasts, cells, values, variances, keepCells=(), window=None, flush=False, droneReading=None):
+    '''
+    EnKFStep (windowStep if window is given) with the super-observations,
+    droneReading is (cell, value, variance), combined with the other
+    readings of its cell and always kept, the observation settings of
+    the filter are restored afterwards so the planner keeps the
+    nominal sensors
+    '''
+    cells = np.asarray(cells, dtype=int)
+    values = np.asarray(values, dtype=float)
+    variances = np.broadcast_to(np.asarray(variances, dtype=float), values.shape)
+    if droneReading is not None:
+      cells = np.append(cells, droneReading[0])
+      values = np.append(values, droneReading[1])
+      variances = np.append(variances, droneReading[2])
+      keepCells = list(keepCells) + [droneReading[0]]
+    H, observations, obsVariances = self.build(cells, values, variances, keepCells)
+    self.storeReadings.append(len(values))
+    self.storeObsDim.append(H.obsDim)
+    saved = (EnKFinstance.H, EnKFinstance.obsDim, EnKFinstance.obsError, EnKFinstance.droneLoc)
+    EnKFinstance.H = H
+    EnKFinstance.obsDim = H.obsDim
+    EnKFinstance.obsError = np.sqrt(obsVariances)
+    EnKFinstance.droneLoc = None  # no drone row override, the drone reading is in the super-observations
+    try:
+      if window is None:
+        ensembles = EnKFinstance.EnKFStep(forecasts, observations)
+      else:
+        ensembles = EnKFinstance.windowStep(forecasts, observations, window, flush)
+    finally:
+      EnKFinstance.H, EnKFinstance.obsDim, EnKFinstance.obsError, EnKFinstance.droneLoc = saved
+    return ensembles
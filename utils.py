@@ -9,12 +9,17 @@ import numpy as np
 import copy as cp
 
 
-def readData(textfile):
+def readData(textfile, geometry=None):
   """
   reads the text file
   returns two lists with density and velocity
   measured at a specific point
+  if a CorridorGeometry is given, segments are mapped to cells by
+  their link and offset and each cell takes the segment nearest to
+  its center, otherwise the fixed thresholds below are used
   """
+  if geometry is not None:
+    return _readSegmentData(textfile, geometry)
   try:
     with open(textfile) as tf:
       density = dict()
@@ -47,57 +52,134 @@ def readData(textfile):
   return density, speed
 
 
+def _readSegmentData(textfile, geometry):
+  """
+  readData using the corridor geometry, density lists are
+  ordered by global cell, speeds are those of the first cell
+  of the incident links 2 and 7
+  """
+  records = list()  # (timeStep, link, offset km, density, speed)
+  try:
+    with open(textfile) as tf:
+      for line in tf:
+        data = line.strip().split(';')
+        first_number = 0
+        try:
+          first_number = float(data[0])
+        except:
+          pass
+        if first_number == 1:
+          roadid_str_list = data[2].split('-')
+          link = int(float(roadid_str_list[0]))
+          if link not in geometry.linkPosition:
+            continue
+          time = data[1].split('-')
+          records.append((float(time[0]) / 10, link, float(roadid_str_list[1]) / 1000.0, float(data[3]), float(data[5])))
+  except IOError as ioerr:
+    print('failed to read' + str(ioerr))
+  density = dict()
+  speed = dict()
+  if len(records) == 0:
+    return density, speed
+  timeSteps, links, offsets, densities, speeds = (np.array(column) for column in zip(*records))
+  cells = geometry.linkOffsetToCell(links, offsets)
+  distance = np.abs(geometry.linkOffsets[[geometry.linkPosition[link] for link in links]] + offsets - geometry.cellToKm(cells))
+  order = np.lexsort((distance, cells, timeSteps))  # per time step and cell, the nearest segment comes first
+  incidentCells = geometry.locToCell([2, 7], [0, 0])
+  previous = None
+  for index in order:
+    key = (timeSteps[index], cells[index])
+    if key == previous:
+      continue
+    previous = key
+    timeStep = timeSteps[index]
+    density.setdefault(timeStep, []).append(densities[index])
+    speed.setdefault(timeStep, [])
+    if cells[index] in incidentCells:
+      if densities[index] != 0.0:  #density is not zero
+        speed[timeStep].append(speeds[index])
+      else:
+        speed[timeStep].append(100.0)
+  for timeStep in density:
+    if len(density[timeStep]) != geometry.numCells:
+      raise Exception('... time step ' + str(timeStep) + ' does not have a segment in every cell ...')
+  return density, speed
+
+
 def setCTMVehicles(trafficNet, EnKFensemble):
   '''
   sets the vehicles in CTM traffic model
   based on one particular ensemble output
-  an ensemble is a list of 40 CTM densities
+  an ensemble is an array of 40 CTM densities
   across cells, set ramp cells to zero to
   allow vehicles to exit
   '''
   cellindex = 0
   for linkID in trafficNet.linkDict:
+    link = trafficNet.linkDict[linkID]
     if linkID is not 9:
-      for cell in trafficNet.linkDict[linkID].cells:
-        EnKFveh = EnKFensemble[cellindex] * cell.length  # convert density to vehicles
-        cell.vehicles = EnKFveh  # assign EnKF determined vehicles to cell
-        cellindex += 1
+      link.setCellDensities(EnKFensemble[cellindex:cellindex + link.numCells])  # assign EnKF determined densities to cells
+      cellindex += link.numCells
     if linkID is 9:
-      for cell in trafficNet.linkDict[linkID].cells:
-        cell.vehicles = 0
+      link.setCellDensities([0.0] * link.numCells)
   return trafficNet
 
 
-def forwardCTMPropagation(time, trafficNet, EnKFensembles):
+def forwardCTMPropagation(time, trafficNet, EnKFensembles, memberParams=None):
   '''
   propagates a set of EnKF ensembles forward
-  each EnKF ensemble is a list of 40 density values across
-  cells
+  EnKFensembles is a (members x cells) array, each row is
+  the 40 density values of a member
   flow is propagated using cell transmission model
-  return a list of lists with propagated ensembles
+  memberParams is a dict linkID: (members x 3) array of ffs, critDen
+  and capacity, if given all members are propagated together with
+  their own parameters by the batched engine (see VmaxMemberParameters)
+  or one by one when the engine cannot take them (free flow speeds
+  of LTM links)
+  returns a (members x cells) array with propagated ensembles
   '''
-  propagatedEnsembles = list()
-  for ensemble in EnKFensembles:
+  EnKFensembles = np.asarray(EnKFensembles, dtype=float)
+  if memberParams is not None:
+    engine = trafficNet.getEnsembleEngine()
+    if engine.acceptsMemberParameters(memberParams):
+      engine.setMemberParameters(memberParams)
+      return engine.propagate(time, EnKFensembles)
+  propagatedEnsembles = np.empty_like(EnKFensembles)
+  if memberParams is not None:
+    nominal = {linkID: (trafficNet.linkDict[linkID].params['ffs'], trafficNet.linkDict[linkID].params['critDen']) for linkID in memberParams}
+  for member, ensemble in enumerate(EnKFensembles):
+    if memberParams is not None:
+      for linkID in memberParams:
+        trafficNet.linkDict[linkID].updateVmaxCritDen(memberParams[linkID][member][0], memberParams[linkID][member][1])
     trafficNet = setCTMVehicles(trafficNet, ensemble)  # set current ensembles
-    propagatedEnsembles.append(trafficNet.loadNetworkStep(time)[0])  # propagate the ensembles forward using model
+    propagatedEnsembles[member] = trafficNet.loadNetworkStep(time)[0]  # propagate the ensembles forward using model
+  if memberParams is not None:
+    for linkID in nominal:
+      trafficNet.linkDict[linkID].updateVmaxCritDen(nominal[linkID][0], nominal[linkID][1])
   return propagatedEnsembles
 
 
-def CTMcreateInitialEnsemble(stateDim, ensembleSize, modSTDV, bestguess=20):
+def CTMcreateInitialEnsemble(stateDim, ensembleSize, modSTDV, bestguess=20, rng=None):
   '''
   creates an initial ensemble around a best guess
   estimate of the state
   best guess is a single number for best guess average
   densities on the states
+  rng is a numpy Generator, a fresh one is used if None
   '''
-  return np.random.normal(loc=bestguess, scale=modSTDV, size=(ensembleSize,stateDim)).tolist()
+  if rng is None:
+    rng = np.random.default_rng()
+  return rng.normal(loc=bestguess, scale=modSTDV, size=(ensembleSize,stateDim))
 
   
-def VmaxCreateInitialEnsemble(VstateDim,Vensembles,VmodSTDV, bestguess=80):
+def VmaxCreateInitialEnsemble(VstateDim,Vensembles,VmodSTDV, bestguess=80, rng=None):
   '''
   creates an initial ensemble for vmax
+  rng is a numpy Generator, a fresh one is used if None
   '''
-  return np.random.normal(loc=bestguess, scale=VmodSTDV, size=(Vensembles,VstateDim)).tolist()
+  if rng is None:
+    rng = np.random.default_rng()
+  return rng.normal(loc=bestguess, scale=VmodSTDV, size=(Vensembles,VstateDim))
 
   
 def m(vmax, rho):
@@ -123,11 +205,23 @@ def VmaxtoCritDen(vmax):
   defines the relationship based on maintaining uncongested
   backwave
   '''
-  rhoCrit=np.full(vmax.shape,0.0)
-  for key, vmaxVal in enumerate(vmax):  
-    rhoCritical = (80.0*100*300)/(vmaxVal*(300 - 80) + 80*100)
-    rhoCrit[key] = rhoCritical
-  return rhoCrit
+  return (80.0*100*300)/(np.asarray(vmax, dtype=float)*(300 - 80) + 80*100)
+
+
+def VmaxMemberParameters(VmaxEnsembles, linkIDs=(2, 7)):
+  '''
+  builds per member parameters for forwardCTMPropagation from
+  the vmax ensembles (members x incident links), returns a dict
+  linkID: (members x 3) array of ffs, critical density, capacity
+  linkIDs follow the order of Network.updateVmaxCritDen
+  '''
+  VmaxEnsembles = np.asarray(VmaxEnsembles, dtype=float)
+  memberParams = dict()
+  for key, linkID in enumerate(linkIDs):
+    vmax = VmaxEnsembles[:, key]
+    critDen = VmaxtoCritDen(vmax)
+    memberParams[linkID] = np.stack((vmax, critDen, vmax * critDen), axis=1)
+  return memberParams
 
 
 def createLocToCell(trafficNet):
@@ -135,16 +229,7 @@ def createLocToCell(trafficNet):
   creates the mapping between (linkid, cell) to
   global cellindex between (0,40) across all links
   '''
-  cellindex = 0
-  locToCell = dict()
-  cellToLoc = dict()
-  for linkID in trafficNet.linkDict:
-    if linkID is not 9:
-      for cellkey, cell in enumerate(trafficNet.linkDict[linkID].cells):
-        locToCell[(linkID, cellkey)] = cellindex
-        cellToLoc[cellindex] = (linkID, cellkey)
-        cellindex += 1
-  return locToCell
+  return dict(trafficNet.getGeometry().locToCellMap)
 
 
 def cellToLength(listofLocations, trafficNet):
@@ -152,19 +237,21 @@ def cellToLength(listofLocations, trafficNet):
   returns UAV location on the road network in km
   across time, input list of UAV location (linkID, linkCell)
   '''
-  DronePositions = list()
-  LocToCell = createLocToCell(trafficNet)
-  for location in listofLocations:
-    cellLocation = LocToCell[location]
-    physicalLocation = (5.0/18)*cellLocation + (5.0/36)
-    DronePositions.append(physicalLocation)
-  return DronePositions
+  if len(listofLocations) == 0:
+    return list()
+  geometry = trafficNet.getGeometry()
+  linkIDs, cells = zip(*listofLocations)
+  return geometry.cellToKm(geometry.locToCell(linkIDs, cells)).tolist()
 
 
-def lengthToCell(locKm):
+def lengthToCell(locKm, trafficNet=None):
   '''
   from position in km to cell number
+  with trafficNet the cell containing each position is found in
+  the corridor geometry, otherwise uniform 5/18 km cells are assumed
   '''
+  if trafficNet is not None:
+    return trafficNet.getGeometry().kmToCell(locKm).tolist()
   cell_loc = list()
   for loc in locKm:
      cell_loc.append(int(loc*(18.0/5)-0.5))